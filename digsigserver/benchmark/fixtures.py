@@ -0,0 +1,264 @@
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import stat
+import tarfile
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from digsigserver.signers.tegrasign import TegraSigner
+
+MACHINE = 'bench'
+TEGRA_BSPVERSION = '35.4.1'
+TEGRA_SOCTYPE = 'tegra234'
+CST_VERSION = '3.3.1'
+
+
+# Shell snippets for the stand-ins for the vendor tools.  Each one
+# sleeps for the configured latency, then produces output in the
+# place the signer expects to find it.
+def _stub(latency: float, body: str) -> str:
+    return '#!/bin/sh\nsleep {}\n{}\n'.format(latency, body)
+
+
+_ARG_AFTER = '''{var}=
+prev=
+for a in "$@"; do
+    [ "$prev" = "{flag}" ] && {var}="$a"
+    prev="$a"
+done
+'''
+
+_LAST_ARG = 'for last in "$@"; do :; done\n'
+
+STUB_TOOLS = {
+    'mkimage': _LAST_ARG + 'head -c 512 /dev/urandom >> "$last"',
+    'openssl': _ARG_AFTER.format(var='out', flag='-out') + 'head -c 256 /dev/urandom > "$out"',
+    'sign-file': 'head -c 512 /dev/urandom >> "$4"\nprintf "~Module signature appended~\\n" >> "$4"',
+    'cst': _ARG_AFTER.format(var='out', flag='-o') + 'head -c 4096 /dev/urandom > "$out"',
+    'rk_sign_tool': '''case "$1" in
+    sb|sl) for last in "$@"; do :; done; head -c 2048 /dev/urandom >> "$last" ;;
+esac''',
+    'flash-helper': '''bup=
+for a in "$@"; do [ "$a" = "--bup" ] && bup=yes; done
+if [ -n "$bup" ]; then
+    # Like the real BUP generator, each BUPGENSPECS entry's run adds
+    # its entries to the shared payloads left by the runs before it
+    mkdir -p payloads_t23x
+    for payload in bl_only_payload bl_update_payload; do
+        printf '%s-%s\n' "$BOARDID" "$FAB" >> "payloads_t23x/$payload"
+        cat "$LNXFILE" >> "payloads_t23x/$payload"
+    done
+else
+    cp "$LNXFILE" "$LNXFILE.signed"
+    echo "flash.sh" > flashcmd.txt
+fi''',
+}
+
+
+def _write(path: str, data, mode: int = 0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+def _write_stub(path: str, latency: float, tool: str):
+    _write(path, _stub(latency, STUB_TOOLS[tool]), stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP)
+
+
+def _generate_keys(keydir: str):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'digsigserver benchmark')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=365)).sign(
+        key, hashes.SHA256())
+    key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                serialization.NoEncryption())
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    pubkey_pem = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+    cst_keys = io.BytesIO()
+    with tarfile.open(fileobj=cst_keys, mode='w:gz') as tf:
+        info = tarfile.TarInfo('crts/SRK1_sha256_2048_65537_v3_ca_crt.pem')
+        info.size = len(cert_pem)
+        tf.addfile(info, io.BytesIO(cert_pem))
+    files = {
+        'tegrasign/rsa_priv.pem': key_pem,
+        'rksign/dev.key': key_pem,
+        'rksign/dev.crt': cert_pem,
+        'rksign/dev.pubkey': pubkey_pem,
+        'imxsign/imx-cst-keys.tar.gz': cst_keys.getvalue(),
+        'fitimagesign/dev.key': key_pem,
+        'fitimagesign/dev.crt': cert_pem,
+        'kmodsign/kernel-signkey.priv': key_pem,
+        'kmodsign/kernel-signkey.x509': cert_pem,
+        'opteesign/optee-signing-key.pem': key_pem,
+        'swupdate/rsa-private.key': key_pem,
+        'mender/private.key': key_pem,
+        'uefisign/db.key': key_pem,
+        'uefisign/db.crt': cert_pem,
+    }
+    for name, data in files.items():
+        _write(os.path.join(keydir, MACHINE, name), data, 0o600)
+
+
+def _setup_l4t_tools(basedir: str, latency: float):
+    toolspath = os.path.join(basedir, 'L4T-{}-{}'.format(TEGRA_BSPVERSION, TEGRA_SOCTYPE), 'Linux_for_Tegra')
+    scripts = (TegraSigner.signing_scripts + TegraSigner.tegrasign_v3_scripts + TegraSigner.tegrasign_v3_support
+               + TegraSigner.r35_and_later + [os.path.join('bootloader', 'nvflashxmlparse'),
+                                              os.path.join('bootloader', 'rollback', 'rollback_parser.py'),
+                                              os.path.join('bootloader', 'tegrasign_v3_oemkey.yaml')])
+    for script in scripts:
+        if script.endswith('pyfdt'):
+            _write(os.path.join(toolspath, script, '__init__.py'), '')
+        else:
+            _write(os.path.join(toolspath, script), '#!/bin/sh\nexit 0\n', 0o755)
+    _write_stub(os.path.join(toolspath, 'bootloader', '{}-flash-helper'.format(TEGRA_SOCTYPE)),
+                latency, 'flash-helper')
+
+
+def setup_environment(basedir: str, latency: float) -> dict:
+    # Populates basedir with keys and stand-in tools, returning the
+    # server configuration (as environment variables) to use them.
+    keydir = os.path.join(basedir, 'keys')
+    _generate_keys(keydir)
+    bindir = os.path.join(basedir, 'bin')
+    for tool in ['mkimage', 'openssl', 'sign-file']:
+        _write_stub(os.path.join(bindir, tool), latency, tool)
+    cst_base = os.path.join(basedir, 'nxp')
+    _write_stub(os.path.join(cst_base, 'cst-{}'.format(CST_VERSION), 'linux64', 'bin', 'cst'), latency, 'cst')
+    rk_tools = os.path.join(basedir, 'rockchip')
+    _write_stub(os.path.join(rk_tools, 'rkbin-tools', 'rk_sign_tool'), latency, 'rk_sign_tool')
+    _write(os.path.join(rk_tools, 'rkbin-tools', 'boot_merger'), '#!/bin/sh\nexit 0\n', 0o755)
+    _write(os.path.join(rk_tools, 'rkbin-tools', 'setting.ini'), '[System]\n')
+    l4t_base = os.path.join(basedir, 'nvidia')
+    _setup_l4t_tools(l4t_base, latency)
+    os.makedirs(os.path.join(basedir, 'artifacts'), exist_ok=True)
+    return {
+        'PATH': bindir + ':' + os.environ.get('PATH', '/usr/bin:/bin'),
+        'DIGSIGSERVER_KEYFILE_URI': 'file://' + keydir,
+        'DIGSIGSERVER_L4T_TOOLS_BASE': l4t_base,
+        'DIGSIGSERVER_L4T_TOOLS_CACHE_DIR': os.path.join(basedir, 'l4t-cache'),
+        'DIGSIGSERVER_IMX_CST_BASE': cst_base,
+        'DIGSIGSERVER_RK_TOOLS_PATH': rk_tools,
+        'DIGSIGSERVER_KMODSIGN_SIGN_FILE': os.path.join(bindir, 'sign-file'),
+        'DIGSIGSERVER_JOB_STORE_DIR': os.path.join(basedir, 'jobs'),
+        'DIGSIGSERVER_WORKDIR_BASE': os.path.join(basedir, 'work'),
+    }
+
+
+def _tarball(files: dict) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz', compresslevel=1) as tf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _payload(size: int) -> bytes:
+    # Half random, half zeros, so that compression has something to do
+    # without being trivial
+    return os.urandom(size // 2) + bytes(size - size // 2)
+
+
+def _mender_artifact(size: int) -> bytes:
+    version = json.dumps({'format': 'mender', 'version': 3}).encode('utf-8')
+    header = gzip.compress(b'{}')
+    payload = _payload(size)
+    data = _tarball({'rootfs.img': payload})
+    manifest = ''.join('{}  {}\n'.format(hashlib.sha256(content).hexdigest(), name)
+                       for name, content in sorted([('version', version), ('header.tar.gz', header),
+                                                    ('data/0000/rootfs.img', payload)])).encode('utf-8')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.USTAR_FORMAT) as tf:
+        for name, content in [('version', version), ('manifest', manifest),
+                              ('header.tar.gz', header), ('data/0000.tar.gz', data)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+class Scenario:
+    # A signing request to be sent repeatedly: the endpoint, the form
+    # fields, and the uploaded files as (filename, content type, data).
+    # If set, prepare(n) is called before each request, returning any
+    # per-request fields, and cleanup(n) afterwards.
+    def __init__(self, name: str, endpoint: str, fields: dict, files: dict, prepare=None, cleanup=None):
+        self.name = name
+        self.endpoint = endpoint
+        self.fields = fields
+        self.files = files
+        self.prepare = prepare
+        self.cleanup = cleanup
+
+
+def _mender_scenario(basedir: str, size: int) -> Scenario:
+    template = os.path.join(basedir, 'artifacts', 'unsigned-{}.mender'.format(size))
+    with open(template, 'wb') as f:
+        f.write(_mender_artifact(size))
+
+    def artifact_path(n: int) -> str:
+        return os.path.join(basedir, 'artifacts', 'request-{}.mender'.format(n))
+
+    def prepare(n: int) -> dict:
+        shutil.copyfile(template, artifact_path(n))
+        return {'artifact-uri': 'file://' + artifact_path(n)}
+
+    def cleanup(n: int):
+        os.unlink(artifact_path(n))
+
+    return Scenario('mender', '/sign/mender', {'distro': MACHINE}, {}, prepare, cleanup)
+
+
+def build_scenarios(basedir: str, size: int) -> list:
+    payload = _payload(size)
+    octets = 'application/octet-stream'
+    manifest = 'DTBFILE=board.dtb\nLNXFILE=boot.img\nODMDATA=gbe-uphy-config-22\n'
+    tegra_files = {'flash.xml.in': b'<partition_layout/>\n', 'board.dtb': bytes(4096), 'boot.img': payload}
+    modules = {'kernel/drivers/mod{}.ko'.format(i): payload[i::8] for i in range(8)}
+    return [
+        Scenario('tegra', '/sign/tegra',
+                 {'machine': MACHINE, 'soctype': TEGRA_SOCTYPE, 'bspversion': TEGRA_BSPVERSION},
+                 {'artifact': ('artifact.tar.gz', octets,
+                               _tarball(dict(tegra_files, MANIFEST=manifest.encode('utf-8'))))}),
+        Scenario('tegra-bup', '/sign/tegra',
+                 {'machine': MACHINE, 'soctype': TEGRA_SOCTYPE, 'bspversion': TEGRA_BSPVERSION},
+                 {'artifact': ('artifact.tar.gz', octets,
+                               _tarball(dict(tegra_files, MANIFEST=(
+                                   manifest + 'BUPGENSPECS=boardid=3701;fab=300 boardid=3767;fab=000\n'
+                               ).encode('utf-8'))))}),
+        Scenario('rk', '/sign/rk', {'machine': MACHINE, 'soctype': 'rk3588', 'artifact_type': 'idblock'},
+                 {'artifact': ('idblock.img', octets, payload)}),
+        Scenario('imx', '/sign/imx',
+                 {'machine': MACHINE, 'soctype': 'mx8m', 'cstversion': CST_VERSION},
+                 {'csf': ('csf-input.txt', 'text/plain', b'[Header]\nVersion = 4.3\n'),
+                  'artifact': ('flash.bin', octets, payload)}),
+        Scenario('fitimage', '/sign/fitimage', {'machine': MACHINE},
+                 {'artifact': ('fitImage', octets, payload)}),
+        Scenario('modules', '/sign/modules', {'machine': MACHINE},
+                 {'artifact': ('modules.tar.gz', octets, _tarball(modules))}),
+        Scenario('optee', '/sign/optee', {'machine': MACHINE},
+                 {'artifact': ('tas.tar.gz', octets, _tarball({
+                     '8aaaf200-2450-11e4-abe2-0002a5d5c51b.stripped.elf': payload,
+                     '8aaaf200-2450-11e4-abe2-0002a5d5c51b.ta-version': b'1\n'}))}),
+        Scenario('uefi', '/sign/tegra/uefi', {'machine': MACHINE, 'signing_type': 'signature'},
+                 {'artifact': ('artifact', octets, payload)}),
+        Scenario('swupdate', '/sign/swupdate', {'distro': MACHINE},
+                 {'sw-description': ('sw-description', octets, b'software = { version = "1.0"; };\n')}),
+        _mender_scenario(basedir, size),
+    ]
@@ -0,0 +1,295 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from digsigserver.benchmark import fixtures
+
+
+def _size(value: str) -> int:
+    units = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+    if value and value[-1].lower() in units:
+        return int(float(value[:-1]) * units[value[-1].lower()])
+    return int(value)
+
+
+def _list(convert):
+    def parse(value: str) -> list:
+        return [convert(v) for v in value.split(',') if v]
+    return parse
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _multipart(fields: dict, files: dict) -> tuple[str, bytes]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            boundary, name, value).encode('utf-8'))
+    for name, (filename, content_type, data) in files.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: {}\r\n\r\n'.format(boundary, name, filename, content_type).encode('utf-8'))
+        parts.append(data)
+        parts.append(b'\r\n')
+    parts.append('--{}--\r\n'.format(boundary).encode('utf-8'))
+    return 'multipart/form-data; boundary={}'.format(boundary), b''.join(parts)
+
+
+def _percentile(values: list, pct: float) -> float:
+    # nearest-rank
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+def _memory(pid: int) -> dict:
+    # Current and peak resident set size of the server process, in KiB
+    result = {}
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ['VmRSS', 'VmHWM']:
+                    result[key] = int(value.split()[0])
+    except FileNotFoundError:
+        pass
+    return result
+
+
+class BenchmarkServer:
+    # The digsigserver instance under test, run as a child process
+    def __init__(self, basedir: str, env: dict, loglevel: str):
+        self.port = _free_port()
+        self.logfile = os.path.join(basedir, 'server.log')
+        self.env = dict(os.environ, **env)
+        self.env['DIGSIGSERVER_LOG_LEVEL'] = loglevel
+        self.proc = None
+
+    def start(self, timeout: float = 30.0):
+        with open(self.logfile, 'wb') as log:
+            self.proc = subprocess.Popen([sys.executable, '-m', 'digsigserver.benchmark.server',
+                                          '--port', str(self.port)],
+                                         env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError('server exited with status {}, see {}'.format(self.proc.returncode, self.logfile))
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=1)
+                conn.request('GET', '/status/queues')
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return
+                conn.close()
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError('server did not start within {} seconds, see {}'.format(timeout, self.logfile))
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+    def memory(self) -> dict:
+        return _memory(self.proc.pid)
+
+
+class Client:
+    # Sends requests for a scenario, one keep-alive connection per thread
+    def __init__(self, port: int, timeout: float):
+        self.port = port
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def send(self, scenario: fixtures.Scenario, n: int, body: Optional[tuple] = None) -> tuple[float, int, str]:
+        fields = dict(scenario.fields)
+        if scenario.prepare:
+            fields.update(scenario.prepare(n))
+            body = None
+        content_type, data = body or _multipart(fields, scenario.files)
+        start = time.monotonic()
+        try:
+            conn = self._connection()
+            try:
+                conn.request('POST', scenario.endpoint, body=data, headers={'Content-Type': content_type})
+                resp = conn.getresponse()
+                payload = resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                self.local.conn = None
+                raise
+            elapsed = time.monotonic() - start
+            detail = '' if resp.status == 200 else payload[:200].decode('utf-8', errors='replace')
+            return elapsed, resp.status, detail
+        except (OSError, http.client.HTTPException) as e:
+            return time.monotonic() - start, 0, str(e)
+        finally:
+            if scenario.cleanup:
+                try:
+                    scenario.cleanup(n)
+                except FileNotFoundError:
+                    pass
+
+
+def run_scenario(client: Client, server: BenchmarkServer, scenario: fixtures.Scenario,
+                 size: int, concurrency: int, requests: int) -> dict:
+    body = None if scenario.prepare else _multipart(scenario.fields, scenario.files)
+    result = {'scenario': scenario.name, 'endpoint': scenario.endpoint, 'size': size,
+              'concurrency': concurrency, 'requests': requests}
+    _, status, detail = client.send(scenario, 0, body)
+    if status != 200:
+        result['error'] = 'warmup request failed with status {}: {}'.format(status, detail.strip())
+        return result
+
+    peak_rss = [0]
+    done = threading.Event()
+
+    def sample_memory():
+        while not done.wait(0.05):
+            peak_rss[0] = max(peak_rss[0], server.memory().get('VmRSS', 0))
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(lambda n: client.send(scenario, n, body), range(1, requests + 1)))
+    elapsed = time.monotonic() - start
+    done.set()
+    sampler.join()
+
+    latencies = [latency for latency, status, _ in outcomes if status == 200]
+    errors = {}
+    for _, status, _ in outcomes:
+        if status != 200:
+            errors[status] = errors.get(status, 0) + 1
+    memory = server.memory()
+    result.update(ok=len(latencies), errors=errors, elapsed=round(elapsed, 3),
+                  throughput=round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+                  p50=round(_percentile(latencies, 50), 4), p99=round(_percentile(latencies, 99), 4),
+                  max=round(max(latencies), 4) if latencies else 0.0,
+                  rss_kib=max(peak_rss[0], memory.get('VmRSS', 0)), hwm_kib=memory.get('VmHWM', 0))
+    return result
+
+
+def _format_size(size: int) -> str:
+    for unit, scale in [('G', 1 << 30), ('M', 1 << 20), ('K', 1 << 10)]:
+        if size >= scale and size % scale == 0:
+            return '{}{}'.format(size // scale, unit)
+    return str(size)
+
+
+def print_table(results: list, out=sys.stdout):
+    header = '{:<10} {:>6} {:>5} {:>6} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+        'scenario', 'size', 'conc', 'ok', 'errors', 'req/s', 'p50(ms)', 'p99(ms)', 'max(ms)', 'rss(MiB)')
+    print(header, file=out)
+    print('-' * len(header), file=out)
+    for r in results:
+        if 'error' in r:
+            print('{:<10} {:>6} {:>5}  {}'.format(r['scenario'], _format_size(r['size']), r['concurrency'],
+                                                  r['error']), file=out)
+            continue
+        errors = sum(r['errors'].values())
+        print('{:<10} {:>6} {:>5} {:>6} {:>7} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f}'.format(
+            r['scenario'], _format_size(r['size']), r['concurrency'], r['ok'], errors, r['throughput'],
+            r['p50'] * 1000, r['p99'] * 1000, r['max'] * 1000, r['rss_kib'] / 1024), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m digsigserver.benchmark',
+                                     description='Load test digsigserver signing endpoints using stand-in '
+                                                 'signing tools with configurable latency')
+    parser.add_argument('-c', '--concurrency', type=_list(int), default=[1, 4],
+                        help='comma-separated list of client concurrency levels (default: 1,4)')
+    parser.add_argument('-s', '--size', type=_list(_size), default=[_size('64k'), _size('4m')],
+                        help='comma-separated list of payload sizes, with optional k/m/g suffix (default: 64k,4m)')
+    parser.add_argument('-n', '--requests', type=int, default=20,
+                        help='number of requests per scenario, size and concurrency level (default: 20)')
+    parser.add_argument('-l', '--tool-latency', type=float, default=0.05,
+                        help='seconds each stand-in signing tool takes to run (default: 0.05)')
+    parser.add_argument('--scenarios', type=_list(str),
+                        help='comma-separated list of scenarios to run (default: all)')
+    parser.add_argument('--tool-backends', action='store_true',
+                        help='use the external-tool backends for kernel module and swupdate signing')
+    parser.add_argument('-e', '--server-env', action='append', default=[], metavar='NAME=VALUE',
+                        help='additional server configuration setting (repeatable), with or without '
+                             'the DIGSIGSERVER_ prefix')
+    parser.add_argument('--log-level', default='WARNING', help='server log level (default: WARNING)')
+    parser.add_argument('--timeout', type=float, default=600.0, help='per-request timeout in seconds')
+    parser.add_argument('--workdir', help='directory for keys, tools and logs (default: a temporary directory, '
+                                          'removed afterwards)')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON to FILE ("-" for stdout)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='digsigserver-bench-') as tmpdir:
+        basedir = args.workdir or tmpdir
+        os.makedirs(basedir, exist_ok=True)
+        env = fixtures.setup_environment(basedir, args.tool_latency)
+        if args.tool_backends:
+            env.update(DIGSIGSERVER_KMODSIGN_BACKEND='sign-file', DIGSIGSERVER_SWUPDATE_SSL_BACKEND='openssl')
+        for setting in args.server_env:
+            name, sep, value = setting.partition('=')
+            if not sep:
+                parser.error('invalid server setting: {}'.format(setting))
+            env[name if name.startswith('DIGSIGSERVER_') else 'DIGSIGSERVER_' + name] = value
+        server = BenchmarkServer(basedir, env, args.log_level)
+        server.start()
+        results = []
+        try:
+            client = Client(server.port, args.timeout)
+            idle = server.memory()
+            print('server pid {}, idle RSS {:.1f} MiB, tool latency {}s'.format(
+                server.proc.pid, idle.get('VmRSS', 0) / 1024, args.tool_latency), file=sys.stderr)
+            for size in args.size:
+                scenarios = fixtures.build_scenarios(basedir, size)
+                if args.scenarios:
+                    unknown = set(args.scenarios) - set(s.name for s in scenarios)
+                    if unknown:
+                        parser.error('unknown scenario(s): {}'.format(', '.join(sorted(unknown))))
+                    scenarios = [s for s in scenarios if s.name in args.scenarios]
+                for scenario in scenarios:
+                    for concurrency in args.concurrency:
+                        result = run_scenario(client, server, scenario, size, concurrency, args.requests)
+                        results.append(result)
+                        print('{} size={} concurrency={}: {}'.format(
+                            scenario.name, _format_size(size), concurrency,
+                            result.get('error') or '{} ok, {:.2f} req/s'.format(result['ok'], result['throughput'])),
+                            file=sys.stderr)
+        finally:
+            server.stop()
+        print_table(results)
+        print('server log: {}'.format(server.logfile if args.workdir else '(removed)'), file=sys.stderr)
+        if args.json:
+            output = json.dumps({'tool_latency': args.tool_latency, 'results': results}, indent=2)
+            if args.json == '-':
+                print(output)
+            else:
+                with open(args.json, 'w') as f:
+                    f.write(output + '\n')
@@ -0,0 +1,22 @@
+import argparse
+from sanic import Sanic
+from sanic.worker.loader import AppLoader
+from digsigserver.server import create_app
+
+
+# Runs the server in a single process, so the benchmark can
+# track its memory usage by PID.  Configuration comes from the
+# DIGSIGSERVER_* environment variables set up by the runner.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--address', help='address to host on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='port to host on', type=int, required=True)
+    args = parser.parse_args()
+    loader = AppLoader(factory=create_app)
+    app = loader.load()
+    app.prepare(host=args.address, port=args.port, single_process=True, access_log=False, motd=False)
+    Sanic.serve_single(primary=app)
+
+
+if __name__ == '__main__':
+    main()
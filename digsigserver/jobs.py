@@ -0,0 +1,146 @@
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from typing import Callable, Optional
+
+from sanic.log import logger
+
+from digsigserver.utils import process_exists
+
+
+class Job:
+    def __init__(self, job_id: str, operation: str, jobdir: str):
+        self.id = job_id
+        self.operation = operation
+        self.jobdir = jobdir
+        # the worker process running the job
+        self.pid = os.getpid()
+        self.state = 'queued'
+        self.created = time.time()
+        self.updated = self.created
+        self.status_code = None
+        self.message = None
+        self.filename = None
+        # resource usage of the tools run for the job, by tool
+        self.usage = {}
+
+    @property
+    def workdir(self) -> str:
+        return os.path.join(self.jobdir, 'work')
+
+    @property
+    def result_path(self) -> str:
+        return os.path.join(self.jobdir, 'result')
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ['done', 'failed']
+
+    def set_state(self, state: str, status_code: Optional[int] = None, message: Optional[str] = None,
+                  filename: Optional[str] = None):
+        self.state = state
+        self.status_code = status_code
+        self.message = message
+        self.filename = filename
+        self.updated = time.time()
+
+    def to_dict(self) -> dict:
+        return {'id': self.id,
+                'operation': self.operation,
+                'status': self.state,
+                'created': self.created,
+                'updated': self.updated,
+                'status_code': self.status_code,
+                'message': self.message,
+                'filename': self.filename}
+
+    @classmethod
+    def from_dict(cls, jobdir: str, d: dict) -> 'Job':
+        job = cls(d['id'], d['operation'], jobdir)
+        job.state = d['status']
+        job.created = d['created']
+        job.updated = d['updated']
+        job.status_code = d['status_code']
+        job.message = d['message']
+        job.filename = d['filename']
+        job.pid = d.get('pid')
+        job.usage = d.get('usage', {})
+        return job
+
+
+# Keeps track of signing jobs submitted through the job API.
+# Each job has a directory under the store directory holding
+# its state (job.json), its working directory while it runs,
+# and its result once it has finished.  Finished jobs are
+# removed once they are older than the configured TTL, using
+# the remove function if one is provided.  Unfinished jobs whose
+# worker process has gone away are marked as failed first.
+class JobManager:
+    def __init__(self, store_dir: str, ttl: float, remove: Optional[Callable] = None):
+        self.store_dir = store_dir
+        self.ttl = ttl
+        self.remove = remove or (lambda path: shutil.rmtree(path, ignore_errors=True))
+        self.jobs = {}
+        os.makedirs(store_dir, exist_ok=True)
+
+    def create(self, operation: str) -> Job:
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, operation, os.path.join(self.store_dir, job_id))
+        os.makedirs(job.workdir)
+        self.jobs[job_id] = job
+        self.save(job)
+        return job
+
+    def save(self, job: Job):
+        path = os.path.join(job.jobdir, 'job.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(job.to_dict(), pid=job.pid, usage=job.usage), f)
+        os.replace(path + '.tmp', path)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        if not re.match(r'[0-9a-f]{32}$', job_id):
+            return None
+        job = self.jobs.get(job_id)
+        if job:
+            return job
+        # May have been submitted to another worker process
+        jobdir = os.path.join(self.store_dir, job_id)
+        try:
+            with open(os.path.join(jobdir, 'job.json'), 'r') as f:
+                return Job.from_dict(jobdir, json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def discard(self, job: Job):
+        self.jobs.pop(job.id, None)
+        self.remove(job.jobdir)
+
+    def abandoned(self, job: Job) -> bool:
+        if job.finished or job.id in self.jobs:
+            return False
+        return job.pid is None or (job.pid != os.getpid() and not process_exists(job.pid))
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in os.listdir(self.store_dir):
+            job = self.get(job_id)
+            if job is None:
+                # never got as far as saving its state
+                path = os.path.join(self.store_dir, job_id)
+                try:
+                    if os.path.isdir(path) and os.stat(path).st_mtime < cutoff:
+                        self.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if self.abandoned(job):
+                logger.warning("Job {} ({}) abandoned by worker process {}".format(job_id, job.operation, job.pid))
+                job.set_state('failed', 500, "Job interrupted")
+                self.save(job)
+                self.remove(job.workdir)
+            elif job.finished and job.updated < cutoff:
+                logger.info("Expiring job {}".format(job_id))
+                self.discard(job)
@@ -0,0 +1,92 @@
+import ctypes
+import ctypes.util
+import mmap
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sanic.log import logger
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_mlock_warned = False
+
+
+# Holds a copy of a key file in anonymous memory that is locked
+# into RAM (where RLIMIT_MEMLOCK permits) and excluded from core
+# dumps.  The memory is zeroed when the buffer is released.
+class _LockedBuffer:
+    def __init__(self, data: bytes):
+        global _mlock_warned
+        self.size = len(data)
+        self._map = mmap.mmap(-1, max(self.size, 1))
+        if hasattr(mmap, 'MADV_DONTDUMP'):
+            self._map.madvise(mmap.MADV_DONTDUMP)
+        buf = ctypes.c_char.from_buffer(self._map)
+        self._addr = ctypes.addressof(buf)
+        del buf
+        self.locked = _libc.mlock(ctypes.c_void_p(self._addr), ctypes.c_size_t(len(self._map))) == 0
+        if not self.locked and not _mlock_warned:
+            logger.warning('could not lock key cache memory: {}'.format(ctypes.get_errno()))
+            _mlock_warned = True
+        self._map.write(data)
+
+    def read(self) -> bytes:
+        return self._map[:self.size]
+
+    def release(self):
+        self._map.seek(0)
+        self._map.write(bytes(len(self._map)))
+        if self.locked:
+            _libc.munlock(ctypes.c_void_p(self._addr), ctypes.c_size_t(len(self._map)))
+        self._map.close()
+
+
+# LRU cache of key file contents, with a time-to-live and a bound
+# on the total number of bytes held.  Entries with no data record
+# that a key file does not exist.
+class KeyCache:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _drop(self, key: tuple):
+        expires, buf = self._entries.pop(key)
+        if buf:
+            self.size -= buf.size
+            buf.release()
+
+    def get(self, key: tuple) -> tuple[bool, Optional[bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires, buf = entry
+            if expires < time.monotonic():
+                self._drop(key)
+                return False, None
+            self._entries.move_to_end(key)
+            return True, buf.read() if buf else None
+
+    def put(self, key: tuple, data: Optional[bytes]):
+        if data is not None and len(data) > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            buf = _LockedBuffer(data) if data is not None else None
+            self._entries[key] = (time.monotonic() + self.ttl, buf)
+            if buf:
+                self.size += buf.size
+            while self.size > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def flush(self) -> int:
+        with self._lock:
+            count = len(self._entries)
+            for key in list(self._entries):
+                self._drop(key)
+            return count
@@ -1,10 +1,17 @@
 import tempfile
+import time
 import os
 
 from sanic import Sanic
+from . import keyobjects
+from . import metrics
 from . import utils
 
 
+def keyset_uri(app: Sanic, signtype: str, machine_or_distro: str) -> str:
+    return '{}/{}/{}/'.format(app.config.get('KEYFILE_URI'), machine_or_distro, signtype)
+
+
 class KeyFiles:
     signing_types = [
         'tegrasign',
@@ -24,26 +31,63 @@ class KeyFiles:
     def __init__(self, app: Sanic, signtype: str, machine_or_distro: str):
         if signtype not in self.signing_types:
             raise RuntimeError('unrecognized signing type: {}'.format(signtype))
-        self.keyfileuri = '{}/{}/{}/'.format(app.config.get('KEYFILE_URI'),
-                                             machine_or_distro, signtype)
+        self.keyfileuri = keyset_uri(app, signtype, machine_or_distro)
         self.tmpdir = None
-        if not utils.uri_exists(self.keyfileuri, is_dir=True):
+        self.cache = getattr(app.ctx, 'keycache', None)
+        self.cache_key = (app.config.get('KEYFILE_URI'), machine_or_distro, signtype)
+        self.operation = metrics.current_operation()
+        if not self._keydir_exists():
             raise RuntimeError('no key files found for {}/{}'.format(signtype, machine_or_distro))
 
+    def _keydir_exists(self) -> bool:
+        if self.cache:
+            found, _ = self.cache.get(self.cache_key + (None,))
+            if found:
+                return True
+        if not utils.uri_exists(self.keyfileuri, is_dir=True):
+            return False
+        if self.cache:
+            self.cache.put(self.cache_key + (None,), b'')
+        return True
+
+    def _fetch(self, keyname: str, path: str):
+        if self.cache:
+            found, data = self.cache.get(self.cache_key + (keyname,))
+            if found:
+                if data is not None:
+                    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+                        f.write(data)
+                return
+        try:
+            utils.uri_fetch(os.path.join(self.keyfileuri, keyname), path)
+        except (RuntimeError, FileNotFoundError):
+            pass
+        if self.cache:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    self.cache.put(self.cache_key + (keyname,), f.read())
+            else:
+                self.cache.put(self.cache_key + (keyname,), None)
+
     def get(self, keyname: str) -> str:
         if not self.tmpdir:
             self.tmpdir = tempfile.TemporaryDirectory()
         path = os.path.join(self.tmpdir.name, keyname)
         if os.path.exists(path):
             return path
-        try:
-            utils.uri_fetch(os.path.join(self.keyfileuri, keyname), path)
-        except RuntimeError:
-            pass
+        start = time.monotonic()
+        self._fetch(keyname, path)
+        metrics.observe_phase('keyfetch', time.monotonic() - start, self.operation)
         if os.path.exists(path):
             return path
         raise FileNotFoundError('No key file named {}'.format(keyname))
 
+    def private_key(self, keyname: str):
+        return keyobjects.load_private_key(self.get(keyname), self.keyfileuri + keyname)
+
+    def certificates(self, keyname: str) -> list:
+        return keyobjects.load_certificates(self.get(keyname), self.keyfileuri + keyname)
+
     def cleanup(self):
         if self.tmpdir:
             try:
@@ -0,0 +1,103 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
+_PEM_CERTIFICATE = re.compile(rb'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', re.DOTALL)
+
+_lock = threading.Lock()
+_config = {'ttl': 0.0, 'max_entries': 32}
+_objects = OrderedDict()
+_origins = {}
+
+
+def configure(ttl: float, max_entries: int):
+    with _lock:
+        _config.update(ttl=ttl, max_entries=max_entries)
+        _objects.clear()
+        _origins.clear()
+
+
+def enabled() -> bool:
+    return _config['ttl'] > 0 and _config['max_entries'] > 0
+
+
+def flush() -> int:
+    with _lock:
+        count = len(_objects)
+        _objects.clear()
+        _origins.clear()
+        return count
+
+
+def _drop(cache_key: tuple):
+    _objects.pop(cache_key, None)
+    for origin in [origin for origin, key in _origins.items() if key == cache_key]:
+        del _origins[origin]
+
+
+# Parsed key and certificate objects are cached by a hash of the
+# file contents, so the (relatively expensive) parsing and key
+# validation only happens the first time a given key is used.
+# Entries expire after a time-to-live, and the least-recently-used
+# ones are evicted beyond a maximum number of entries.  When the
+# origin (the key file's location under KEYFILE_URI) is known, an
+# object parsed from different contents at the same origin is
+# dropped as soon as the change is seen.
+def _load(kind: str, path: str, loader, origin: Optional[str] = None):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not enabled():
+        return loader(data)
+    cache_key = (kind, hashlib.sha256(data).hexdigest())
+    now = time.monotonic()
+    with _lock:
+        if origin is not None:
+            previous = _origins.get((kind, origin))
+            if previous is not None and previous != cache_key:
+                _drop(previous)
+            _origins[(kind, origin)] = cache_key
+        entry = _objects.get(cache_key)
+        if entry is not None:
+            expires, obj = entry
+            if expires >= now:
+                _objects.move_to_end(cache_key)
+                return obj
+            del _objects[cache_key]
+    obj = loader(data)
+    with _lock:
+        _objects[cache_key] = (now + _config['ttl'], obj)
+        _objects.move_to_end(cache_key)
+        while len(_objects) > _config['max_entries']:
+            _drop(next(iter(_objects)))
+    return obj
+
+
+def _parse_private_key(data: bytes):
+    try:
+        return serialization.load_pem_private_key(data, password=None)
+    except ValueError:
+        return serialization.load_der_private_key(data, password=None)
+
+
+def _parse_certificates(data: bytes) -> list:
+    # A PEM file may hold a chain of certificates.  The blocks are split
+    # out here, rather than with load_pem_x509_certificates(), which
+    # needs a newer cryptography than we otherwise require.
+    blocks = _PEM_CERTIFICATE.findall(data)
+    if blocks:
+        return [x509.load_pem_x509_certificate(block) for block in blocks]
+    return [x509.load_der_x509_certificate(data)]
+
+
+def load_private_key(path: str, origin: Optional[str] = None):
+    return _load('private-key', path, _parse_private_key, origin)
+
+
+def load_certificates(path: str, origin: Optional[str] = None) -> list:
+    return _load('certificates', path, _parse_certificates, origin)
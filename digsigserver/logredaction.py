@@ -1,31 +1,72 @@
 import logging
-from typing import Any
+import re
+from typing import Any, Callable, Optional
+
+REDACTED = '<redacted>'
+
+# PKCS#11 URIs (for HSM-backed keys) carry the PIN as a pin-value
+# attribute once the placeholder has been filled in, so those are
+# redacted even if the PIN is not one of the known secrets.
+_PIN_VALUE = 'pin-value='
+_PIN_VALUE_PATTERN = r'(pin-value=)[^\s;&?\'",\])]+'
+_REPLACEMENT = r'\g<1>' + REDACTED
+
+# Argument types whose string form cannot contain a secret
+_SAFE_TYPES = (int, float, type(None))
+
+
+# Stands in for a record's message and arguments, formatting and
+# redacting them only when (and if) a handler asks for the message.
+class _RedactedMessage:
+    __slots__ = ('msg', 'args', 'redact', 'text')
+
+    def __init__(self, msg: Any, args: Any, redact: Callable[[str], str]) -> None:
+        self.msg = msg
+        self.args = args
+        self.redact = redact
+        self.text: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.text is None:
+            text = str(self.msg)
+            if self.args:
+                text = text % self.args
+            self.text = self.redact(text)
+        return self.text
 
 
 class SecretRedactionFilter(logging.Filter):
     def __init__(self) -> None:
         super().__init__()
-        self._secrets: list[str] = []
+        self.set_secrets([])
 
     def set_secrets(self, secrets: list[str]) -> None:
         self._secrets = [secret for secret in secrets if secret]
+        # All the secrets are matched in one pass, longest first, so a
+        # secret containing another is redacted whole.  Substring checks
+        # for the literal parts are much cheaper than a regex search, so
+        # they are used to skip the (common) text with nothing to redact.
+        alternatives = [re.escape(secret) for secret in sorted(self._secrets, key=len, reverse=True)]
+        self._pattern = re.compile('|'.join([_PIN_VALUE_PATTERN] + alternatives))
+        self._needles = tuple(self._secrets) + (_PIN_VALUE,)
 
-    def _redact(self, value: Any) -> Any:
-        if isinstance(value, str):
-            for secret in self._secrets:
-                value = value.replace(secret, '<redacted>')
-            return value
-        if isinstance(value, tuple):
-            return tuple(self._redact(item) for item in value)
-        if isinstance(value, list):
-            return [self._redact(item) for item in value]
-        if isinstance(value, dict):
-            return {key: self._redact(item) for key, item in value.items()}
-        return value
+    def redact(self, text: str) -> str:
+        for needle in self._needles:
+            if needle in text:
+                return self._pattern.sub(_REPLACEMENT, text)
+        return text
 
     def filter(self, record: logging.LogRecord) -> bool:
-        record.msg = self._redact(record.msg)
-        record.args = self._redact(record.args)
+        msg, args = record.msg, record.args
+        if isinstance(msg, str) and (not args or (isinstance(args, tuple) and
+                                                  all(isinstance(arg, _SAFE_TYPES) for arg in args))):
+            # Only the message itself can contain a secret, and checking
+            # it costs no more than deferring the check would.
+            if msg:
+                record.msg = self.redact(msg)
+        elif not isinstance(msg, _RedactedMessage):
+            record.msg = _RedactedMessage(msg, args, self.redact)
+            record.args = None
         if hasattr(record, 'exc_text'):
             record.exc_text = None
         return True
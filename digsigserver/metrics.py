@@ -0,0 +1,162 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# Name of the signing operation being handled, used to label
+# the phase metrics recorded while handling it.  Anything recorded
+# outside of a signing operation is labeled with UNATTRIBUTED
+# instead of an empty name.
+UNATTRIBUTED = 'unattributed'
+_operation = contextvars.ContextVar('digsigserver_operation', default='')
+
+
+def current_operation() -> str:
+    return _operation.get()
+
+
+def set_operation(name: str):
+    return _operation.set(name)
+
+
+def reset_operation(token):
+    _operation.reset(token)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: Optional[str] = None) -> str:
+    items = ['{}="{}"'.format(name, _escape(str(value))) for name, value in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    @staticmethod
+    def _key(labelvalues: tuple) -> tuple:
+        return tuple(value if value else UNATTRIBUTED for value in labelvalues)
+
+    def _header(self) -> list:
+        return ['# HELP {} {}'.format(self.name, self.description),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1):
+        labelvalues = self._key(labelvalues)
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + ['{}{} {}'.format(self.name, _labels(self.labelnames, labelvalues), _number(value))
+                                 for labelvalues, value in values]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+
+    def observe(self, *labelvalues, value: float):
+        labelvalues = self._key(labelvalues)
+        with self._lock:
+            counts, total = self._values.get(labelvalues, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[labelvalues] = (counts, total + value)
+
+    def collect(self) -> list:
+        with self._lock:
+            values = sorted((labelvalues, (list(counts), total))
+                            for labelvalues, (counts, total) in self._values.items())
+        lines = self._header()
+        for labelvalues, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _number(bound)
+                lines.append('{}_bucket{} {}'.format(self.name,
+                                                     _labels(self.labelnames, labelvalues, 'le="{}"'.format(le)),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, labelvalues), _number(total)))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, labelvalues), cumulative))
+        return lines
+
+
+def gauge(name: str, description: str, labelnames: tuple, samples: dict) -> list:
+    # Gauges are computed when the metrics are collected, from
+    # a dict of label values -> current value
+    return ['# HELP {} {}'.format(name, description),
+            '# TYPE {} gauge'.format(name)] + ['{}{} {}'.format(name, _labels(labelnames, labelvalues), _number(value))
+                                              for labelvalues, value in sorted(samples.items())]
+
+
+_registry = []
+
+requests_total = Counter('digsigserver_requests_total',
+                         'Signing requests received.', ('endpoint',))
+request_errors_total = Counter('digsigserver_request_errors_total',
+                               'Signing requests that failed with a server error.', ('endpoint',))
+request_duration = Histogram('digsigserver_request_duration_seconds',
+                             'Time taken to handle signing requests.', ('endpoint',))
+phase_duration = Histogram('digsigserver_phase_duration_seconds',
+                           'Time spent in each phase of handling a signing operation.', ('operation', 'phase'))
+tool_duration = Histogram('digsigserver_tool_duration_seconds',
+                          'Run time of the signing tools.', ('operation', 'tool'))
+jobs_finished_total = Counter('digsigserver_jobs_finished_total',
+                              'Signing jobs that have finished.', ('operation', 'state'))
+signing_cancelled_total = Counter('digsigserver_signing_cancelled_total',
+                                  'Signing operations abandoned before they finished, because the '
+                                  'request was cancelled.', ('operation',))
+tools_killed_total = Counter('digsigserver_tools_killed_total',
+                             'Signing tools killed before they finished, because the signing operation '
+                             'was cancelled or timed out.', ('operation', 'reason'))
+result_cache_total = Counter('digsigserver_result_cache_lookups_total',
+                             'Result cache lookups, by whether the result was found, joined while in progress, '
+                             'or missed.', ('operation', 'result'))
+
+
+def observe_phase(phase: str, seconds: float, operation: Optional[str] = None):
+    phase_duration.observe(operation if operation is not None else current_operation(), phase, value=seconds)
+
+
+@contextmanager
+def timer(phase: str, operation: Optional[str] = None):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time.monotonic() - start, operation)
+
+
+def collect() -> list:
+    lines = []
+    for metric in _registry:
+        lines += metric.collect()
+    return lines
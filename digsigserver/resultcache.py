@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from sanic.log import logger
+
+
+# On-disk store of signing results, keyed by a hash of everything
+# that goes into producing them (see key()).  Each entry is a JSON
+# metadata file, plus a data file for results that are files
+# rather than just a message.  Entries expire after a time-to-live,
+# and the least-recently-used ones are evicted to keep the total
+# size under a maximum.  Writes are done by renaming into place, so
+# several worker processes can share the same directory.
+#
+# Requests for a result that is still being produced can wait for
+# it, rather than starting the same signing operation again; that
+# tracking is per-process.
+class ResultCache:
+    def __init__(self, directory: str, max_size: int, ttl: float, salt: str = ''):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.salt = salt
+        self.inflight = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def key(self, parts: dict) -> str:
+        return hashlib.sha256(json.dumps(dict(parts, salt=self.salt), sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.directory, key[:2], key)
+        return base + '.json', base + '.data'
+
+    def _remove(self, key: str):
+        for path in self._paths(key):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def lookup(self, key: str) -> Optional[dict]:
+        metapath, datapath = self._paths(key)
+        try:
+            with open(metapath, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('created', 0) + self.ttl < time.time():
+            self._remove(key)
+            return None
+        if entry.get('message') is None:
+            # The data file is opened here, so the result can still be
+            # read if the entry is evicted before it has been sent.
+            try:
+                entry['file'] = open(datapath, 'rb')
+            except FileNotFoundError:
+                return None
+            entry['path'] = datapath
+        # the metadata file's mtime tracks when the entry was last used
+        try:
+            os.utime(metapath)
+        except FileNotFoundError:
+            if entry.get('file'):
+                entry['file'].close()
+            return None
+        return entry
+
+    def store(self, key: str, filename: str, path: Optional[str] = None, message: Optional[str] = None,
+              move: bool = False) -> Optional[dict]:
+        # Stores a result, either a message or the file at path, which is
+        # moved into the cache if move is set, or hard-linked (or copied)
+        # otherwise.  Returns the new entry, or None if it could not be stored.
+        metapath, datapath = self._paths(key)
+        os.makedirs(os.path.dirname(metapath), mode=0o700, exist_ok=True)
+        entry = {'filename': filename, 'message': message, 'created': time.time()}
+        size = 0
+        try:
+            if message is None:
+                size = os.path.getsize(path)
+                if size > self.max_size:
+                    logger.info("result for {} too large to cache ({} bytes)".format(key, size))
+                    if move:
+                        os.unlink(path)
+                    return None
+                fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(datapath), prefix='.tmp-')
+                os.close(fd)
+                if move:
+                    os.replace(path, tmppath)
+                else:
+                    os.unlink(tmppath)
+                    try:
+                        os.link(path, tmppath)
+                    except OSError:
+                        shutil.copyfile(path, tmppath)
+                os.replace(tmppath, datapath)
+            with open(metapath + '.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.replace(metapath + '.tmp', metapath)
+            if message is None:
+                # opened before evicting, as in lookup()
+                entry['file'] = open(datapath, 'rb')
+        except OSError as e:
+            logger.warning("could not cache result for {}: {}".format(key, e))
+            self._remove(key)
+            return None
+        if message is None:
+            entry['path'] = datapath
+        self._evict()
+        return entry
+
+    def _entries(self) -> list:
+        entries = []
+        for subdir in os.listdir(self.directory):
+            subpath = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                if not name.endswith('.json'):
+                    continue
+                key = name[:-5]
+                metapath, datapath = self._paths(key)
+                try:
+                    st = os.stat(metapath)
+                    size = st.st_size + (os.path.getsize(datapath) if os.path.exists(datapath) else 0)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, key, size))
+        return sorted(entries)
+
+    def _evict(self):
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, _, size in entries)
+            cutoff = time.time() - self.ttl
+            for used, key, size in entries:
+                if total <= self.max_size and used >= cutoff:
+                    continue
+                self._remove(key)
+                total -= size
+
+    def flush(self) -> int:
+        with self._lock:
+            entries = self._entries()
+            for _, key, _ in entries:
+                self._remove(key)
+            return len(entries)
+
+    def sweep(self, max_age: float) -> int:
+        # Removes temporary files left behind by interrupted stores
+        count = 0
+        cutoff = time.time() - max_age
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if not (name.startswith('.tmp-') or name.endswith('.json.tmp')):
+                    continue
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        count += 1
+                except FileNotFoundError:
+                    pass
+        return count
+
+    def pending(self, key: str) -> Optional[asyncio.Future]:
+        return self.inflight.get(key)
+
+    def begin(self, key: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        return future
+
+    def finish(self, key: str, stored: bool):
+        # Wakes up any requests waiting for this result.  They look it
+        # up if it was stored, or run the operation themselves if not.
+        future = self.inflight.pop(key, None)
+        if future and not future.done():
+            future.set_result(stored)
@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+_reservation = contextvars.ContextVar('digsigserver_reservation', default=None)
+
+
+class QueueFullError(Exception):
+    def __init__(self, name: str, retry_after: int):
+        super().__init__('signing queue for {} is full'.format(name))
+        self.name = name
+        self.retry_after = retry_after
+
+
+class SignerQueue:
+    def __init__(self, name: str, concurrency: int, queue_depth: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name)
+        self.pending = 0
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def full(self) -> bool:
+        return self.pending >= self.concurrency + self.queue_depth
+
+    def _call(self, func: Callable, args: tuple):
+        with self._lock:
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def status(self) -> dict:
+        with self._lock:
+            running = self.running
+        return {'concurrency': self.concurrency,
+                'queue_depth': self.queue_depth,
+                'running': running,
+                'queued': max(0, self.pending - running)}
+
+
+# A place in a signer's queue, taken when a request is admitted, so
+# that requests still uploading count against the queue's limit.  The
+# signing operations run for the request use it, rather than being
+# admitted again, until it is released at the end of the request.
+class Reservation:
+    def __init__(self, queue: SignerQueue):
+        self.queue = queue
+        self.held = True
+
+    def covers(self, queue: SignerQueue) -> bool:
+        return self.held and queue is self.queue
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.queue.pending -= 1
+
+
+# Runs signing operations on a separate, bounded thread pool
+# for each signer, rejecting new work once a signer's queue
+# is full rather than letting it pile up behind slow jobs.
+# Also holds the per-signer time limits for signing operations.
+class Scheduler:
+    def __init__(self, concurrency: int, queue_depth: int, retry_after: int,
+                 limits: Optional[str] = None, timeout: float = 0, timeouts: Optional[str] = None):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+        self.default_timeout = timeout
+        self.limits = {}
+        # limits is a comma-separated list of <name>=<concurrency>[:<queue-depth>]
+        for entry in (limits or '').split(','):
+            if not entry.strip():
+                continue
+            name, _, setting = entry.partition('=')
+            concurrency, _, depth = setting.partition(':')
+            self.limits[name.strip()] = (int(concurrency), int(depth) if depth else queue_depth)
+        # timeouts is a comma-separated list of <name>=<seconds>
+        self.timeouts = {}
+        for entry in (timeouts or '').split(','):
+            if not entry.strip():
+                continue
+            name, _, seconds = entry.partition('=')
+            self.timeouts[name.strip()] = float(seconds)
+        self.queues = {}
+
+    def queue(self, name: str) -> SignerQueue:
+        q = self.queues.get(name)
+        if not q:
+            concurrency, depth = self.limits.get(name, (self.concurrency, self.queue_depth))
+            q = SignerQueue(name, concurrency, depth)
+            self.queues[name] = q
+        return q
+
+    def timeout(self, name: str) -> float:
+        return self.timeouts.get(name, self.default_timeout)
+
+    def admit(self, name: str) -> Reservation:
+        # Reserves a place in the signer's queue for the current
+        # request (and any tasks started from it)
+        q = self.queue(name)
+        if q.full():
+            raise QueueFullError(name, self.retry_after)
+        q.pending += 1
+        reservation = Reservation(q)
+        _reservation.set(reservation)
+        return reservation
+
+    async def run(self, name: str, func: Callable, *args):
+        q = self.queue(name)
+        reservation = _reservation.get()
+        reserved = reservation is not None and reservation.covers(q)
+        if not reserved:
+            if q.full():
+                raise QueueFullError(name, self.retry_after)
+            q.pending += 1
+        try:
+            # the signer runs with the caller's context, so it can see
+            # which operation it is running for
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(q.executor, context.run, q._call, func, args)
+        finally:
+            if not reserved:
+                q.pending -= 1
+
+    def status(self) -> dict:
+        return {name: q.status() for name, q in sorted(self.queues.items())}
@@ -1,13 +1,17 @@
 import asyncio
+import shutil
 import tempfile
-from typing import Optional
+import time
+from contextlib import nullcontext
+from typing import BinaryIO, Optional
 import re
 import os
 
 from sanic import Sanic, request
-from sanic.exceptions import SanicException
+from sanic.exceptions import RangeNotSatisfiable, SanicException
+from sanic.handlers import ContentRangeHandler
 from sanic.log import logger
-from sanic.response import text
+from sanic.response import json, text, HTTPResponse
 
 from digsigserver.signers.tegrasign import TegraSigner
 from digsigserver.signers.imxsign import IMXSigner
@@ -22,6 +26,17 @@ from digsigserver.signers.ueficapsulesign import UefiCapsuleSigner
 from digsigserver.signers.ekbsign import EKBSigner
 from digsigserver.signers.fitimagesign import FitImageSigner
 from digsigserver.logredaction import install_log_redaction_filter
+from digsigserver.jobs import Job, JobManager
+from digsigserver.keycache import KeyCache
+from digsigserver.keyfiles import keyset_uri
+from digsigserver.resultcache import ResultCache
+from digsigserver.scheduler import QueueFullError, Reservation, Scheduler
+from digsigserver.signers import Signer
+from digsigserver.uploads import Upload, UploadedFile, receive_upload
+from digsigserver.workdirs import WorkdirManager
+from . import keyobjects
+from . import metrics
+from . import usage
 from . import utils
 
 # Signing can take a loooong time, so set a more reasonable
@@ -32,7 +47,34 @@ CodesignSanicDefaults = {
     'L4T_TOOLS_BASE': '/opt/nvidia',
     'IMX_CST_BASE': '/opt/NXP',
     'KEYFILE_URI': 'file:///please/configure/this/path',
-    'LOG_LEVEL': 'DEBUG'
+    'LOG_LEVEL': 'DEBUG',
+    'KEYFILE_CACHE_TTL': 0,
+    'KEYFILE_CACHE_MAX_SIZE': 4194304,
+    'S3_MAX_CONCURRENCY': 10,
+    'S3_MULTIPART_CHUNKSIZE': 8388608,
+    'RESPONSE_CHUNK_SIZE': 1048576,
+    'SIGNER_CONCURRENCY': 4,
+    'SIGNER_QUEUE_DEPTH': 16,
+    'SIGNER_LIMITS': '',
+    'SIGNER_RETRY_AFTER': 30,
+    'SIGNER_TIMEOUT': 0,
+    'SIGNER_TIMEOUTS': '',
+    'JOB_RESULT_TTL': 3600,
+    'KMODSIGN_BACKEND': 'native',
+    'KMODSIGN_WORKERS': 0,
+    'OPTEESIGN_WORKERS': 0,
+    'TEGRA_SIGNING_CACHE_MAX_SIZE': 1073741824,
+    'RK_OPTEE_TA_BACKEND': 'native',
+    'RKOPTEESIGN_WORKERS': 0,
+    'SWUPDATE_SSL_BACKEND': 'native',
+    'UEFISIGN_BACKEND': 'native',
+    'MENDER_BACKEND': 'native',
+    'KEYOBJECT_CACHE_TTL': 0,
+    'KEYOBJECT_CACHE_MAX_ENTRIES': 32,
+    'RESULT_CACHE_MAX_SIZE': 0,
+    'RESULT_CACHE_TTL': 86400,
+    'WORKDIR_REAPER_CONCURRENCY': 2,
+    'TOOL_OUTPUT_TAIL_SIZE': 65536
 }
 
 """
@@ -46,16 +88,50 @@ def create_app() -> Sanic:
     app.config.load_environment_vars(prefix='DIGSIGSERVER_')
     install_log_redaction_filter([app.config.get('YUBIHSM_PASSWORD')])
     logger.setLevel(app.config.get("LOG_LEVEL"))
+    utils.configure_storage(app.config)
+    keyobjects.configure(float(app.config.get('KEYOBJECT_CACHE_TTL')),
+                         int(app.config.get('KEYOBJECT_CACHE_MAX_ENTRIES')))
+    if float(app.config.get('KEYFILE_CACHE_TTL')) > 0:
+        app.ctx.keycache = KeyCache(float(app.config.get('KEYFILE_CACHE_TTL')),
+                                    int(app.config.get('KEYFILE_CACHE_MAX_SIZE')))
+    app.ctx.scheduler = Scheduler(int(app.config.get('SIGNER_CONCURRENCY')),
+                                  int(app.config.get('SIGNER_QUEUE_DEPTH')),
+                                  int(app.config.get('SIGNER_RETRY_AFTER')),
+                                  app.config.get('SIGNER_LIMITS'),
+                                  float(app.config.get('SIGNER_TIMEOUT')),
+                                  app.config.get('SIGNER_TIMEOUTS'))
+    if int(app.config.get('RESULT_CACHE_MAX_SIZE')) > 0:
+        app.ctx.resultcache = ResultCache(app.config.get('RESULT_CACHE_DIR') or
+                                          os.path.join(tempfile.gettempdir(), 'digsigserver-results'),
+                                          int(app.config.get('RESULT_CACHE_MAX_SIZE')),
+                                          float(app.config.get('RESULT_CACHE_TTL')),
+                                          result_cache_salt(app))
+    app.ctx.workdirs = WorkdirManager(app.config.get('WORKDIR_BASE') or os.path.join(tempfile.gettempdir(),
+                                                                                     'digsigserver-work'),
+                                      int(app.config.get('WORKDIR_REAPER_CONCURRENCY')))
+    app.ctx.jobs = JobManager(app.config.get('JOB_STORE_DIR') or os.path.join(tempfile.gettempdir(),
+                                                                               'digsigserver-jobs'),
+                              float(app.config.get('JOB_RESULT_TTL')), app.ctx.workdirs.release)
     attach_exception_handlers(app)
     attach_endpoints(app)
     return app
 
 
+def result_cache_salt(app: Sanic) -> str:
+    # Settings that select the tools and keys used for signing, so
+    # cached results are not reused after they are changed
+    return '\n'.join('{}={}'.format(name, app.config.get(name)) for name in sorted(app.config)
+                     if re.match(r'[A-Z0-9_]+_(BACKEND|BASE|PATH|URI|SIGN_FILE)$', name))
+
+
 def attach_exception_handlers(app: Sanic):
     @app.exception(Exception)
     async def handle_unexpected_error(req: request, exc: Exception):
         if isinstance(exc, SanicException):
             raise exc
+        if isinstance(exc, QueueFullError):
+            logger.warning(str(exc))
+            return text("Server busy", status=429, headers={"Retry-After": str(exc.retry_after)})
         logger.exception('Unhandled application failure')
         return text('Signing error', status=500)
 
@@ -64,10 +140,30 @@ def config_get(item: str, default_value=None) -> str:
     return Sanic.get_app('digsigserver').config.get(item, default_value)
 
 
-def validate_upload(req: request, name: str, ok_types: Optional[list] = None) -> request.File:
+def admit(signer_class: type) -> Reservation:
+    return Sanic.get_app('digsigserver').ctx.scheduler.admit(signer_class.__name__)
+
+
+async def run_signer(s: Signer, method, *args):
+    # If the request is cancelled (the client disconnected, or the
+    # response timed out), the signer's tools are killed rather than
+    # being left to run to completion
+    scheduler = Sanic.get_app('digsigserver').ctx.scheduler
+    name = type(s).__name__
+    try:
+        with metrics.timer('sign'):
+            return await scheduler.run(name, s.run_timed, scheduler.timeout(name), method, *args)
+    except asyncio.CancelledError:
+        logger.warning("{} signing cancelled".format(s.operation))
+        metrics.signing_cancelled_total.inc(s.operation)
+        s.cancel()
+        raise
+
+
+def validate_upload(upload: Upload, name: str, ok_types: Optional[list] = None) -> UploadedFile:
     if not ok_types:
         ok_types = ["application/octet-stream"]
-    f = req.files.get(name)
+    f = upload.files.get(name)
     return f if f and f.type in ok_types else None
 
 
@@ -85,389 +181,791 @@ def parse_manifest(manifest_file: str) -> dict:
     return result
 
 
-async def return_file(req: request, filename: str, return_filename: str):
-    response = await req.respond(content_type="application/octet-stream",
-                                 headers={"Content-Disposition": f'Attachment; filename="{return_filename}"'})
-    with open(filename, "rb") as f:
-        while True:
-            data = f.read(8192)
+def byte_range(req: request, stats: os.stat_result) -> tuple[int, int]:
+    # Returns the first and last byte of the single range requested,
+    # limited to the size of the file as RFC 7233 requires: a suffix
+    # range longer than the file covers all of it.
+    content_range = ContentRangeHandler(req, stats)
+    start = max(0, content_range.start)
+    end = min(content_range.end, stats.st_size - 1)
+    if start >= stats.st_size or start > end:
+        raise RangeNotSatisfiable("Range starts beyond end of file", content_range)
+    return start, end
+
+
+async def return_file(req: request, filename: str, return_filename: str, f: Optional[BinaryIO] = None):
+    # File reads are done in the executor, so a slow disk doesn't stall
+    # the event loop.  Single byte ranges are supported, so clients can
+    # resume an interrupted download.  If the file has already been
+    # opened, it is passed in as f, and is closed when done.
+    loop = asyncio.get_running_loop()
+    chunk_size = int(config_get('RESPONSE_CHUNK_SIZE'))
+    if f is None:
+        f = await loop.run_in_executor(None, open, filename, "rb")
+    try:
+        stats = os.fstat(f.fileno())
+        headers = {"Content-Disposition": f'Attachment; filename="{return_filename}"',
+                   "Accept-Ranges": "bytes"}
+        status = 200
+        offset = 0
+        remaining = stats.st_size
+        if req.headers.get("range"):
+            offset, end = byte_range(req, stats)
+            remaining = end - offset + 1
+            headers["Content-Range"] = "bytes {}-{}/{}".format(offset, end, stats.st_size)
+            status = 206
+        headers["Content-Length"] = str(remaining)
+        start = time.monotonic()
+        response = await req.respond(status=status, content_type="application/octet-stream", headers=headers)
+        while remaining > 0:
+            data = await loop.run_in_executor(None, os.pread, f.fileno(), min(chunk_size, remaining), offset)
             if not data:
                 break
             await response.send(data, False)
-    await response.eof()
+            offset += len(data)
+            remaining -= len(data)
+        await response.eof()
+        metrics.observe_phase('send', time.monotonic() - start)
+    finally:
+        f.close()
 
 
 async def return_tarball(req: request, workdir: str, return_filename: str = "signed-artifact.tar.gz",
                          files_to_return: Optional[list] = None):
-    outfile = tempfile.NamedTemporaryFile(delete=False)
-    outfile.close()
-    if utils.repack_files(workdir, outfile.name, file_list=files_to_return):
-        await return_file(req, outfile.name, return_filename)
-        response = None
+    # The tarball is generated on the fly and sent with chunked encoding.
+    # Holding back the first chunk lets us still return an error if tar
+    # fails immediately; a failure after that drops the connection.
+    # Time spent waiting for tar is accounted as repacking, the rest as sending.
+    stream = utils.stream_repack(workdir, int(config_get('RESPONSE_CHUNK_SIZE')), file_list=files_to_return)
+    start = time.monotonic()
+    try:
+        try:
+            data = await anext(stream, b'')
+        except RuntimeError as e:
+            logger.warning(str(e))
+            return text("Signing error", status=500)
+        repack_time = time.monotonic() - start
+        response = await req.respond(content_type="application/octet-stream",
+                                     headers={"Content-Disposition": f'Attachment; filename="{return_filename}"'})
+        while data:
+            await response.send(data, False)
+            repack_start = time.monotonic()
+            data = await anext(stream, b'')
+            repack_time += time.monotonic() - repack_start
+        await response.eof()
+        metrics.observe_phase('repack', repack_time)
+        metrics.observe_phase('send', time.monotonic() - start - repack_time)
+    except RuntimeError as e:
+        logger.error('aborting response: {}'.format(e))
+        raise
+    finally:
+        await stream.aclose()
+    return None
+
+
+class SigningResult:
+    # Describes what a signing operation produced: either a single
+    # file (path), a message, or (if neither is set) the listed files
+    # in the workdir, or the whole workdir, returned as a tarball.
+    # A shared path (in the result cache) must not be moved or removed,
+    # and may be removed by the cache at any time, so it comes with an
+    # open file to read the result from.
+    def __init__(self, filename: str, path: Optional[str] = None, files: Optional[list] = None,
+                 message: Optional[str] = None, shared: bool = False, file: Optional[BinaryIO] = None):
+        self.filename = filename
+        self.path = path
+        self.files = files
+        self.message = message
+        self.shared = shared
+        self.file = file
+
+
+# Operations marked as cacheable produce results that can be reused
+# for an identical request: their output is deterministic, or a
+# previously-generated signature is as good as a new one.  Their
+# results must depend only on the request and the signing keys, and
+# they must not update anything outside the workdir.
+class SigningOperation:
+    def __init__(self, name: str, signer_class: type, func, spool: Optional[list], extract: Optional[list],
+                 cacheable: bool = False):
+        self.name = name
+        self.signer_class = signer_class
+        self.func = func
+        self.spool = spool
+        self.extract = extract
+        self.cacheable = cacheable
+
+
+signing_operations = {}
+
+
+def signing_operation(name: str, signer_class: type, spool: Optional[list] = None,
+                      extract: Optional[list] = None, cacheable: bool = False):
+    def decorator(func):
+        signing_operations[name] = SigningOperation(name, signer_class, func, spool, extract, cacheable)
+        return func
+    return decorator
+
+
+def output_file(workdir: str) -> str:
+    return os.path.join(workdir, '.signed-output')
+
+
+@signing_operation("tegra", TegraSigner, extract=["artifact"], cacheable=True)
+async def sign_tegra(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = TegraSigner(app, workdir, upload.form.get("machine"), upload.form.get("soctype"),
+                        upload.form.get("bspversion"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    if f.extracted:
+        try:
+            envvars = parse_manifest(os.path.join(workdir, 'MANIFEST'))
+        except ValueError:
+            return text("Invalid manifest", status=400)
+        if 'BUPGENSPECS' in envvars:
+            result = await run_signer(s, s.multisign, envvars)
+        elif 'SIGNFILES' in envvars:
+            result = await run_signer(s, s.signfiles, envvars)
+        else:
+            result = await run_signer(s, s.sign, envvars)
+        if result:
+            return SigningResult("signed-artifact.tar.gz")
+    return text("Signing error", status=500)
+
+
+@signing_operation("rk", RockchipSigner, spool=["artifact"], cacheable=True)
+async def sign_rk(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = RockchipSigner(app, workdir, upload.form.get("machine"), upload.form.get("soctype"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    artifact_type = upload.form.get("artifact_type", "").lower()
+    burn_key_hash = utils.to_boolean(upload.form.get("burn_key_hash", "no"))
+    if artifact_type not in ["fit-image", "idblock", "usbloader"]:
+        return text("Invalid artifact type", status=400)
+    if artifact_type == "fit-image":
+        external_data_offset = upload.form.get("external_data_offset", "")
+        with metrics.timer('extract'):
+            extracted = await asyncio.get_running_loop().run_in_executor(None, utils.extract_files,
+                                                                         workdir, f.path)
+        os.unlink(f.path)
+        if extracted:
+            if await run_signer(s, s.sign, artifact_type,
+                                burn_key_hash, None, None, external_data_offset):
+                return SigningResult("signed-artifact.tar.gz", files=s.fit_image_output_files)
     else:
-        response = text("Signing error", status=500)
-    os.unlink(outfile.name)
-    return response
-
-
-def attach_endpoints(app: Sanic):
-    @app.post("/sign/tegra")
-    async def sign_handler_tegra(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = TegraSigner(app, workdir, req.form.get("machine"), req.form.get("soctype"),
-                                req.form.get("bspversion"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            if await asyncio.get_running_loop().run_in_executor(None, utils.extract_files, workdir, f):
-                try:
-                    envvars = parse_manifest(os.path.join(workdir, 'MANIFEST'))
-                except ValueError:
-                    return text("Invalid manifest", status=400)
-                if 'BUPGENSPECS' in envvars:
-                    result = await asyncio.get_running_loop().run_in_executor(None, s.multisign, envvars)
-                elif 'SIGNFILES' in envvars:
-                    result = await asyncio.get_running_loop().run_in_executor(None, s.signfiles, envvars)
-                else:
-                    result = await asyncio.get_running_loop().run_in_executor(None, s.sign, envvars)
-                if result:
-                    return await return_tarball(req, workdir)
-        return text("Signing error", status=500)
-
-    @app.post("/sign/rk")
-    async def sign_handler_rk_kernel_fit(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = RockchipSigner(app, workdir, req.form.get("machine"), req.form.get("soctype"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            artifact_type = req.form.get("artifact_type").lower()
-            burn_key_hash = utils.to_boolean(req.form.get("burn_key_hash", "no"))
-            if artifact_type not in ["fit-image", "idblock", "usbloader"]:
-                return text("Invalid artifact type", status=400)
-            if artifact_type == "fit-image":
-                external_data_offset = req.form.get("external_data_offset", "")
-                if await asyncio.get_running_loop().run_in_executor(None, utils.extract_files,
-                                                                    workdir, f):
-                    if await asyncio.get_running_loop().run_in_executor(None, s.sign, artifact_type,
-                                                                        burn_key_hash, None, None, external_data_offset):
-                        await return_tarball(req, workdir, s.fit_image_output_files)
-                        response = None
-                    else:
-                        response = text("Signing error", status=500)
-            else:
-                with open(os.path.join(workdir, "artifact"), "wb") as artifact:
-                    artifact.write(f.body)
-                outfile = tempfile.NamedTemporaryFile(delete=False)
-                outfile.close()
-                if await asyncio.get_running_loop().run_in_executor(None, s.sign, artifact_type,
-                                                                burn_key_hash, artifact.name, outfile.name, None):
-                    await return_file(req, outfile.name, "artifact.signed")
-                    response = None
-                else:
-                    response = text("Signing error", status=500)
-        return response
-
-    @app.post("/sign/imx")
-    async def sign_handler_imx(req: request):
-        csf = validate_upload(req, "csf", ok_types=["text/plain"])
-        if not csf:
-            return text("Invalid CSF", status=400)
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = IMXSigner(app, workdir, req.form.get("machine"), req.form.get("soctype"),
-                              req.form.get("cstversion"), req.form.get("backend"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            with open(os.path.join(workdir, "csf-input.txt"), "w") as csfinput:
-                csfinput.write(csf.body.decode('UTF-8'))
-            with open(os.path.join(workdir, f.name), "wb") as artifact:
-                artifact.write(f.body)
-
-            outfile = tempfile.NamedTemporaryFile(delete=False)
-            outfile.close()
-
-            if await asyncio.get_running_loop().run_in_executor(None, s.sign, outfile.name):
-                await return_file(req, outfile.name, "artifact.signed")
-                response = None
-            else:
-                response = text("Signing error", status=500)
-        return response
-
-    @app.post("/sign/fitimage")
-    async def sign_handler_fitimage(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        dtb = validate_upload(req, "dtb")
-        backend = req.form.get("backend")
-        keyname = req.form.get("keyname")
-        if backend == "pkcs11" and not keyname:
-            return text("Key URI missing for PKCS#11 backend", status=400)
-        if not keyname:
-            keyname = "dev"
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = FitImageSigner(app, workdir, req.form.get("machine") or "imx", backend)
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            fitimage_path = os.path.join(workdir, "fitImage")
-            with open(fitimage_path, "wb") as fitimage:
-                fitimage.write(f.body)
-
-            dtb_path = None
-            if dtb:
-                dtb_path = os.path.join(workdir, dtb.name or "u-boot.dtb")
-                with open(dtb_path, "wb") as dtb_file:
-                    dtb_file.write(dtb.body)
-
-            outfile = tempfile.NamedTemporaryFile(delete=False)
-            outfile.close()
-            if await asyncio.get_running_loop().run_in_executor(None, s.sign,
-                                   fitimage_path,
-                                   dtb_path,
-                                   req.form.get("external_data_offset"),
-                                   req.form.get("mark_required"),
-                                    req.form.get("algo"),
-                                   keyname,
-                                   req.form.get("comment")):
-                if dtb_path:
-                    dtb_name = os.path.basename(dtb_path)
-                    response = await return_tarball(req, workdir, return_filename="signed-fitImage.tar.gz",
-                                                   files_to_return=["fitImage", dtb_name])
-                else:
-                    await return_file(req, fitimage_path, "fitImage.signed")
-                    response = None
-            else:
-                response = text("Signing error", status=500)
-        return response
-
-    @app.post("/sign/modules")
-    async def sign_handler_modules(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = KernelModuleSigner(app, workdir, req.form.get("machine"), req.form.get("hashalg", "sha512"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            if await asyncio.get_running_loop().run_in_executor(None, utils.extract_files, workdir, f):
-                result = await asyncio.get_running_loop().run_in_executor(None, s.sign)
-                if result:
-                    return await return_tarball(req, workdir)
-        return text("Signing error", status=500)
-
-    @app.post("/sign/tegra/uefi")
-    async def sign_handler_uefi(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = UefiSigner(app,
-                               workdir,
-                               req.form.get("machine"),
-                               req.form.get("signing_type"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            signing_type = req.form.get("signing_type").lower()
-            if signing_type not in ["sbsign", "signature", "attach_signature"]:
-                return text("Invalid signing type", status=400)
-            with open(os.path.join(workdir, "artifact"), "wb") as artifact:
-                artifact.write(f.body)
-            outfile = tempfile.NamedTemporaryFile(delete=False)
-            outfile.close()
-            if await asyncio.get_running_loop().run_in_executor(None,
-                                                                s.sign,
-                                                                artifact.name,
-                                                                outfile.name):
-                await return_file(req, outfile.name, "artifact.signed")
-                response = None
-            else:
-                response = text("Signing error", status=500)
-        os.unlink(outfile.name)
-        return response
-
-    @app.post("/sign/tegra/ueficapsule")
-    async def sign_handler_uefi_capsule(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = UefiCapsuleSigner(
-                    app,
-                    workdir,
-                    req.form.get("machine"),
-                    req.form.get("soctype"),
-                    req.form.get("bspversion"),
-                    req.form.get("guid"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            with open(os.path.join(workdir, "artifact"), "wb") as artifact:
-                artifact.write(f.body)
-            outfile = tempfile.NamedTemporaryFile(delete=False)
-            outfile.close()
-            if await asyncio.get_running_loop().run_in_executor(None,
-                                                                s.generate_signed_capsule,
-                                                                artifact.name,
-                                                                outfile.name):
-                await return_file(req, outfile.name, "artifact.cap")
-                response = None
-            else:
-                response = text("Signing error", status=500)
-        os.unlink(outfile.name)
-        return response
-
-    @app.post("/sign/optee")
-    async def sign_handler_optee(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
+        artifact = os.path.join(workdir, "artifact")
+        os.rename(f.path, artifact)
+        outfile = output_file(workdir)
+        if await run_signer(s, s.sign, artifact_type,
+                            burn_key_hash, artifact, outfile, None):
+            return SigningResult("artifact.signed", path=outfile)
+    return text("Signing error", status=500)
+
+
+@signing_operation("imx", IMXSigner, spool=["csf", "artifact"], cacheable=True)
+async def sign_imx(app: Sanic, upload: Upload, workdir: str):
+    csf = validate_upload(upload, "csf", ok_types=["text/plain"])
+    if not csf:
+        return text("Invalid CSF", status=400)
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = IMXSigner(app, workdir, upload.form.get("machine"), upload.form.get("soctype"),
+                      upload.form.get("cstversion"), upload.form.get("backend"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    os.rename(csf.path, os.path.join(workdir, "csf-input.txt"))
+    os.rename(f.path, os.path.join(workdir, f.name))
+
+    outfile = output_file(workdir)
+    if await run_signer(s, s.sign, outfile):
+        return SigningResult("artifact.signed", path=outfile)
+    return text("Signing error", status=500)
+
+
+@signing_operation("fitimage", FitImageSigner, spool=["artifact", "dtb"], cacheable=True)
+async def sign_fitimage(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    dtb = validate_upload(upload, "dtb")
+    backend = upload.form.get("backend")
+    keyname = upload.form.get("keyname")
+    if backend == "pkcs11" and not keyname:
+        return text("Key URI missing for PKCS#11 backend", status=400)
+    if not keyname:
+        keyname = "dev"
+    try:
+        s = FitImageSigner(app, workdir, upload.form.get("machine") or "imx", backend)
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    fitimage_path = os.path.join(workdir, "fitImage")
+    os.rename(f.path, fitimage_path)
+
+    dtb_path = None
+    if dtb:
+        dtb_path = os.path.join(workdir, dtb.name or "u-boot.dtb")
+        os.rename(dtb.path, dtb_path)
+
+    if await run_signer(s, s.sign,
+                        fitimage_path,
+                        dtb_path,
+                        upload.form.get("external_data_offset"),
+                        upload.form.get("mark_required"),
+                        upload.form.get("algo"),
+                        keyname,
+                        upload.form.get("comment")):
+        if dtb_path:
+            dtb_name = os.path.basename(dtb_path)
+            return SigningResult("signed-fitImage.tar.gz", files=["fitImage", dtb_name])
+        return SigningResult("fitImage.signed", path=fitimage_path)
+    return text("Signing error", status=500)
+
+
+@signing_operation("modules", KernelModuleSigner, extract=["artifact"], cacheable=True)
+async def sign_modules(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = KernelModuleSigner(app, workdir, upload.form.get("machine"), upload.form.get("hashalg", "sha512"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    if f.extracted:
+        if await run_signer(s, s.sign):
+            return SigningResult("signed-artifact.tar.gz")
+    return text("Signing error", status=500)
+
+
+@signing_operation("tegra/uefi", UefiSigner, spool=["artifact"], cacheable=True)
+async def sign_uefi(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = UefiSigner(app,
+                       workdir,
+                       upload.form.get("machine"),
+                       upload.form.get("signing_type"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    signing_type = upload.form.get("signing_type").lower()
+    if signing_type not in ["sbsign", "signature", "attach_signature"]:
+        return text("Invalid signing type", status=400)
+    artifact = os.path.join(workdir, "artifact")
+    os.rename(f.path, artifact)
+    outfile = output_file(workdir)
+    if await run_signer(s,
+                        s.sign,
+                        artifact,
+                        outfile):
+        return SigningResult("artifact.signed", path=outfile)
+    return text("Signing error", status=500)
+
+
+@signing_operation("tegra/ueficapsule", UefiCapsuleSigner, spool=["artifact"], cacheable=True)
+async def sign_uefi_capsule(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = UefiCapsuleSigner(
+            app,
+            workdir,
+            upload.form.get("machine"),
+            upload.form.get("soctype"),
+            upload.form.get("bspversion"),
+            upload.form.get("guid"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    artifact = os.path.join(workdir, "artifact")
+    os.rename(f.path, artifact)
+    outfile = output_file(workdir)
+    if await run_signer(s,
+                        s.generate_signed_capsule,
+                        artifact,
+                        outfile):
+        return SigningResult("artifact.cap", path=outfile)
+    return text("Signing error", status=500)
+
+
+@signing_operation("optee", OPTEESigner, extract=["artifact"], cacheable=True)
+async def sign_optee(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = OPTEESigner(app, workdir, upload.form.get("machine"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    if f.extracted:
+        if await run_signer(s, s.sign):
+            return SigningResult("signed-artifact.tar.gz")
+    return text("Signing error", status=500)
+
+
+@signing_operation("rkoptee-tee", RockchipOpteeSigner, spool=["artifact"], cacheable=True)
+async def sign_rk_optee_tee(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = RockchipOpteeSigner(app, workdir, upload.form.get("machine"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+    os.rename(f.path, os.path.join(workdir, "tee.bin"))
+    outfile = output_file(workdir)
+    if await run_signer(s, s.resign_tee,
+                        os.path.join(workdir, "tee.bin"),
+                        outfile):
+        return SigningResult("tee.bin.signed", path=outfile)
+    return text("Signing error", status=500)
+
+
+@signing_operation("rkoptee-ta", RockchipOpteeSigner, extract=["artifact"], cacheable=True)
+async def sign_rk_optee_ta(app: Sanic, upload: Upload, workdir: str):
+    f = validate_upload(upload, "artifact")
+    if not f:
+        return text("Invalid artifact", status=400)
+    try:
+        s = RockchipOpteeSigner(app, workdir, upload.form.get("machine"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    if f.extracted:
+        if await run_signer(s, s.resign_tas):
+            return SigningResult("signed-artifact.tar.gz")
+    return text("Signing error", status=500)
+
+
+@signing_operation("swupdate", SwupdateSigner, spool=["sw-description"], cacheable=True)
+async def sign_swupdate(app: Sanic, upload: Upload, workdir: str):
+    distro = upload.form.get("distro")
+    if not distro:
+        return text("Distro name missing", status=400)
+    backend = upload.form.get("backend")
+    method = upload.form.get("method")
+    if not method:
+        method = "RSA"
+    key_uri = upload.form.get("key-uri")
+    if backend == "pkcs11" and not key_uri:
+        return text("Key URI missing for PKCS#11 backend", status=400)
+    f = validate_upload(upload, "sw-description")
+    if not f:
+        return text("Invalid sw-description", status=400)
+    try:
+        s = SwupdateSigner(app, workdir, distro, backend)
+    except ValueError:
+        logger.info("could not init signer")
+        return text("Invalid parameters", status=400)
+    outfile = output_file(workdir)
+    os.rename(f.path, os.path.join(workdir, "sw-description"))
+    if await run_signer(s, s.sign,
+                        method, "sw-description",
+                        outfile, key_uri):
+        return SigningResult("sw-description.sig", path=outfile)
+    return text("Signing error", status=500)
+
+
+@signing_operation("mender", MenderSigner)
+async def sign_mender(app: Sanic, upload: Upload, workdir: str):
+    artifact = upload.form.get('artifact-uri')
+    if not artifact:
+        return text("Artifact URI missing", status=400)
+    distro = upload.form.get('distro')
+    if not distro:
+        return text("Distro name missing", status=400)
+    try:
+        s = MenderSigner(app, workdir, distro, artifact)
+    except ValueError:
+        return text("Invalid parameters", status=400)
+    if await run_signer(s, s.sign):
+        return SigningResult("", message="Signing successful")
+    return text("Signing error", status=500)
+
+
+@signing_operation("tegra/ekb", EKBSigner)
+async def sign_ekb(app: Sanic, upload: Upload, workdir: str):
+    try:
+        s = EKBSigner(
+            app,
+            workdir,
+            upload.form.get("machine"),
+            upload.form.get("soctype"),
+            upload.form.get("bspversion"))
+    except ValueError:
+        return text("Invalid parameters", status=400)
+
+    outfile = output_file(workdir)
+    if await run_signer(s,
+                        s.generate_ekb,
+                        outfile):
+        return SigningResult("ekb.img", path=outfile)
+    return text("Signing error", status=500)
+
+
+# Key backends using the key files under $DIGSIGSERVER_KEYFILE_URI;
+# anything else (pkcs11, for example) uses keys held in an HSM
+SOFTWARE_KEY_BACKENDS = (None, '', 'ssl')
+
+
+def result_cache_parts(app: Sanic, op: SigningOperation, upload: Upload) -> Optional[dict]:
+    # Everything that goes into the result cache key for a request: the
+    # operation, its parameters and uploaded files, and the current
+    # versions of the signing keys.  Requests using keys held in an HSM
+    # (any backend other than the default software one) are not
+    # cacheable, since we can't tell when those keys change.
+    if upload.form.get('backend') not in SOFTWARE_KEY_BACKENDS:
+        return None
+    keys = {}
+    for field in ['machine', 'distro']:
+        if upload.form.get(field):
             try:
-                s = OPTEESigner(app, workdir, req.form.get("machine"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            if await asyncio.get_running_loop().run_in_executor(None, utils.extract_files, workdir, f):
-                result = await asyncio.get_running_loop().run_in_executor(None, s.sign)
-                if result:
-                    return await return_tarball(req, workdir)
-        return text("Signing error", status=500)
-
-    @app.post("/sign/rkoptee-tee")
-    async def sign_handler_rk_optee_tee(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = RockchipOpteeSigner(app, workdir, req.form.get("machine"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-            with open(os.path.join(workdir, "tee.bin"), "wb") as artifact:
-                artifact.write(f.body)
-            outfile = tempfile.NamedTemporaryFile(delete=False)
-            outfile.close()
-            if await asyncio.get_running_loop().run_in_executor(None, s.resign_tee,
-                                                                os.path.join(workdir, "tee.bin"),
-                                                                outfile.name):
-                await return_file(req, outfile.name, "tee.bin.signed")
-                response = None
-            else:
-                response = text("Signing error", status=500)
-        os.unlink(outfile.name)
-        return response
-
-    @app.post("/sign/rkoptee-ta")
-    async def sign_handler_rk_optee_ta(req: request):
-        f = validate_upload(req, "artifact")
-        if not f:
-            return text("Invalid artifact", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = RockchipOpteeSigner(app, workdir, req.form.get("machine"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            if await asyncio.get_running_loop().run_in_executor(None, utils.extract_files, workdir, f):
-                result = await asyncio.get_running_loop().run_in_executor(None, s.resign_tas)
-                if result:
-                    return await return_tarball(req, workdir)
-        return text("Signing error", status=500)
-
-    @app.post("/sign/swupdate")
-    async def sign_handler_swupdate(req: request):
-        distro = req.form.get("distro")
-        if not distro:
-            return text("Distro name missing", status=400)
-        backend = req.form.get("backend")
-        method = req.form.get("method")
-        if not method:
-            method = "RSA"
-        key_uri = req.form.get("key-uri")
-        if backend == "pkcs11" and not key_uri:
-            return text("Key URI missing for PKCS#11 backend", status=400)
-        f = validate_upload(req, "sw-description")
-        if not f:
-            return text("Invalid sw-description", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
+                keys[field] = utils.uri_fingerprint(keyset_uri(app, op.signer_class.keytag, upload.form[field]),
+                                                    is_dir=True)
+            except (RuntimeError, OSError):
+                keys[field] = None
+    if not any(keys.values()):
+        return None
+    return {'operation': op.name,
+            'form': upload.form,
+            'files': {name: [f.name, f.type, f.digest] for name, f in upload.files.items()},
+            'keys': keys}
+
+
+def store_result(cache: ResultCache, key: str, workdir: str, result: SigningResult) -> Optional[dict]:
+    if result.message is not None:
+        return cache.store(key, result.filename, message=result.message)
+    if result.path:
+        return cache.store(key, result.filename, path=result.path)
+    fd, tarball = tempfile.mkstemp(dir=cache.directory, prefix='.tmp-')
+    os.close(fd)
+    if not utils.repack_files(workdir, tarball, result.files):
+        os.unlink(tarball)
+        return None
+    return cache.store(key, result.filename, path=tarball, move=True)
+
+
+def cached_result(entry: dict) -> SigningResult:
+    return SigningResult(entry['filename'], path=entry.get('path'), message=entry['message'], shared=True,
+                         file=entry.get('file'))
+
+
+async def run_operation(app: Sanic, op: SigningOperation, upload: Upload, workdir: str):
+    # Runs a signing operation, going through the result cache (if
+    # enabled) for cacheable ones.  Identical requests that arrive
+    # while the operation is running wait for its result.
+    cache = getattr(app.ctx, 'resultcache', None)
+    if not cache or not op.cacheable:
+        return await op.func(app, upload, workdir)
+    loop = asyncio.get_running_loop()
+    parts = await loop.run_in_executor(None, result_cache_parts, app, op, upload)
+    if parts is None:
+        return await op.func(app, upload, workdir)
+    key = cache.key(parts)
+    entry = await loop.run_in_executor(None, cache.lookup, key)
+    if entry:
+        metrics.result_cache_total.inc(op.name, 'hit')
+        logger.info("Returning cached result {} for {} request".format(key, op.name))
+        return cached_result(entry)
+    pending = cache.pending(key)
+    if pending:
+        metrics.result_cache_total.inc(op.name, 'joined')
+        logger.info("Waiting for identical {} request in progress ({})".format(op.name, key))
+        if await asyncio.shield(pending):
+            entry = await loop.run_in_executor(None, cache.lookup, key)
+            if entry:
+                return cached_result(entry)
+        return await op.func(app, upload, workdir)
+    metrics.result_cache_total.inc(op.name, 'miss')
+    cache.begin(key)
+    entry = None
+    try:
+        result = await op.func(app, upload, workdir)
+        if not isinstance(result, SigningResult):
+            return result
+        with metrics.timer('repack') if result.path is None and result.message is None else nullcontext():
+            entry = await loop.run_in_executor(None, store_result, cache, key, workdir, result)
+        return cached_result(entry) if entry else result
+    finally:
+        cache.finish(key, entry is not None)
+
+
+async def send_result(req: request, workdir: str, result):
+    if not isinstance(result, SigningResult):
+        return result
+    if result.message is not None:
+        return text(result.message)
+    if result.path:
+        await return_file(req, result.path, result.filename, result.file)
+        return None
+    return await return_tarball(req, workdir, return_filename=result.filename,
+                                files_to_return=result.files)
+
+
+def wants_digest(app: Sanic, op: SigningOperation) -> bool:
+    return op.cacheable and getattr(app.ctx, 'resultcache', None) is not None
+
+
+def copy_shared_result(result: SigningResult, dest: str):
+    # Links to the cached file if it is still there, otherwise copies
+    # it from the open file
+    try:
+        try:
+            os.link(result.path, dest)
+        except OSError:
+            result.file.seek(0)
+            with open(dest, 'wb') as f:
+                shutil.copyfileobj(result.file, f)
+    finally:
+        result.file.close()
+
+
+def server_error(exc: Exception) -> bool:
+    return not isinstance(exc, SanicException) or exc.status_code >= 500
+
+
+async def handle_signing_request(req: request, op: SigningOperation):
+    endpoint = "/sign/{}".format(op.name)
+    token = metrics.set_operation(op.name)
+    req.ctx.usage, usage_token = usage.track()
+    metrics.requests_total.inc(endpoint)
+    start = time.monotonic()
+    failed = True
+    try:
+        reservation = admit(op.signer_class)
+        try:
+            workdir = await req.app.ctx.workdirs.create()
             try:
-                s = SwupdateSigner(app, workdir, distro, backend)
-            except ValueError:
-                logger.info("could not init signer")
-                return text("Invalid parameters", status=400)
-            outfile = tempfile.NamedTemporaryFile(delete=False)
-            outfile.close()
-            with open(os.path.join(workdir, "sw-description"), "w") as infile:
-                infile.write(f.body.decode('UTF-8'))
-            if await asyncio.get_running_loop().run_in_executor(None, s.sign,
-                                                                method, "sw-description",
-                                                                outfile.name, key_uri):
-                await return_file(req, outfile.name, "sw-description.sig")
-                response = None
+                with metrics.timer('upload'):
+                    upload = await receive_upload(req, workdir, spool=op.spool, extract=op.extract,
+                                                  digest=wants_digest(req.app, op))
+                result = await run_operation(req.app, op, upload, workdir)
+                response = await send_result(req, workdir, result)
+                failed = isinstance(response, HTTPResponse) and response.status >= 500
+                return response
+            finally:
+                req.app.ctx.workdirs.release(workdir)
+        finally:
+            reservation.release()
+    except Exception as e:
+        failed = server_error(e)
+        raise
+    finally:
+        if failed:
+            metrics.request_errors_total.inc(endpoint)
+        metrics.request_duration.observe(endpoint, value=time.monotonic() - start)
+        metrics.reset_operation(token)
+        logger.info("resource usage: {}".format(req.ctx.usage.to_json(endpoint=endpoint, failed=failed,
+                                                                      wall=round(time.monotonic() - start, 3))))
+        usage.untrack(usage_token)
+
+
+async def run_job(app: Sanic, job: Job, op: SigningOperation, upload: Upload, reservation: Reservation):
+    loop = asyncio.get_running_loop()
+    metrics.set_operation(op.name)
+    job_usage, _ = usage.track()
+    start = time.monotonic()
+    job.set_state('running')
+    app.ctx.jobs.save(job)
+    try:
+        result = await run_operation(app, op, upload, job.workdir)
+        if not isinstance(result, SigningResult):
+            job.set_state('failed', result.status, result.body.decode('utf-8', errors='replace'))
+        elif result.message is not None:
+            job.set_state('done', 200, result.message)
+        else:
+            if result.path and result.shared:
+                await loop.run_in_executor(None, copy_shared_result, result, job.result_path)
+            elif result.path:
+                os.rename(result.path, job.result_path)
             else:
-                response = text("Signing error", status=500)
-        os.unlink(outfile.name)
-        return response
-
-    @app.post("/sign/mender")
-    async def sign_handler_mender(req: request):
-        artifact = req.form.get('artifact-uri')
-        if not artifact:
-            return text("Artifact URI missing", status=400)
-        distro = req.form.get('distro')
-        if not distro:
-            return text("Distro name missing", status=400)
-        with tempfile.TemporaryDirectory() as workdir:
-            try:
-                s = MenderSigner(app, workdir, distro, artifact)
-            except ValueError:
-                return text("Invalid parameters", status=400)
-            if await asyncio.get_running_loop().run_in_executor(None, s.sign):
-                return text("Signing successful")
-        return text("Signing error", status=500)
+                with metrics.timer('repack'):
+                    repacked = await loop.run_in_executor(None, utils.repack_files, job.workdir, job.result_path,
+                                                          result.files)
+                if not repacked:
+                    raise RuntimeError('could not pack job result')
+            job.set_state('done', 200, filename=result.filename)
+    except QueueFullError as e:
+        logger.warning(str(e))
+        job.set_state('failed', 429, "Server busy")
+    except Exception:
+        logger.exception('Job {} failed'.format(job.id))
+        job.set_state('failed', 500, "Signing error")
+    reservation.release()
+    app.ctx.workdirs.release(job.workdir)
+    job.usage = job_usage.summary()
+    app.ctx.jobs.save(job)
+    metrics.jobs_finished_total.inc(job.operation, job.state)
+    logger.info("resource usage: {}".format(job_usage.to_json(job=job.id, operation=job.operation, state=job.state,
+                                                              wall=round(time.monotonic() - start, 3))))
+    logger.info("Job {} ({}) {}".format(job.id, job.operation, job.state))
+
+
+async def expire_jobs(app: Sanic):
+    # Expires old jobs periodically.  The first pass runs at startup,
+    # so jobs left unfinished by worker processes that have since
+    # exited are failed promptly.
+    interval = min(60.0, float(app.config.get('JOB_RESULT_TTL')))
+    while True:
+        await asyncio.get_running_loop().run_in_executor(None, app.ctx.jobs.expire)
+        await asyncio.sleep(interval)
+
+
+async def sweep_workdirs(app: Sanic):
+    # Clean up after processes that exited without removing their
+    # workdirs, and anything else that got left behind
+    loop = asyncio.get_running_loop()
+    resultcache = getattr(app.ctx, 'resultcache', None)
+    while True:
+        count = await loop.run_in_executor(None, app.ctx.workdirs.sweep)
+        if resultcache:
+            count += await loop.run_in_executor(None, resultcache.sweep, 3600.0)
+        if count:
+            logger.info("Swept up {} leftover workdirs and files".format(count))
+        await asyncio.sleep(300)
 
 
-    @app.post("/sign/tegra/ekb")
-    async def get_handler_ekb(req: request):
-        with tempfile.TemporaryDirectory() as workdir:
+def attach_endpoints(app: Sanic):
+    @app.on_response
+    async def add_server_timing(req: request, response: HTTPResponse):
+        # for streamed responses, this runs when the response is started,
+        # after the signing tools have finished
+        request_usage = getattr(req.ctx, 'usage', None)
+        if request_usage and request_usage.tools:
+            response.headers['Server-Timing'] = request_usage.server_timing()
+
+    @app.post("/admin/keycache/flush")
+    async def admin_handler_keycache_flush(req: request):
+        keycache = getattr(app.ctx, 'keycache', None)
+        if not keycache and not keyobjects.enabled():
+            return text("Key cache not enabled", status=404)
+        count = keyobjects.flush()
+        if keycache:
+            count += keycache.flush()
+        return text("Flushed {} entries".format(count))
+
+    @app.post("/admin/resultcache/flush")
+    async def admin_handler_resultcache_flush(req: request):
+        resultcache = getattr(app.ctx, 'resultcache', None)
+        if not resultcache:
+            return text("Result cache not enabled", status=404)
+        count = await asyncio.get_running_loop().run_in_executor(None, resultcache.flush)
+        return text("Flushed {} entries".format(count))
+
+    @app.get("/status/queues")
+    async def status_handler_queues(req: request):
+        return json(app.ctx.scheduler.status())
+
+    @app.get("/metrics")
+    async def metrics_handler(req: request):
+        queues = app.ctx.scheduler.status()
+        jobs = {}
+        for job in list(app.ctx.jobs.jobs.values()):
+            if not job.finished:
+                jobs[(job.operation, job.state)] = jobs.get((job.operation, job.state), 0) + 1
+        lines = metrics.collect()
+        lines += metrics.gauge('digsigserver_signer_queued', 'Signing operations waiting for a signer thread.',
+                               ('signer',), {(name,): q['queued'] for name, q in queues.items()})
+        lines += metrics.gauge('digsigserver_signer_running', 'Signing operations in progress.',
+                               ('signer',), {(name,): q['running'] for name, q in queues.items()})
+        lines += metrics.gauge('digsigserver_jobs_in_flight', 'Signing jobs queued or running.',
+                               ('operation', 'state'), jobs)
+        return text('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def signing_handler(op: SigningOperation):
+        async def handler(req: request):
+            return await handle_signing_request(req, op)
+        return handler
+
+    for op in signing_operations.values():
+        app.add_route(signing_handler(op), "/sign/{}".format(op.name), methods=["POST"], stream=True,
+                      name="sign_handler_{}".format(re.sub(r'[^a-z0-9]', '_', op.name)))
+
+    @app.post("/jobs/sign/<name:path>", stream=True)
+    async def jobs_handler_submit(req: request, name: str):
+        op = signing_operations.get(name)
+        if not op:
+            return text("Unknown signing operation", status=404)
+        endpoint = "/jobs/sign/{}".format(op.name)
+        token = metrics.set_operation(op.name)
+        metrics.requests_total.inc(endpoint)
+        start = time.monotonic()
+        try:
+            reservation = admit(op.signer_class)
             try:
-                s = EKBSigner(
-                    app,
-                    workdir,
-                    req.form.get("machine"),
-                    req.form.get("soctype"),
-                    req.form.get("bspversion"))
-            except ValueError:
-                return text("Invalid parameters", status=400)
-
-            outfile = tempfile.NamedTemporaryFile(delete=False)
-            outfile.close()
-            if await asyncio.get_running_loop().run_in_executor(None,
-                                                                s.generate_ekb,
-                                                                outfile.name):
-                await return_file(req, outfile.name, "ekb.img")
-                response = None
-            else:
-                response = text("Signing error", status=500)
-        os.unlink(outfile.name)
-        return response
+                job = await asyncio.get_running_loop().run_in_executor(None, app.ctx.jobs.create, op.name)
+                try:
+                    with metrics.timer('upload'):
+                        upload = await receive_upload(req, job.workdir, spool=op.spool, extract=op.extract,
+                                                      digest=wants_digest(app, op))
+                except BaseException:
+                    app.ctx.jobs.discard(job)
+                    raise
+            except BaseException:
+                reservation.release()
+                raise
+            # the job keeps the request's place in the queue
+            app.add_task(run_job(app, job, op, upload, reservation))
+        except Exception as e:
+            if server_error(e):
+                metrics.request_errors_total.inc(endpoint)
+            raise
+        finally:
+            metrics.request_duration.observe(endpoint, value=time.monotonic() - start)
+            metrics.reset_operation(token)
+        return json(job.to_dict(), status=202, headers={"Location": "/jobs/{}".format(job.id)})
+
+    @app.get("/jobs/<job_id>")
+    async def jobs_handler_status(req: request, job_id: str):
+        job = app.ctx.jobs.get(job_id)
+        if not job:
+            return text("No such job", status=404)
+        return json(job.to_dict())
+
+    @app.get("/jobs/<job_id>/result")
+    async def jobs_handler_result(req: request, job_id: str):
+        job = app.ctx.jobs.get(job_id)
+        if not job:
+            return text("No such job", status=404)
+        if not job.finished:
+            return text("Job not finished", status=409)
+        if job.state == 'failed' or not job.filename:
+            return text(job.message, status=job.status_code)
+        # Attribute the download to the job's operation, and report the
+        # resource usage of the job's tools in the Server-Timing header
+        token = metrics.set_operation(job.operation)
+        req.ctx.usage = usage.ResourceUsage.from_summary(job.usage)
+        try:
+            await return_file(req, job.result_path, job.filename)
+        finally:
+            metrics.reset_operation(token)
+
+    @app.after_server_start
+    async def start_job_expiry(app: Sanic):
+        app.add_task(expire_jobs(app))
+
+    @app.after_server_start
+    async def start_workdir_sweep(app: Sanic):
+        app.add_task(sweep_workdirs(app))
+
+    @app.after_server_stop
+    async def finish_workdir_removal(app: Sanic):
+        await asyncio.get_running_loop().run_in_executor(None, app.ctx.workdirs.shutdown)
@@ -0,0 +1,211 @@
+import hashlib
+import mmap
+import os
+import struct
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# Authenticode signing of PE/COFF images, as done by sbsign, following
+# "Windows Authenticode Portable Executable Signature Format".
+
+OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+OID_CONTENT_TYPE = '1.2.840.113549.1.9.3'
+OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+OID_SHA256 = '2.16.840.1.101.3.4.2.1'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+OID_SPC_INDIRECT_DATA = '1.3.6.1.4.1.311.2.1.4'
+OID_SPC_SP_OPUS_INFO = '1.3.6.1.4.1.311.2.1.12'
+OID_SPC_PE_IMAGE_DATA = '1.3.6.1.4.1.311.2.1.15'
+
+IMAGE_DIRECTORY_ENTRY_SECURITY = 4
+WIN_CERT_REVISION_2_0 = 0x0200
+WIN_CERT_TYPE_PKCS_SIGNED_DATA = 0x0002
+
+
+class PEFormatError(Exception):
+    pass
+
+
+def _der(tag: int, content: bytes) -> bytes:
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(encoded)]) + encoded + content
+
+
+def _seq(*items: bytes) -> bytes:
+    return _der(0x30, b''.join(items))
+
+
+def _set(*items: bytes) -> bytes:
+    return _der(0x31, b''.join(sorted(items)))
+
+
+def _oid(dotted: str) -> bytes:
+    arcs = [int(a) for a in dotted.split('.')]
+    body = bytearray([40 * arcs[0] + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            chunk.insert(0, 0x80 | (arc & 0x7f))
+            arc >>= 7
+        body += bytes(chunk)
+    return _der(0x06, bytes(body))
+
+
+def _int(value: int) -> bytes:
+    return _der(0x02, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def _algid(oid: str) -> bytes:
+    return _seq(_oid(oid), b'\x05\x00')
+
+
+def _unpack(fmt: str, buf, offset: int) -> tuple:
+    # struct.unpack_from, with a truncated image reported as a format error
+    if offset < 0 or offset + struct.calcsize(fmt) > len(buf):
+        raise PEFormatError('image truncated at offset 0x{:x}'.format(offset))
+    return struct.unpack_from(fmt, buf, offset)
+
+
+class PEImage:
+    # Locations of the fields and regions the Authenticode hash
+    # is computed over.
+    def __init__(self, buf):
+        if len(buf) < 0x40 or buf[:2] != b'MZ':
+            raise PEFormatError('not a PE/COFF image')
+        pe_offset = _unpack('<I', buf, 0x3c)[0]
+        if buf[pe_offset:pe_offset + 4] != b'PE\0\0':
+            raise PEFormatError('PE signature not found')
+        coff = pe_offset + 4
+        nsections, opthdr_size = _unpack('<2xH12xH', buf, coff)
+        opthdr = coff + 20
+        magic = _unpack('<H', buf, opthdr)[0]
+        if magic == 0x10b:
+            ddir_offset = opthdr + 96
+        elif magic == 0x20b:
+            ddir_offset = opthdr + 112
+        else:
+            raise PEFormatError('unrecognized optional header magic 0x{:x}'.format(magic))
+        ndirs = _unpack('<I', buf, ddir_offset - 4)[0]
+        if ndirs <= IMAGE_DIRECTORY_ENTRY_SECURITY:
+            raise PEFormatError('no certificate table directory entry')
+        self.checksum_offset = opthdr + 64
+        self.certdir_offset = ddir_offset + 8 * IMAGE_DIRECTORY_ENTRY_SECURITY
+        self.size_of_headers = _unpack('<I', buf, opthdr + 60)[0]
+        cert_offset, cert_size = _unpack('<II', buf, self.certdir_offset)
+        self.data_size = len(buf)
+        if cert_size:
+            # An existing signature gets replaced
+            if cert_offset + cert_size != len(buf):
+                raise PEFormatError('existing certificate table is not at the end of the image')
+            self.data_size = cert_offset
+        if not self.certdir_offset + 8 <= self.size_of_headers <= self.data_size:
+            raise PEFormatError('invalid size of headers 0x{:x}'.format(self.size_of_headers))
+        self.sections = []
+        section_table = opthdr + opthdr_size
+        for i in range(nsections):
+            raw_size, raw_ptr = _unpack('<II', buf, section_table + 40 * i + 16)
+            if raw_size:
+                if raw_ptr + raw_size > self.data_size:
+                    raise PEFormatError('section {} extends past the end of the image'.format(i))
+                self.sections.append((raw_ptr, raw_size))
+        self.sections.sort()
+
+    def digest(self, buf, padding_size: int) -> bytes:
+        view = memoryview(buf)
+        h = hashlib.sha256()
+        h.update(view[:self.checksum_offset])
+        h.update(view[self.checksum_offset + 4:self.certdir_offset])
+        h.update(view[self.certdir_offset + 8:self.size_of_headers])
+        end = self.size_of_headers
+        for ptr, size in self.sections:
+            h.update(view[ptr:ptr + size])
+            end = max(end, ptr + size)
+        if end < self.data_size:
+            h.update(view[end:self.data_size])
+        h.update(b'\0' * padding_size)
+        view.release()
+        return h.digest()
+
+
+def _spc_indirect_data_content(digest: bytes) -> bytes:
+    # SpcPeImageData with no flags and the customary "<<<Obsolete>>>" file link
+    obsolete = '<<<Obsolete>>>'.encode('utf-16-be')
+    pe_image_data = _seq(_der(0x03, b'\x00'), _der(0xa0, _der(0xa2, _der(0x80, obsolete))))
+    return _seq(_seq(_oid(OID_SPC_PE_IMAGE_DATA), pe_image_data),
+                _seq(_algid(OID_SHA256), _der(0x04, digest)))
+
+
+def signed_data(digest: bytes, key: rsa.RSAPrivateKey, cert: x509.Certificate) -> bytes:
+    content = _spc_indirect_data_content(digest)
+    # The messageDigest attribute covers the content octets of the
+    # SpcIndirectDataContent, without its tag and length
+    content_body = content[2 + (content[1] & 0x7f if content[1] & 0x80 else 0):]
+    attributes = [_seq(_oid(OID_CONTENT_TYPE), _set(_oid(OID_SPC_INDIRECT_DATA))),
+                  _seq(_oid(OID_SPC_SP_OPUS_INFO), _set(_seq())),
+                  _seq(_oid(OID_MESSAGE_DIGEST), _set(_der(0x04, hashlib.sha256(content_body).digest())))]
+    signed_attrs = _set(*attributes)
+    signature = key.sign(signed_attrs, padding.PKCS1v15(), hashes.SHA256())
+    signer_info = _seq(_int(1),
+                       _seq(cert.issuer.public_bytes(), _int(cert.serial_number)),
+                       _algid(OID_SHA256),
+                       b'\xa0' + signed_attrs[1:],
+                       _algid(OID_RSA_ENCRYPTION),
+                       _der(0x04, signature))
+    sd = _seq(_int(1),
+              _set(_algid(OID_SHA256)),
+              _seq(_oid(OID_SPC_INDIRECT_DATA), _der(0xa0, content)),
+              _der(0xa0, cert.public_bytes(serialization.Encoding.DER)),
+              _set(signer_info))
+    return _seq(_oid(OID_SIGNED_DATA), _der(0xa0, sd))
+
+
+def pe_checksum(buf, checksum_offset: int) -> int:
+    size = len(buf)
+    total = 0
+    for pos in range(0, size - size % 2, 1048576):
+        chunk = buf[pos:min(pos + 1048576, size - size % 2)]
+        total += sum(struct.unpack('<{}H'.format(len(chunk) // 2), chunk))
+    if size % 2:
+        total += buf[size - 1]
+    # the checksum field itself is excluded
+    total -= sum(_unpack('<HH', buf, checksum_offset))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return (total + size) & 0xffffffff
+
+
+def sign_pe(infile: str, outfile: str, key: rsa.RSAPrivateKey, cert: x509.Certificate):
+    with open(infile, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            image = PEImage(buf)
+            # The certificate table must be 8-byte aligned; the padding is
+            # part of the hashed image
+            padding_size = -image.data_size % 8
+            digest = image.digest(buf, padding_size)
+    sig = signed_data(digest, key, cert)
+    cert_size = 8 + len(sig) + (-len(sig) % 8)
+    with open(infile, 'rb') as src, open(outfile, 'w+b') as dst:
+        offset = 0
+        while offset < image.data_size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, image.data_size - offset)
+            if sent == 0:
+                raise PEFormatError('{} was truncated while signing'.format(infile))
+            offset += sent
+        dst.seek(image.data_size)
+        dst.write(b'\0' * padding_size)
+        dst.write(struct.pack('<IHH', cert_size, WIN_CERT_REVISION_2_0, WIN_CERT_TYPE_PKCS_SIGNED_DATA))
+        dst.write(sig)
+        dst.write(b'\0' * (-len(sig) % 8))
+        dst.seek(image.certdir_offset)
+        dst.write(struct.pack('<II', image.data_size + padding_size, cert_size))
+        dst.flush()
+        with mmap.mmap(dst.fileno(), 0) as buf:
+            struct.pack_into('<I', buf, image.checksum_offset, pe_checksum(buf, image.checksum_offset))
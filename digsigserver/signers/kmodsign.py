@@ -1,7 +1,41 @@
 import os
 import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from digsigserver.signers import Signer
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.serialization import pkcs7
 from sanic import Sanic
+from sanic.log import logger
+
+# Trailer appended to signed modules, as generated by
+# scripts/sign-file in the kernel sources
+MODULE_SIG_MAGIC = b'~Module signature appended~\n'
+PKEY_ID_PKCS7 = 2
+
+hash_algorithms = {'sha256': hashes.SHA256,
+                   'sha384': hashes.SHA384,
+                   'sha512': hashes.SHA512}
+
+
+# Equivalent of 'sign-file <hashalg> <key> <cert> <module>': a detached
+# PKCS#7 signature with no certificates or signed attributes, followed by
+# the module_signature structure and the magic string.
+def _sign_module(path: str, key, cert: x509.Certificate, hashalg: str):
+    with open(path, 'rb') as f:
+        data = f.read()
+    sig = pkcs7.PKCS7SignatureBuilder().set_data(data).add_signer(
+        cert, key, hash_algorithms[hashalg]()
+    ).sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature,
+                                        pkcs7.PKCS7Options.NoAttributes,
+                                        pkcs7.PKCS7Options.NoCerts,
+                                        pkcs7.PKCS7Options.Binary])
+    with open(path, 'ab') as f:
+        f.write(sig)
+        f.write(struct.pack('>BBBBB3xI', 0, 0, PKEY_ID_PKCS7, 0, 0, len(sig)))
+        f.write(MODULE_SIG_MAGIC)
 
 
 class KernelModuleSigner(Signer):
@@ -9,15 +43,54 @@ class KernelModuleSigner(Signer):
     keytag = 'kmodsign'
 
     def __init__(self, app: Sanic, workdir: str, machine: str, hashalg: str):
-        signcmd = os.path.join('/usr', 'src', 'linux-headers-{}'.format(os.uname().release),
-                               'scripts', 'sign-file')
-        if not os.path.exists(signcmd):
-            raise RuntimeError('cannot find {} for module signing'.format(signcmd))
-        self.signcmd = signcmd
+        backend = app.config.get('KMODSIGN_BACKEND')
+        if backend not in ['native', 'sign-file']:
+            raise RuntimeError('unrecognized module signing backend: {}'.format(backend))
+        if backend == 'sign-file':
+            signcmd = app.config.get('KMODSIGN_SIGN_FILE') or os.path.join(
+                '/usr', 'src', 'linux-headers-{}'.format(os.uname().release), 'scripts', 'sign-file')
+            if not os.path.exists(signcmd):
+                raise RuntimeError('cannot find {} for module signing'.format(signcmd))
+            self.signcmd = signcmd
         if not re.match(r'sha(256|384|512)$', hashalg):
             raise ValueError('unrecognized hash algorithm: {}'.format(hashalg))
         self.hashalg = hashalg
-        super().__init__(app, workdir, machine)
+        self.workers = int(app.config.get('KMODSIGN_WORKERS')) or os.cpu_count() or 1
+        super().__init__(app, workdir, machine, backend)
+
+    def _modules(self) -> list:
+        result = []
+        for dirpath, _, filenames in os.walk(self.workdir):
+            for file in filenames:
+                if file.endswith('.ko'):
+                    result.append(os.path.join(dirpath, file))
+        return result
+
+    def _sign_native(self, modules: list) -> bool:
+        try:
+            key = self.keys.private_key('kernel-signkey.priv')
+            cert = self.keys.certificates('kernel-signkey.x509')[0]
+        except ValueError:
+            logger.error("could not parse module signing key or certificate")
+            return False
+
+        def sign_one(path: str) -> bool:
+            try:
+                _sign_module(path, key, cert, self.hashalg)
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning("signing error for {}: {}".format(path, e))
+                return False
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return all(executor.map(sign_one, modules))
+
+    def _sign_file(self, modules: list, privkey: str, pubkey: str) -> bool:
+        def sign_one(path: str) -> bool:
+            return self.run_command([self.signcmd, self.hashalg, privkey, pubkey, path], cleanup=False)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return all(executor.map(sign_one, modules))
 
     def sign(self) -> bool:
         privkey = self.keys.get('kernel-signkey.priv')
@@ -25,12 +98,11 @@ class KernelModuleSigner(Signer):
         if not privkey or not pubkey:
             raise RuntimeError('key missing for module signing')
 
-        for dirpath, _, filenames in os.walk(self.workdir):
-            for file in filenames:
-                if file.endswith('.ko'):
-                    cmd = [self.signcmd, self.hashalg, privkey, pubkey, os.path.join(dirpath, file)]
-                    if not self.run_command(cmd, cleanup=False):
-                        self.keys.cleanup()
-                        return False
-        self.keys.cleanup()
-        return True
+        modules = self._modules()
+        logger.info("Signing {} modules with {} backend".format(len(modules), self.backend))
+        try:
+            if self.backend == 'native':
+                return self._sign_native(modules)
+            return self._sign_file(modules, privkey, pubkey)
+        finally:
+            self.keys.cleanup()
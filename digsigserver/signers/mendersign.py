@@ -1,8 +1,179 @@
+import base64
+import hashlib
 import os
 import shutil
+import tarfile
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
 from digsigserver.signers import Signer
 from digsigserver import utils
 from sanic import Sanic
+from sanic.log import logger
+
+TAR_BLOCK_SIZE = 512
+COPY_CHUNK_SIZE = 1048576
+
+
+class ArtifactFormatError(Exception):
+    pass
+
+
+def _read_exact(src, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = src.read(size - len(data))
+        if not chunk:
+            raise ArtifactFormatError('artifact is truncated')
+        data += chunk
+    return bytes(data)
+
+
+def _copy(src, dst, size: int, h=None):
+    while size > 0:
+        chunk = src.read(min(size, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise ArtifactFormatError('artifact is truncated')
+        if h:
+            h.update(chunk)
+        dst.write(chunk)
+        size -= len(chunk)
+
+
+def _padding(size: int) -> int:
+    return -size % TAR_BLOCK_SIZE
+
+
+def _tar_number(field: bytes) -> int:
+    if field[0] & 0x80:
+        # GNU base-256 encoding, used for sizes over 8GiB
+        return int.from_bytes(field[1:], 'big')
+    try:
+        return int(field.strip(b'\0 ') or b'0', 8)
+    except ValueError:
+        raise ArtifactFormatError('invalid tar header')
+
+
+def _pax_records(data: bytes) -> dict:
+    records = {}
+    while data:
+        length, _, rest = data.partition(b' ')
+        try:
+            record = rest[:int(length) - len(length) - 2]
+            data = data[int(length):]
+        except ValueError:
+            raise ArtifactFormatError('invalid pax header')
+        key, _, value = record.partition(b'=')
+        records[key.decode('utf-8')] = value.decode('utf-8')
+    return records
+
+
+def _read_member(src):
+    # Reads the header block(s) for the next member of the outer tar
+    # archive, returning them unmodified along with the member's name
+    # and size, or None at the end of the archive.
+    blocks = bytearray()
+    longname = None
+    pax = {}
+    while True:
+        hdr = _read_exact(src, TAR_BLOCK_SIZE)
+        if hdr == bytes(TAR_BLOCK_SIZE):
+            if blocks:
+                raise ArtifactFormatError('archive ends in the middle of a member header')
+            return None
+        if _tar_number(hdr[148:156]) != sum(hdr[:148]) + 256 + sum(hdr[156:]):
+            raise ArtifactFormatError('invalid tar header checksum')
+        blocks += hdr
+        size = _tar_number(hdr[124:136])
+        typeflag = hdr[156:157]
+        if typeflag in [b'x', b'g', b'L', b'K']:
+            data = _read_exact(src, size + _padding(size))
+            blocks += data
+            if typeflag == b'L':
+                longname = data[:size].rstrip(b'\0').decode('utf-8')
+            elif typeflag == b'x':
+                pax.update(_pax_records(data[:size]))
+            continue
+        name = hdr[:100].rstrip(b'\0').decode('utf-8')
+        if hdr[257:262] == b'ustar' and hdr[345:500].rstrip(b'\0'):
+            name = hdr[345:500].rstrip(b'\0').decode('utf-8') + '/' + name
+        name = pax.get('path', longname or name)
+        size = int(pax.get('size', size))
+        return bytes(blocks), hdr, name, size
+
+
+def _manifest_entries(manifest: bytes) -> dict:
+    entries = {}
+    for line in manifest.decode('utf-8').splitlines():
+        if line:
+            checksum, _, name = line.partition('  ')
+            entries[name] = checksum
+    return entries
+
+
+def sign_manifest(key, manifest: bytes) -> bytes:
+    # Same signature encodings as mender-artifact: base64 of the PKCS#1 v1.5
+    # signature for RSA, or of the raw (r, s) pair for ECDSA
+    if isinstance(key, rsa.RSAPrivateKey):
+        sig = key.sign(manifest, padding.PKCS1v15(), hashes.SHA256())
+    elif isinstance(key, ec.EllipticCurvePrivateKey):
+        r, s = decode_dss_signature(key.sign(manifest, ec.ECDSA(hashes.SHA256())))
+        size = (key.curve.key_size + 7) // 8
+        sig = r.to_bytes(size, 'big') + s.to_bytes(size, 'big')
+    elif isinstance(key, ed25519.Ed25519PrivateKey):
+        sig = key.sign(manifest)
+    else:
+        raise ValueError('unsupported key type for mender signing')
+    return base64.b64encode(sig)
+
+
+def sign_artifact(src, dst, key):
+    # Copies the outer tar archive of a Mender artifact from src to dst,
+    # inserting manifest.sig after the manifest.  Only the manifest is
+    # held in memory; all other members are passed through as-is, and
+    # the top-level ones listed in the manifest have their checksums
+    # verified along the way.
+    digests = {}
+    manifest = None
+    while True:
+        member = _read_member(src)
+        if member is None:
+            break
+        blocks, hdr, name, size = member
+        if name == 'manifest.sig':
+            raise ArtifactFormatError('artifact is already signed')
+        dst.write(blocks)
+        if name == 'manifest':
+            data = _read_exact(src, size + _padding(size))
+            dst.write(data)
+            manifest = _manifest_entries(data[:size])
+            sig = sign_manifest(key, data[:size])
+            info = tarfile.TarInfo.frombuf(hdr, 'utf-8', 'surrogateescape')
+            info.name = 'manifest.sig'
+            info.size = len(sig)
+            dst.write(info.tobuf(tarfile.USTAR_FORMAT))
+            dst.write(sig + bytes(_padding(len(sig))))
+            continue
+        h = hashlib.sha256() if manifest is None or name in manifest else None
+        _copy(src, dst, size, h)
+        _copy(src, dst, _padding(size))
+        if h:
+            digests[name] = h.hexdigest()
+    if manifest is None:
+        raise ArtifactFormatError('no manifest found in artifact')
+    for name, digest in digests.items():
+        if name in manifest and manifest[name] != digest:
+            raise ArtifactFormatError('checksum mismatch for {}'.format(name))
+    # end-of-archive marker, plus any padding out to the record size
+    dst.write(bytes(TAR_BLOCK_SIZE))
+    while True:
+        chunk = src.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        dst.write(chunk)
 
 
 class MenderSigner(Signer):
@@ -10,8 +181,12 @@ class MenderSigner(Signer):
     keytag = 'mender'
 
     def __init__(self, app: Sanic, workdir: str, distro: str, artifact_uri: str):
+        backend = app.config.get('MENDER_BACKEND')
+        if backend not in ['native', 'mender-artifact']:
+            raise RuntimeError('unrecognized mender backend: {}'.format(backend))
+        self.native = backend == 'native'
         signcmd = shutil.which('mender-artifact')
-        if not signcmd:
+        if not signcmd and not self.native:
             raise RuntimeError('no mender-artifact command')
         self.signcmd = signcmd
         if not utils.uri_exists(artifact_uri):
@@ -19,7 +194,33 @@ class MenderSigner(Signer):
         self.artifact_uri = artifact_uri
         super().__init__(app, workdir, distro)
 
+    def _sign_native(self) -> bool:
+        try:
+            key = self.keys.private_key('private.key')
+        except ValueError:
+            logger.error("could not parse mender signing key")
+            return False
+        finally:
+            self.keys.cleanup()
+        src = utils.uri_open_read(self.artifact_uri)
+        try:
+            dst = utils.uri_open_write(self.artifact_uri)
+            try:
+                sign_artifact(src, dst, key)
+            except BaseException:
+                dst.abort()
+                raise
+            dst.commit()
+        except (ArtifactFormatError, ValueError) as e:
+            logger.warning("signing error: {}".format(e))
+            return False
+        finally:
+            src.close()
+        return True
+
     def sign(self) -> bool:
+        if self.native:
+            return self._sign_native()
         privkey = self.keys.get('private.key')
         if not privkey:
             raise RuntimeError('key missing for mender signing')
@@ -1,17 +1,69 @@
 import os
 import copy
+import math
 import shutil
+import struct
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import utils
 
 from digsigserver.signers import Signer
+from digsigserver.signers.opteesign import SHDR_ENCRYPTED_TA, SHDR_MAGIC, SHDR_SIZE, algorithms
 
 from sanic import Sanic
 from sanic.log import logger
 
 
+# In-process equivalent of Rockchip's resign_ta.py: replaces the
+# signature in the TA's signed header.  If the new key's signature
+# size differs from the old one, the header changes, so the digest
+# has to be recomputed (which isn't possible for encrypted TAs).
+def _resign_ta(path: str, key: rsa.RSAPrivateKey) -> bool:
+    with open(path, 'rb') as f:
+        shdr = f.read(SHDR_SIZE)
+        if len(shdr) != SHDR_SIZE:
+            logger.error("{}: too short for a TA".format(path))
+            return False
+        magic, img_type, img_size, algo, digest_len, sig_len = struct.unpack('<IIIIHH', shdr)
+        if magic != SHDR_MAGIC:
+            logger.error("{}: bad TA header magic".format(path))
+            return False
+        if algo == algorithms['TEE_ALG_RSASSA_PKCS1_PSS_MGF1_SHA256']:
+            pad = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=digest_len)
+        elif algo == algorithms['TEE_ALG_RSASSA_PKCS1_V1_5_SHA256']:
+            pad = padding.PKCS1v15()
+        else:
+            logger.error("{}: unsupported signing algorithm 0x{:08x}".format(path, algo))
+            return False
+        img_digest = f.read(digest_len)
+        f.seek(sig_len, os.SEEK_CUR)
+        rest = f.read()
+    new_sig_len = math.ceil(key.key_size / 8)
+    if new_sig_len != sig_len:
+        if img_type == SHDR_ENCRYPTED_TA:
+            logger.error("{}: cannot change the signature size of an encrypted TA".format(path))
+            return False
+        shdr = struct.pack('<IIIIHH', magic, img_type, img_size, algo, digest_len, new_sig_len)
+        h = hashes.Hash(hashes.SHA256())
+        h.update(shdr)
+        h.update(rest)
+        img_digest = h.finalize()
+    sig = key.sign(img_digest, pad, utils.Prehashed(hashes.SHA256()))
+    with open(path, 'wb') as f:
+        f.write(shdr)
+        f.write(img_digest)
+        f.write(sig)
+        f.write(rest)
+    return True
+
+
 class RockchipOpteeSigner (Signer):
 
     keytag = 'rkopteesign'
-    tools = ['change_puk', 'resign_ta.py']
 
     def __init__(self, app: Sanic, workdir: str, machine: str):
         logger.debug("{}: machine: {}".format(self.__class__.__name__, machine))
@@ -19,7 +71,11 @@ class RockchipOpteeSigner (Signer):
         if not os.path.exists(self.toolspath):
             logger.error("RK_TOOLS_PATH({}) not found".format(self.toolspath))
             raise ValueError("no tools available")
-        for tool in self.tools:
+        self.ta_backend = app.config.get('RK_OPTEE_TA_BACKEND')
+        if self.ta_backend not in ['native', 'script']:
+            raise RuntimeError('unrecognized TA signing backend: {}'.format(self.ta_backend))
+        tools = ['change_puk', 'resign_ta.py'] if self.ta_backend == 'script' else ['change_puk']
+        for tool in tools:
             if not os.path.exists(os.path.join(self.toolspath, tool)):
                 logger.error("{} not found in RK_TOOLS_PATH".format(tool))
                 raise ValueError("missing required tool '{}' in ".format(tool, self.toolspath))
@@ -42,16 +98,43 @@ class RockchipOpteeSigner (Signer):
             shutil.copyfile(infile, outfile)
         return result
 
+    def _load_ta_key(self) -> Optional[rsa.RSAPrivateKey]:
+        try:
+            key = self.keys.private_key('optee-signing-key.pem')
+        except ValueError:
+            logger.error("could not parse RSA private key")
+            return None
+        if not isinstance(key, rsa.RSAPrivateKey):
+            logger.error("signing key is not an RSA private key")
+            return None
+        return key
+
     def resign_tas(self) -> bool:
         private_key = self.keys.get('optee-signing-key.pem')
-        env = self._prepare_path()
-        result = True
+        tas = []
         for dirpath, _, filenames in os.walk(self.workdir):
             for file in filenames:
                 if file.endswith(".ta"):
-                    if not self.run_command(['resign_ta.py', '--key', private_key, '--in',
-                                             os.path.join(dirpath, file)], cleanup=False, env=env):
-                        result = False
-                        break
-        self.keys.cleanup()
-        return result
+                    tas.append(os.path.join(dirpath, file))
+        if self.ta_backend == 'native':
+            key = self._load_ta_key()
+            if not key:
+                self.keys.cleanup()
+                return False
+
+            def resign_one(path: str) -> bool:
+                return _resign_ta(path, key)
+        else:
+            env = self._prepare_path()
+
+            def resign_one(path: str) -> bool:
+                return self.run_command(['resign_ta.py', '--key', private_key, '--in', path],
+                                        cleanup=False, env=env)
+
+        logger.info("Re-signing {} TAs with {} backend".format(len(tas), self.ta_backend))
+        workers = int(self.app.config.get('RKOPTEESIGN_WORKERS')) or os.cpu_count() or 1
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return all(executor.map(resign_one, tas))
+        finally:
+            self.keys.cleanup()
@@ -1,11 +1,64 @@
+import logging
 import os
+import selectors
+import signal
 import subprocess
-from typing import Optional
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+from digsigserver import metrics
+from digsigserver import usage
 from digsigserver.keyfiles import KeyFiles
 from sanic import Sanic
 from sanic.log import logger
 
 
+# Collects the output a tool writes to one of its streams, keeping
+# only the last `limit` bytes (for error reports), and passing each
+# complete line to `log`, if set, as it arrives.  Lines longer than
+# the limit (or max_line, if that is larger) are logged in pieces.
+class OutputTail:
+    max_line = 65536
+
+    def __init__(self, limit: int, log: Optional[Callable] = None):
+        self.limit = limit
+        self.log = log
+        self.chunks = deque()
+        self.size = 0
+        self.dropped = 0
+        self.partial = b''
+
+    def feed(self, data: bytes):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.chunks and self.size - len(self.chunks[0]) >= self.limit:
+            old = self.chunks.popleft()
+            self.size -= len(old)
+            self.dropped += len(old)
+        if self.log:
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            if len(self.partial) > max(self.limit, self.max_line):
+                lines.append(self.partial)
+                self.partial = b''
+            for line in lines:
+                self.log(line)
+
+    def close(self):
+        if self.log and self.partial:
+            self.log(self.partial)
+        self.partial = b''
+
+    def text(self) -> str:
+        data = b''.join(self.chunks)
+        dropped = self.dropped + max(0, len(data) - self.limit)
+        if dropped:
+            data = data[len(data) - self.limit:] if self.limit > 0 else b''
+            return '[{} bytes omitted]\n'.format(dropped) + data.decode('utf-8', errors='replace')
+        return data.decode('utf-8', errors='replace')
+
+
 class Signer:
 
     keytag = 'Unknown'
@@ -16,7 +69,14 @@ class Signer:
         self.workdir = workdir
         self.key_selector = key_selector
         self.backend = backend or 'ssl'
+        self.operation = metrics.current_operation()
+        self.usage = usage.current()
         self.keys = None
+        self.cancelled = threading.Event()
+        self.deadline = None
+        self.output_tail_size = int(app.config.get('TOOL_OUTPUT_TAIL_SIZE'))
+        self._procs = {}
+        self._procs_lock = threading.Lock()
         if load_keys:
             self.keys = KeyFiles(app, self.keytag, key_selector)
 
@@ -28,24 +88,134 @@ class Signer:
     def sign(self, *args) -> bool:
         raise RuntimeError("unimplemented sign method")
 
+    def run_timed(self, timeout: float, method, *args):
+        # Runs a signing method, killing any tools still running
+        # once timeout seconds (if non-zero) have passed
+        self.deadline = time.monotonic() + timeout if timeout > 0 else None
+        return method(*args)
+
+    def _kill(self, pid: int, reason: str):
+        with self._procs_lock:
+            entry = self._procs.get(pid)
+            if not entry or entry[1]:
+                return
+            entry[1] = reason
+            logger.warning("Killing {} (pid {}) for {} signing: {}".format(entry[0], pid, self.operation, reason))
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        metrics.tools_killed_total.inc(self.operation, reason)
+
+    def cancel(self):
+        # Called (from another thread) when the result is no longer
+        # wanted: kills the tools running now, and fails any started
+        # from here on
+        self.cancelled.set()
+        with self._procs_lock:
+            pids = list(self._procs)
+        for pid in pids:
+            self._kill(pid, 'cancelled')
+
+    def _collect_output(self, proc: subprocess.Popen, tool: str) -> tuple[OutputTail, OutputTail]:
+        # Reads the tool's output until it closes both pipes, or has exited
+        # and the pipes have been idle for a while (in case it left a
+        # background process holding them open).  Lines are only formatted
+        # for logging if debug logging is enabled.
+        debug = logger.isEnabledFor(logging.DEBUG)
+        tails = []
+        sel = selectors.DefaultSelector()
+        for name, pipe in [('stdout', proc.stdout), ('stderr', proc.stderr)]:
+            log = None
+            if debug:
+                def log(line: bytes, prefix='{} {}: '.format(tool, name)):
+                    logger.debug(prefix + line.decode('utf-8', errors='replace'))
+            tails.append(OutputTail(self.output_tail_size, log))
+            sel.register(pipe, selectors.EVENT_READ, tails[-1])
+        exited = False
+        try:
+            while sel.get_map():
+                events = sel.select(timeout=1.0)
+                if not events:
+                    if exited:
+                        break
+                    exited = os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+                    continue
+                for key, _ in events:
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        key.data.feed(data)
+                    else:
+                        sel.unregister(key.fileobj)
+        finally:
+            sel.close()
+            proc.stdout.close()
+            proc.stderr.close()
+        for tail in tails:
+            tail.close()
+        return tails[0], tails[1]
+
+    def _run(self, cmd: list, env, cwd: str) -> tuple[int, OutputTail, OutputTail]:
+        # The child is reaped with wait4() to get its resource usage.
+        # Each tool runs in its own session, so the whole process tree
+        # can be killed if the operation times out or is cancelled; it
+        # is not reaped until it has been unregistered, so its PID (and
+        # process group ID) can't be reused while we might still signal it.
+        tool = os.path.basename(cmd[0])
+        if self.cancelled.is_set():
+            stderr = OutputTail(self.output_tail_size)
+            stderr.feed('{} not run: signing cancelled'.format(tool).encode('utf-8'))
+            return -signal.SIGKILL, OutputTail(self.output_tail_size), stderr
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=cwd, env=env, start_new_session=True)
+        with self._procs_lock:
+            self._procs[proc.pid] = [tool, None]
+        timer = None
+        if self.cancelled.is_set():
+            self._kill(proc.pid, 'cancelled')
+        elif self.deadline is not None:
+            timer = threading.Timer(max(0.0, self.deadline - time.monotonic()), self._kill,
+                                    (proc.pid, 'timeout'))
+            timer.daemon = True
+            timer.start()
+        try:
+            try:
+                stdout, stderr = self._collect_output(proc, tool)
+            except BaseException:
+                # don't leave the tool running if reading its output failed
+                self._kill(proc.pid, 'error')
+                raise
+            finally:
+                os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        finally:
+            if timer:
+                timer.cancel()
+            with self._procs_lock:
+                _, killed = self._procs.pop(proc.pid)
+            _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.monotonic() - start
+        metrics.tool_duration.observe(self.operation, tool, value=wall)
+        if self.usage:
+            self.usage.record(tool, wall, rusage)
+        logger.debug("{}: wall={:.3f}s user={:.3f}s sys={:.3f}s maxrss={}KiB".format(
+            tool, wall, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss))
+        if killed:
+            stderr.feed('\n{} killed after {:.1f}s ({})'.format(tool, wall, killed).encode('utf-8'))
+        return proc.returncode, stdout, stderr
+
     def run_command(self, cmd: list, cleanup: bool = True, env: Optional[dict] = None) -> bool:
         if not env:
             env = os.environ
-        try:
-            logger.info("PATH={}".format(env.get('PATH')))
-            logger.info("Running: {}".format(cmd))
-            proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, cwd=self.workdir,
-                                  env=env, check=True, capture_output=True,
-                                  encoding='utf-8')
-            logger.debug("stdout: {}".format(proc.stdout))
-            logger.debug("stderr: {}".format(proc.stderr))
-        except subprocess.CalledProcessError as e:
-            if cleanup and self.keys:
-                self.keys.cleanup()
-            logger.warning("signing error: {}".format(e.stderr))
-            logger.warning("stdout: {}".format(e.stdout))
-            logger.warning("return code: {}".format(e.returncode))
-            return False
+        logger.info("PATH={}".format(env.get('PATH')))
+        logger.info("Running: {}".format(cmd))
+        returncode, stdout, stderr = self._run(cmd, env, self.workdir)
         if cleanup and self.keys:
             self.keys.cleanup()
+        if returncode != 0:
+            logger.warning("signing error: {}".format(stderr.text()))
+            logger.warning("stdout: {}".format(stdout.text()))
+            logger.warning("return code: {}".format(returncode))
+            return False
         return True
@@ -1,19 +1,61 @@
+import os
 import shutil
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import pkcs7
 from digsigserver.signers import Signer
 from sanic import Sanic
+from sanic.log import logger
 
 
 class SwupdateSigner(Signer):
     keytag = 'swupdate'
 
     def __init__(self, app: Sanic, workdir: str, distro: str, backend: str):
+        ssl_backend = app.config.get('SWUPDATE_SSL_BACKEND')
+        if ssl_backend not in ['native', 'openssl']:
+            raise RuntimeError('unrecognized swupdate ssl backend: {}'.format(ssl_backend))
+        self.native = ssl_backend == 'native' and backend in [None, 'ssl']
         signcmd = shutil.which('openssl')
-        if not signcmd:
+        if not signcmd and not self.native:
             raise RuntimeError('no openssl command')
         self.signcmd = signcmd
         super().__init__(app, workdir, distro, backend, load_keys=backend != 'pkcs11')
 
+    def _sign_native(self, method: str, sw_description: str, outfile: str) -> bool:
+        with open(os.path.join(self.workdir, sw_description), 'rb') as f:
+            data = f.read()
+        try:
+            match method:
+                case "RSA":
+                    # equivalent to 'openssl dgst -sha256 -sign'
+                    key = self.keys.private_key('rsa-private.key')
+                    sig = key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+                case "CMS":
+                    # equivalent to 'openssl cms -sign -outform DER -nosmimecap -binary'
+                    # (which includes only the first certificate from the -signer file)
+                    certs = self.keys.certificates('cms.cert')
+                    key = self.keys.private_key('cms-private.key')
+                    sig = pkcs7.PKCS7SignatureBuilder().set_data(data).add_signer(
+                        certs[0], key, hashes.SHA256()
+                    ).sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature,
+                                                        pkcs7.PKCS7Options.Binary,
+                                                        pkcs7.PKCS7Options.NoCapabilities])
+                case _:
+                    raise RuntimeError('Unrecognized signing method {} allowed: RSA, CMS'.format(method))
+        except (ValueError, TypeError) as e:
+            logger.warning("signing error: {}".format(e))
+            return False
+        finally:
+            self.keys.cleanup()
+        with open(outfile, 'wb') as f:
+            f.write(sig)
+        return True
+
     def sign(self, method: str, sw_description: str, outfile: str, key_uri: str = None) -> bool:
+        if self.native:
+            return self._sign_native(method, sw_description, outfile)
         match (method, self.backend):
             case ("RSA", "ssl"):
                 keys = self.ensure_keys_loaded()
@@ -1,13 +1,22 @@
 import os
+import compileall
 import copy
+import hashlib
 import re
 import shutil
+import stat
+import tempfile
+import threading
+import time
 from typing import Optional
 from digsigserver.signers import Signer
+from digsigserver.signers import tegrasign_cache
 
 from sanic import Sanic
 from sanic.log import logger
 
+_tools_template_locks = {}
+
 
 class TegraSigner (Signer):
 
@@ -38,6 +47,9 @@ class TegraSigner (Signer):
     wrapped_scripts = [os.path.join('bootloader', 'BUP_generator.py'),
                        os.path.join('bootloader', 'rollback', 'rollback_parser.py')]
 
+    # Scripts replaced by tegrasign_cache.py when signing caching is enabled
+    cached_scripts = [os.path.join('bootloader', 'tegrasign_v3.py')]
+
     def __init__(self, app: Sanic, workdir: str, machine: str, soctype: str, bspversion: str):
         logger.debug("machine: {}, soctype: {}, bspversion: {}".format(machine, soctype, bspversion))
         if soctype not in ['tegra186', 'tegra194', 'tegra210', 'tegra234']:
@@ -82,6 +94,7 @@ class TegraSigner (Signer):
             self.scripts += self.r35_and_later
         self.soctype = soctype
         self.machine = machine
+        self.signing_cache_dir = app.config.get('TEGRA_SIGNING_CACHE_DIR')
         super().__init__(app, workdir, machine)
         self.local_toolsdir = os.path.join(self.workdir, '_tools')
         logger.debug("scripts: {}".format(self.scripts))
@@ -93,36 +106,134 @@ class TegraSigner (Signer):
             os.symlink(os.path.join(self.local_toolsdir, 'bootloader', s),
                        os.path.join(self.workdir, s))
 
-    def _prepare_scripts(self):
-        if os.path.exists(self.local_toolsdir):
-            shutil.rmtree(self.local_toolsdir)
-        os.mkdir(self.local_toolsdir)
+    def _tools_template_key(self) -> str:
+        h = hashlib.sha256(self.toolspath.encode('utf-8'))
+        if self.signing_cache_dir:
+            st = os.stat(tegrasign_cache.__file__)
+            h.update('signing-cache:{}:{}'.format(st.st_mtime_ns, st.st_size).encode('utf-8'))
+        for script in sorted(self.scripts):
+            src = os.path.join(self.toolspath, script)
+            h.update(script.encode('utf-8'))
+            if os.path.isdir(src):
+                for dirpath, dirnames, filenames in os.walk(src):
+                    dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+                    for name in sorted(filenames):
+                        st = os.stat(os.path.join(dirpath, name))
+                        h.update('{}:{}:{}'.format(os.path.relpath(os.path.join(dirpath, name), src),
+                                                   st.st_mtime_ns, st.st_size).encode('utf-8'))
+            else:
+                st = os.stat(src)
+                h.update('{}:{}'.format(st.st_mtime_ns, st.st_size).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    def _build_tools_template(self, dest: str):
         for script in self.scripts:
             subdir = os.path.dirname(script)
             if subdir:
-                os.makedirs(os.path.join(self.local_toolsdir, subdir), exist_ok=True)
+                os.makedirs(os.path.join(dest, subdir), exist_ok=True)
             src = os.path.join(self.toolspath, script)
-            dest = os.path.join(self.local_toolsdir, script)
+            target = os.path.join(dest, script)
             if os.path.isdir(src):
                 ignore_pat = shutil.ignore_patterns("__pycache__")
-                shutil.copytree(src, dest, ignore=ignore_pat)
+                shutil.copytree(src, target, ignore=ignore_pat)
+            elif self.signing_cache_dir and script in self.cached_scripts:
+                shutil.copyfile(src, os.path.join(os.path.dirname(target), tegrasign_cache.REAL_SCRIPT))
+                shutil.copymode(src, os.path.join(os.path.dirname(target), tegrasign_cache.REAL_SCRIPT))
+                shutil.copyfile(tegrasign_cache.__file__, target)
+                os.chmod(target, 0o755)
+                logger.debug("Copy-wrapped {} -> {} with signing cache".format(src, target))
             elif script.endswith('.py') and script in self.wrapped_scripts:
                 with open(src, 'r') as f:
                     shebang = f.readline().rstrip()
                     needs_wrapping = re.match(r'#!.*(python|python2)$', shebang) is not None
-                shutil.copyfile(src, dest + '.real' if needs_wrapping else dest)
-                shutil.copymode(src, dest + '.real' if needs_wrapping else dest)
+                shutil.copyfile(src, target + '.real' if needs_wrapping else target)
+                shutil.copymode(src, target + '.real' if needs_wrapping else target)
                 if needs_wrapping:
-                    with open(dest, 'w') as f:
-                        f.write('#!/bin/sh\npython2 {} "$@"\n'.format(dest + '.real'))
-                    os.chmod(dest, 0o755)
-                    logger.debug("Copy-wrapped {} -> {}".format(src, dest))
+                    # The template gets linked into each workdir, so the
+                    # wrapper has to locate the real script at run time
+                    with open(target, 'w') as f:
+                        f.write('#!/bin/sh\nexec python2 "$(readlink -f "$0").real" "$@"\n')
+                    os.chmod(target, 0o755)
+                    logger.debug("Copy-wrapped {} -> {}".format(src, target))
                 else:
-                    logger.debug("Copied (non-wrapped) {} -> {}".format(src, dest))
+                    logger.debug("Copied (non-wrapped) {} -> {}".format(src, target))
             else:
-                shutil.copyfile(src, dest)
-                shutil.copymode(src, dest)
-                logger.debug("Copied {} -> {}".format(src, dest))
+                shutil.copyfile(src, target)
+                shutil.copymode(src, target)
+                logger.debug("Copied {} -> {}".format(src, target))
+        # Python 2 scripts will fail to compile here, which is fine.
+        # Everything is made read-only, since the workdirs hardlink to it.
+        compileall.compile_dir(dest, quiet=2)
+        for dirpath, _, filenames in os.walk(dest):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                os.chmod(path, os.stat(path).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def _tools_template(self) -> str:
+        cachedir = self.app.config.get('L4T_TOOLS_CACHE_DIR') or os.path.join(tempfile.gettempdir(),
+                                                                              'digsigserver-l4t-tools')
+        template = os.path.join(cachedir, '{}-{}'.format(os.path.basename(os.path.dirname(self.toolspath)),
+                                                         self._tools_template_key()))
+        with _tools_template_locks.setdefault(template, threading.Lock()):
+            if os.path.isdir(template):
+                return template
+            os.makedirs(cachedir, exist_ok=True)
+            # Build under a temporary name and rename into place, so other
+            # server processes never see a partially-populated template
+            staging = tempfile.mkdtemp(dir=cachedir, prefix='.staging-')
+            try:
+                self._build_tools_template(staging)
+                os.chmod(staging, 0o755)
+                os.rename(staging, template)
+                logger.info("Staged tools template {}".format(template))
+            except OSError:
+                shutil.rmtree(staging, ignore_errors=True)
+                if not os.path.isdir(template):
+                    raise
+            self._remove_stale_templates(cachedir, template)
+        return template
+
+    @staticmethod
+    def _remove_stale_templates(cachedir: str, template: str):
+        # Once the tools have been re-staged, the templates for their
+        # earlier versions are no longer used.  Workdirs populated from
+        # them have hard links (or copies), so they are not affected.
+        # Staging directories are left for an hour, in case another
+        # server process is still building one.
+        prefix = os.path.basename(template).rsplit('-', 1)[0] + '-'
+        cutoff = time.time() - 3600
+        for name in os.listdir(cachedir):
+            path = os.path.join(cachedir, name)
+            try:
+                if name.startswith('.staging-'):
+                    if os.stat(path).st_mtime >= cutoff:
+                        continue
+                elif not name.startswith(prefix) or path == template:
+                    continue
+            except FileNotFoundError:
+                continue
+            logger.info("Removing stale tools template {}".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _prepare_scripts(self):
+        if os.path.exists(self.local_toolsdir):
+            shutil.rmtree(self.local_toolsdir)
+        template = self._tools_template()
+        hardlink = True
+        for dirpath, dirnames, filenames in os.walk(template):
+            destdir = os.path.join(self.local_toolsdir, os.path.relpath(dirpath, template))
+            os.makedirs(destdir, exist_ok=True)
+            for name in filenames:
+                src = os.path.join(dirpath, name)
+                dest = os.path.join(destdir, name)
+                if hardlink:
+                    try:
+                        os.link(src, dest)
+                        continue
+                    except OSError as e:
+                        logger.warning("cannot hardlink from tools template ({}), copying instead".format(e))
+                        hardlink = False
+                shutil.copy2(src, dest)
         # Finally, we need some symlinks in the working directory to point to
         # some of the tools
         self._prepare_symlinks(['tegraflash.py', 'BUP_generator.py'])
@@ -152,6 +263,10 @@ class TegraSigner (Signer):
         if curpath:
             env['PATH'] += ':' + curpath
         env['MACHINE'] = self.machine
+        if self.signing_cache_dir:
+            env['DIGSIGSERVER_SIGNING_CACHE_DIR'] = self.signing_cache_dir
+            env['DIGSIGSERVER_SIGNING_CACHE_MAX_SIZE'] = str(self.app.config.get('TEGRA_SIGNING_CACHE_MAX_SIZE'))
+            env['DIGSIGSERVER_SIGNING_CACHE_TOOLS'] = self._tools_template_key()
         return env
 
     def _prepare_cmd(self, env: dict, to_remove: Optional[list]) -> list:
@@ -266,6 +381,8 @@ class TegraSigner (Signer):
         env = self._prepare_path(envvars)
         self._prepare_scripts()
         cmd = self._prepare_cmd(env, None)
+        # Each entry's run adds to the payloads generated by the runs
+        # before it, so they have to be run one after another
         for spec in env['BUPGENSPECS'].split():
             localenv = copy.deepcopy(env)
             for setting in spec.split(';'):
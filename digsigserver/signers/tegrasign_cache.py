@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+#
+# Memoizing wrapper for the NVIDIA tegrasign_v3.py script.
+#
+# When signing caching is enabled, this gets installed in the
+# staged tools directory in place of tegrasign_v3.py, with the
+# original renamed to tegrasign_v3_uncached.py.  It must only
+# use the standard library, since it runs under whatever Python
+# interpreter the NVIDIA tools invoke.
+#
+# The cache key covers the command-line arguments, the contents
+# of any files they name (including the key file, and files named
+# in list files), and the version of the tools.  On a miss, the
+# real script is run and the files it creates or modifies in the
+# working directory are saved, along with its output; on a hit,
+# those are restored instead of running the script.
+#
+# Configured through the environment:
+#   DIGSIGSERVER_SIGNING_CACHE_DIR       cache directory (required)
+#   DIGSIGSERVER_SIGNING_CACHE_MAX_SIZE  maximum size in bytes
+#   DIGSIGSERVER_SIGNING_CACHE_TOOLS     tools version identifier
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REAL_SCRIPT = 'tegrasign_v3_uncached.py'
+MAX_LIST_FILE_SIZE = 1048576
+
+
+def _hash_file(h, path: str):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1048576)
+            if not chunk:
+                break
+            h.update(chunk)
+
+
+def _referenced_files(path: str) -> list:
+    # List files (XML or text) name the images to be signed, so
+    # their contents have to be part of the key as well.
+    if os.path.getsize(path) > MAX_LIST_FILE_SIZE:
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return []
+    return sorted(set(name for name in re.findall(r'[\w./+-]+', text) if os.path.isfile(name)))
+
+
+def cache_key(args: list) -> str:
+    h = hashlib.sha256()
+    h.update(os.environ.get('DIGSIGSERVER_SIGNING_CACHE_TOOLS', '').encode('utf-8'))
+    for arg in args:
+        # Files outside the working directory (such as the key, which is
+        # in a different temporary directory for each request) are
+        # identified only by their contents
+        if os.path.isabs(arg) and os.path.isfile(arg):
+            h.update(b'\0abs')
+        else:
+            h.update(b'\0' + arg.encode('utf-8'))
+        if os.path.isfile(arg):
+            h.update(b'\0file\0')
+            _hash_file(h, arg)
+            for name in _referenced_files(arg):
+                h.update(b'\0ref\0' + name.encode('utf-8') + b'\0')
+                _hash_file(h, name)
+    return h.hexdigest()
+
+
+def snapshot(topdir: str) -> dict:
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        dirnames[:] = [d for d in dirnames if d != '_tools' and not d.startswith('.bupgen-')]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if os.path.isfile(path) and not os.path.islink(path):
+                result[os.path.relpath(path, topdir)] = (st.st_mtime_ns, st.st_size, st.st_ino)
+    return result
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def evict(cachedir: str, max_size: int):
+    entries = []
+    total = 0
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+        size = _dir_size(path)
+        entries.append((mtime, size, path))
+        total += size
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def restore(entry: str) -> bool:
+    filesdir = os.path.join(entry, 'files')
+    try:
+        os.utime(entry)
+        for dirpath, _, filenames in os.walk(filesdir):
+            for name in filenames:
+                src = os.path.join(dirpath, name)
+                dest = os.path.relpath(src, filesdir)
+                if os.path.dirname(dest):
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copyfile(src, dest)
+        with open(os.path.join(entry, 'stdout'), 'rb') as f:
+            sys.stdout.buffer.write(f.read())
+        with open(os.path.join(entry, 'stderr'), 'rb') as f:
+            sys.stderr.buffer.write(f.read())
+    except FileNotFoundError:
+        # evicted while we were restoring it
+        return False
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return True
+
+
+def store(cachedir: str, key: str, outputs: list, stdout: bytes, stderr: bytes):
+    entry = os.path.join(cachedir, key)
+    if os.path.isdir(entry):
+        return
+    staging = tempfile.mkdtemp(dir=cachedir, prefix='.staging-')
+    try:
+        for name in outputs:
+            dest = os.path.join(staging, 'files', name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(name, dest)
+        with open(os.path.join(staging, 'stdout'), 'wb') as f:
+            f.write(stdout)
+        with open(os.path.join(staging, 'stderr'), 'wb') as f:
+            f.write(stderr)
+        os.rename(staging, entry)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def main() -> int:
+    real_script = os.path.join(os.path.dirname(os.path.realpath(__file__)), REAL_SCRIPT)
+    cmd = [sys.executable, real_script] + sys.argv[1:]
+    cachedir = os.environ.get('DIGSIGSERVER_SIGNING_CACHE_DIR')
+    if not cachedir:
+        return subprocess.call(cmd)
+    os.makedirs(cachedir, exist_ok=True)
+    key = cache_key(sys.argv[1:])
+    entry = os.path.join(cachedir, key)
+    if os.path.isdir(entry) and restore(entry):
+        return 0
+    before = snapshot('.')
+    proc = subprocess.run(cmd, capture_output=True)
+    sys.stdout.buffer.write(proc.stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(proc.stderr)
+    sys.stderr.flush()
+    if proc.returncode == 0:
+        after = snapshot('.')
+        outputs = sorted(name for name, stats in after.items() if before.get(name) != stats)
+        store(cachedir, key, outputs, proc.stdout, proc.stderr)
+        max_size = int(os.environ.get('DIGSIGSERVER_SIGNING_CACHE_MAX_SIZE') or 0)
+        if max_size > 0:
+            evict(cachedir, max_size)
+    return proc.returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,13 @@
+import os
 import shutil
 
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs7
+
 from digsigserver.signers import Signer
+from digsigserver.signers import authenticode
 
 from sanic import Sanic
 from sanic.log import logger
@@ -15,9 +22,55 @@ class UefiSigner (Signer):
         if signing_type not in ['sbsign', 'signature', 'attach_signature']:
             raise ValueError("signing_type '{}' invalid".format(signing_type))
         self.signing_type = signing_type
-        super().__init__(app, workdir, machine)
+        backend = app.config.get('UEFISIGN_BACKEND')
+        if backend not in ['native', 'tools']:
+            raise RuntimeError('unrecognized UEFI signing backend: {}'.format(backend))
+        super().__init__(app, workdir, machine, backend)
+
+    def _cms_signature(self, infile: str, key, cert) -> bytes:
+        # equivalent to 'openssl cms -sign -binary -outform der'
+        with open(infile, 'rb') as f:
+            data = f.read()
+        return pkcs7.PKCS7SignatureBuilder().set_data(data).add_signer(
+            cert, key, hashes.SHA256()
+        ).sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature,
+                                            pkcs7.PKCS7Options.Binary])
+
+    def _sign_native(self, infile: str, outfile: str) -> bool:
+        try:
+            key = self.keys.private_key('db.key')
+            cert = self.keys.certificates('db.crt')[0]
+        except ValueError:
+            logger.error("could not parse UEFI signing key or certificate")
+            return False
+        finally:
+            self.keys.cleanup()
+        try:
+            if self.signing_type == 'sbsign':
+                if not isinstance(key, rsa.RSAPrivateKey):
+                    logger.error("UEFI signing key is not an RSA private key")
+                    return False
+                authenticode.sign_pe(infile, outfile, key, cert)
+            elif self.signing_type == 'signature':
+                sig = self._cms_signature(infile, key, cert)
+                with open(outfile, 'wb') as f:
+                    f.write(sig)
+            elif self.signing_type == 'attach_signature':
+                sig = self._cms_signature(infile, key, cert)
+                shutil.copyfile(infile, outfile)
+                with open(outfile, 'r+b') as f:
+                    size = f.seek(0, os.SEEK_END)
+                    f.truncate(size + (-size % 2048))
+                    f.seek(0, os.SEEK_END)
+                    f.write(sig)
+        except (authenticode.PEFormatError, ValueError, TypeError) as e:
+            logger.warning("signing error: {}".format(e))
+            return False
+        return True
 
     def sign(self, infile: str, outfile: str) -> bool:
+        if self.backend == 'native':
+            return self._sign_native(infile, outfile)
         result = False
         db_key = self.keys.get('db.key')
         db_cert = self.keys.get('db.crt')
@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import os
+import re
+from typing import Optional
+from urllib.parse import parse_qs
+
+from sanic import request
+from sanic.exceptions import BadRequest
+from sanic.log import logger
+
+
+class UploadedFile:
+    def __init__(self, name: str, filename: Optional[str], type: str):
+        self.name = filename
+        self.field = name
+        self.type = type
+        self.path = None
+        self.extracted = False
+        self.digest = None
+
+
+class Upload:
+    def __init__(self):
+        self.form = {}
+        self.files = {}
+
+
+def _parse_part_headers(raw: bytes) -> tuple[str, Optional[str], str]:
+    name = None
+    filename = None
+    content_type = 'text/plain'
+    for line in raw.decode('utf-8', errors='replace').split('\r\n'):
+        hdr, _, value = line.partition(':')
+        hdr = hdr.strip().lower()
+        if hdr == 'content-disposition':
+            for pname, pvalue in re.findall(r';\s*([\w*]+)="?([^";]*)"?', value):
+                if pname.lower() == 'name':
+                    name = pvalue
+                elif pname.lower() == 'filename':
+                    filename = pvalue
+        elif hdr == 'content-type':
+            content_type = value.strip().split(';')[0]
+    if name is None:
+        raise BadRequest('multipart part without a name')
+    return name, filename, content_type
+
+
+class _TarSink:
+    def __init__(self, workdir: str):
+        self.workdir = workdir
+        self.proc = None
+        self.stderr = None
+        self.failed = False
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec('tar', '-x', '-z', '-f-', cwd=self.workdir,
+                                                         stdin=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.PIPE)
+        self.stderr = asyncio.ensure_future(self.proc.stderr.read())
+
+    async def write(self, data: bytes):
+        if self.failed:
+            return
+        try:
+            self.proc.stdin.write(data)
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self.failed = True
+
+    async def finish(self) -> bool:
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        stderr = await self.stderr
+        if await self.proc.wait() != 0 or self.failed:
+            logger.warning("tar failure: {}\n".format(stderr.decode('utf-8', errors='replace')))
+            return False
+        return True
+
+    def abort(self):
+        if self.proc.returncode is None:
+            self.proc.kill()
+        self.stderr.cancel()
+
+
+# File writes are batched up and done in the executor, so a slow
+# disk doesn't stall the event loop.
+class _FileSink:
+    write_size = 1048576
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = None
+        self.buf = bytearray()
+
+    async def start(self):
+        self.f = await asyncio.get_running_loop().run_in_executor(None, open, self.path, 'wb')
+
+    async def write(self, data: bytes):
+        self.buf += data
+        if len(self.buf) >= self.write_size:
+            data = bytes(self.buf)
+            self.buf.clear()
+            await asyncio.get_running_loop().run_in_executor(None, self.f.write, data)
+
+    def _finish(self, data: bytes):
+        try:
+            self.f.write(data)
+        finally:
+            self.f.close()
+
+    async def finish(self) -> bool:
+        await asyncio.get_running_loop().run_in_executor(None, self._finish, bytes(self.buf))
+        return True
+
+    def abort(self):
+        if self.f:
+            self.f.close()
+
+
+class _FieldSink:
+    def __init__(self):
+        self.data = bytearray()
+
+    async def write(self, data: bytes):
+        self.data += data
+
+    async def finish(self) -> bool:
+        return True
+
+    def abort(self):
+        pass
+
+
+class _DiscardSink:
+    async def write(self, data: bytes):
+        pass
+
+    async def finish(self) -> bool:
+        return True
+
+    def abort(self):
+        pass
+
+
+# Reads a multipart/form-data request body as it arrives, rather than
+# having Sanic buffer it in memory.  File parts named in `spool` are
+# written to a file in the workdir (the UploadedFile's `path`), and
+# those named in `extract` are piped directly into tar to be unpacked
+# into the workdir, if their content type is in `ok_types`.  Other
+# file parts are discarded.  If `digest` is set, the SHA-256 hash of
+# each file part's contents is recorded in its UploadedFile.
+# URL-encoded forms are also accepted, for requests that have no
+# file parts.
+async def receive_upload(req: request, workdir: str, spool: Optional[list] = None,
+                         extract: Optional[list] = None,
+                         ok_types: Optional[list] = None, digest: bool = False) -> Upload:
+    spool = spool or []
+    extract = extract or []
+    ok_types = ok_types or ["application/octet-stream"]
+    upload = Upload()
+    content_type = req.headers.get('content-type', '')
+    if content_type.startswith('application/x-www-form-urlencoded') or not content_type:
+        body = bytearray()
+        async for chunk in req.stream:
+            body += chunk
+        for name, values in parse_qs(body.decode('utf-8', errors='replace'), keep_blank_values=True).items():
+            upload.form[name] = values[0]
+        return upload
+    m = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not m:
+        raise BadRequest('expected multipart/form-data request body')
+    delimiter = b'--' + m.group(1).encode('latin-1')
+    separator = b'\r\n' + delimiter
+    buf = bytearray()
+    state = 'preamble'
+    part = None
+    sink = None
+    hasher = None
+    field_name = None
+
+    async def write(data: bytes):
+        if hasher:
+            hasher.update(data)
+        await sink.write(data)
+
+    async def end_part():
+        ok = await sink.finish()
+        if isinstance(sink, _FieldSink):
+            upload.form.setdefault(field_name, sink.data.decode('utf-8', errors='replace'))
+        elif part is not None:
+            part.extracted = ok and isinstance(sink, _TarSink)
+            if hasher:
+                part.digest = hasher.hexdigest()
+
+    try:
+        async for chunk in req.stream:
+            buf += chunk
+            while True:
+                if state == 'preamble':
+                    pos = buf.find(delimiter)
+                    if pos < 0:
+                        del buf[:max(0, len(buf) - len(delimiter))]
+                        break
+                    del buf[:pos + len(delimiter)]
+                    state = 'delimiter'
+                if state == 'delimiter':
+                    if len(buf) < 2:
+                        break
+                    if buf[:2] == b'--':
+                        state = 'done'
+                        break
+                    state = 'headers'
+                if state == 'headers':
+                    pos = buf.find(b'\r\n\r\n')
+                    if pos < 0:
+                        if len(buf) > 16384:
+                            raise BadRequest('multipart headers too long')
+                        break
+                    field_name, filename, content_type = _parse_part_headers(bytes(buf[:pos]).lstrip(b'\r\n'))
+                    del buf[:pos + 4]
+                    part = None
+                    hasher = None
+                    if filename is None:
+                        sink = _FieldSink()
+                    elif field_name in upload.files:
+                        sink = _DiscardSink()
+                    else:
+                        part = UploadedFile(field_name, filename, content_type)
+                        upload.files.setdefault(field_name, part)
+                        if digest:
+                            hasher = hashlib.sha256()
+                        if field_name in extract and content_type in ok_types:
+                            sink = _TarSink(workdir)
+                            await sink.start()
+                        elif field_name in spool:
+                            part.path = os.path.join(workdir, '.upload-{}'.format(field_name))
+                            sink = _FileSink(part.path)
+                            await sink.start()
+                        else:
+                            sink = _DiscardSink()
+                    state = 'body'
+                if state == 'body':
+                    pos = buf.find(separator)
+                    if pos < 0:
+                        keep = len(separator) - 1
+                        if len(buf) > keep:
+                            await write(bytes(buf[:len(buf) - keep]))
+                            del buf[:len(buf) - keep]
+                        break
+                    await write(bytes(buf[:pos]))
+                    del buf[:pos + len(separator)]
+                    await end_part()
+                    sink = None
+                    state = 'delimiter'
+                if state == 'done':
+                    break
+            if state == 'done':
+                buf.clear()
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+        raise
+    if sink is not None:
+        sink.abort()
+    if state != 'done':
+        raise BadRequest('truncated multipart request body')
+    return upload
@@ -0,0 +1,62 @@
+import contextvars
+import json
+import re
+import threading
+from typing import Optional
+
+_current = contextvars.ContextVar('digsigserver_usage', default=None)
+
+
+# Resource usage of the tools run while handling a signing
+# request, as reported by wait4() when each of them exits,
+# totalled for each tool.
+class ResourceUsage:
+    def __init__(self):
+        self.tools = {}
+        self._lock = threading.Lock()
+
+    def record(self, tool: str, wall: float, rusage):
+        with self._lock:
+            entry = self.tools.setdefault(tool, {'count': 0, 'wall': 0.0, 'user': 0.0, 'sys': 0.0, 'maxrss': 0})
+            entry['count'] += 1
+            entry['wall'] += wall
+            entry['user'] += rusage.ru_utime
+            entry['sys'] += rusage.ru_stime
+            entry['maxrss'] = max(entry['maxrss'], rusage.ru_maxrss)
+
+    @classmethod
+    def from_summary(cls, summary: dict) -> 'ResourceUsage':
+        usage = cls()
+        usage.tools = {tool: dict(entry) for tool, entry in summary.items()}
+        return usage
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {tool: dict(entry) for tool, entry in self.tools.items()}
+
+    def to_json(self, **fields) -> str:
+        return json.dumps(dict(fields, tools=self.summary()), sort_keys=True)
+
+    def server_timing(self) -> str:
+        # One metric per tool, with the wall time as the duration and
+        # the CPU times and peak RSS in the description
+        metrics = []
+        for tool, entry in sorted(self.summary().items()):
+            name = re.sub(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]", '_', tool)
+            desc = 'runs={} user={:.1f}ms sys={:.1f}ms maxrss={}KiB'.format(entry['count'], entry['user'] * 1000,
+                                                                          entry['sys'] * 1000, entry['maxrss'])
+            metrics.append('{};dur={:.1f};desc="{}"'.format(name, entry['wall'] * 1000, desc))
+        return ', '.join(metrics)
+
+
+def current() -> Optional[ResourceUsage]:
+    return _current.get()
+
+
+def track() -> tuple[ResourceUsage, contextvars.Token]:
+    usage = ResourceUsage()
+    return usage, _current.set(usage)
+
+
+def untrack(token: contextvars.Token):
+    _current.reset(token)
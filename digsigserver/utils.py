@@ -1,17 +1,22 @@
+import abc
+import asyncio
+import hashlib
 import os
 import shutil
 import subprocess
-from urllib.parse import urlparse
-from sanic import request
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, ParseResult
 from sanic.log import logger
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 
-def extract_files(workdir: str, f: request.File) -> bool:
+def extract_files(workdir: str, tarball: str) -> bool:
     try:
-        subprocess.run(['tar', '-x', '-z', '-f-'],
-                       input=f.body, check=True,
-                       cwd=workdir)
+        subprocess.run(['tar', '-x', '-z', '-f', tarball],
+                       stdin=subprocess.DEVNULL, check=True,
+                       capture_output=True, cwd=workdir)
     except subprocess.CalledProcessError as e:
         logger.warning("tar failure: {}\n".format(e.stderr))
         return False
@@ -31,11 +36,340 @@ def repack_files(workdir: str, outfile: str, file_list: Optional[list] = None) -
     return True
 
 
-def uri_exists(uri: str, is_dir=False) -> bool:
-    u = urlparse(uri)
-    if u.scheme == 'file' or u.scheme == '':
+async def stream_repack(workdir: str, chunk_size: int,
+                        file_list: Optional[list] = None) -> AsyncIterator[bytes]:
+    if file_list is None:
+        file_list = ['.']
+    proc = await asyncio.create_subprocess_exec('tar', '-c', '-z', '-f', '-', *file_list,
+                                                stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE,
+                                                cwd=workdir)
+    stderr = asyncio.ensure_future(proc.stderr.read())
+    try:
+        while True:
+            try:
+                data = await proc.stdout.readexactly(chunk_size)
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+            if len(data) < chunk_size:
+                # tar's exit status has to be checked before the last
+                # chunk is sent, so a failure can still be reported
+                if await proc.wait() != 0:
+                    raise RuntimeError("tar failure on repack: {}".format(
+                        (await stderr).decode('utf-8', errors='replace')))
+                if data:
+                    yield data
+                break
+            yield data
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr.cancel()
+
+
+class StorageBackend(abc.ABC):
+    @abc.abstractmethod
+    def exists(self, u: ParseResult, is_dir: bool = False) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def fetch(self, u: ParseResult, dest: str, is_dir: bool = False):
+        pass
+
+    @abc.abstractmethod
+    def upload(self, filename: str, u: ParseResult):
+        pass
+
+    @abc.abstractmethod
+    def open_read(self, u: ParseResult):
+        pass
+
+    @abc.abstractmethod
+    def open_write(self, u: ParseResult):
+        pass
+
+    @abc.abstractmethod
+    def fingerprint(self, u: ParseResult, is_dir: bool = False) -> str:
+        pass
+
+
+# Streaming writers, returned by StorageBackend.open_write().  The
+# destination is only replaced when commit() is called; abort()
+# discards everything written so far.
+class FileStreamWriter:
+    def __init__(self, path: str):
+        fd, self.tmpname = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                            prefix='.{}.'.format(os.path.basename(path)))
+        self.f = os.fdopen(fd, 'wb')
+        self.path = path
+
+    def write(self, data: bytes):
+        self.f.write(data)
+
+    def commit(self):
+        self.f.close()
+        try:
+            shutil.copymode(self.path, self.tmpname)
+        except FileNotFoundError:
+            pass
+        os.replace(self.tmpname, self.path)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.unlink(self.tmpname)
+        except FileNotFoundError:
+            pass
+
+
+class S3MultipartWriter:
+    def __init__(self, client, bucket: str, key: str, partsize: int, max_concurrency: int):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.partsize = partsize
+        self.max_concurrency = max_concurrency
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.pending = []
+        self.parts = []
+        self.buf = bytearray()
+
+    def _upload_part(self, partno: int, data: bytes) -> dict:
+        resp = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=partno, Body=data)
+        return {'ETag': resp['ETag'], 'PartNumber': partno}
+
+    def _send_part(self, data: bytes):
+        # Parts are uploaded in the background, with the number in
+        # flight (and so the memory used for them) bounded
+        if len(self.pending) >= self.max_concurrency:
+            self.parts.append(self.pending.pop(0).result())
+        partno = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.executor.submit(self._upload_part, partno, data))
+
+    def write(self, data: bytes):
+        self.buf += data
+        while len(self.buf) >= self.partsize:
+            self._send_part(bytes(self.buf[:self.partsize]))
+            del self.buf[:self.partsize]
+
+    def commit(self):
+        try:
+            if self.buf or not (self.parts or self.pending):
+                self._send_part(bytes(self.buf))
+                self.buf.clear()
+            self.parts += [future.result() for future in self.pending]
+            self.pending.clear()
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self.parts})
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class AwsCliStreamReader:
+    def __init__(self, uri: str):
+        self.cmd = ['aws', 's3', 'cp', uri, '-']
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        _, stderr = self.proc.communicate()
+        if self.proc.returncode > 0:
+            raise RuntimeError('cmd: {}\nstderr: {}'.format(' '.join(self.cmd), stderr.decode('utf-8', errors='replace')))
+
+
+class AwsCliStreamWriter:
+    def __init__(self, uri: str):
+        self.cmd = ['aws', 's3', 'cp', '-', uri]
+        logger.info("Running: {}".format(self.cmd))
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.PIPE)
+
+    def write(self, data: bytes):
+        self.proc.stdin.write(data)
+
+    def commit(self):
+        _, stderr = self.proc.communicate()
+        if self.proc.returncode != 0:
+            raise RuntimeError('cmd: {}\nstderr: {}'.format(' '.join(self.cmd), stderr.decode('utf-8', errors='replace')))
+
+    def abort(self):
+        # killing the CLI before its input ends leaves the upload incomplete
+        self.proc.kill()
+        self.proc.communicate()
+
+
+class FileStorageBackend(StorageBackend):
+    def exists(self, u: ParseResult, is_dir: bool = False) -> bool:
         return os.path.isdir(u.path) if is_dir else os.path.exists(u.path)
-    if u.scheme == 's3':
+
+    def fetch(self, u: ParseResult, dest: str, is_dir: bool = False):
+        if is_dir:
+            for f in os.listdir(u.path):
+                shutil.copyfile(os.path.join(u.path, f), os.path.join(dest, f))
+        else:
+            shutil.copyfile(u.path, dest)
+
+    def upload(self, filename: str, u: ParseResult):
+        shutil.copyfile(filename, u.path)
+
+    def open_read(self, u: ParseResult):
+        return open(u.path, 'rb')
+
+    def open_write(self, u: ParseResult):
+        return FileStreamWriter(u.path)
+
+    def fingerprint(self, u: ParseResult, is_dir: bool = False) -> str:
+        h = hashlib.sha256()
+        if is_dir:
+            if not os.path.isdir(u.path):
+                raise FileNotFoundError(u.path)
+            for dirpath, dirnames, filenames in os.walk(u.path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    st = os.stat(path)
+                    h.update('{}:{}:{}\n'.format(os.path.relpath(path, u.path), st.st_size,
+                                                 st.st_mtime_ns).encode('utf-8'))
+        else:
+            st = os.stat(u.path)
+            h.update('{}:{}:{}'.format(st.st_ino, st.st_size, st.st_mtime_ns).encode('utf-8'))
+        return h.hexdigest()
+
+
+# In-process S3 client.  A single client (and its connection pool)
+# is shared by all requests; large objects are transferred using
+# concurrent ranged GETs and multipart uploads.
+class S3StorageBackend(StorageBackend):
+    def __init__(self, endpoint_url: Optional[str] = None, max_concurrency: int = 10,
+                 chunksize: int = 8388608):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+        session = boto3.session.Session()
+        self.client = session.client('s3', endpoint_url=endpoint_url or None,
+                                     config=Config(max_pool_connections=max(10, max_concurrency * 2)))
+        self.transfer_config = TransferConfig(multipart_threshold=chunksize, multipart_chunksize=chunksize,
+                                              max_concurrency=max_concurrency)
+        self.max_concurrency = max_concurrency
+        # S3 requires all but the last part of a multipart upload to be at least 5MiB
+        self.partsize = max(chunksize, 5242880)
+
+    @staticmethod
+    def _bucket_and_key(u: ParseResult) -> tuple[str, str]:
+        return u.netloc, u.path.lstrip('/')
+
+    def _list_objects(self, bucket: str, prefix: str, max_keys: Optional[int] = None) -> list:
+        paginator = self.client.get_paginator('list_objects_v2')
+        params = {'Bucket': bucket, 'Prefix': prefix}
+        if max_keys:
+            params['PaginationConfig'] = {'MaxItems': max_keys}
+        result = []
+        for page in paginator.paginate(**params):
+            result += page.get('Contents', [])
+        return result
+
+    def _list(self, bucket: str, prefix: str, max_keys: Optional[int] = None) -> list:
+        return [obj['Key'] for obj in self._list_objects(bucket, prefix, max_keys)]
+
+    def exists(self, u: ParseResult, is_dir: bool = False) -> bool:
+        from botocore.exceptions import BotoCoreError, ClientError
+        bucket, key = self._bucket_and_key(u)
+        try:
+            if is_dir:
+                if key and not key.endswith('/'):
+                    key += '/'
+                return len(self._list(bucket, key, max_keys=1)) > 0
+            self.client.head_object(Bucket=bucket, Key=key)
+            return True
+        except (BotoCoreError, ClientError) as e:
+            logger.warning('s3 lookup of {}: {}'.format(u.geturl(), e))
+            return False
+
+    def fetch(self, u: ParseResult, dest: str, is_dir: bool = False):
+        from botocore.exceptions import BotoCoreError, ClientError
+        bucket, key = self._bucket_and_key(u)
+        try:
+            if is_dir:
+                if key and not key.endswith('/'):
+                    key += '/'
+                for objkey in self._list(bucket, key):
+                    path = os.path.join(dest, objkey[len(key):])
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    self.client.download_file(bucket, objkey, path, Config=self.transfer_config)
+            else:
+                self.client.download_file(bucket, key, dest, Config=self.transfer_config)
+        except (BotoCoreError, ClientError) as e:
+            raise RuntimeError('s3 fetch of {}: {}'.format(u.geturl(), e))
+        logger.debug("fetched: {}".format(u.geturl()))
+
+    def upload(self, filename: str, u: ParseResult):
+        from botocore.exceptions import BotoCoreError, ClientError
+        bucket, key = self._bucket_and_key(u)
+        logger.info("Uploading: {} -> {}".format(filename, u.geturl()))
+        try:
+            self.client.upload_file(filename, bucket, key, Config=self.transfer_config)
+        except (BotoCoreError, ClientError) as e:
+            raise RuntimeError('s3 upload to {}: {}'.format(u.geturl(), e))
+
+    def open_read(self, u: ParseResult):
+        from botocore.exceptions import BotoCoreError, ClientError
+        bucket, key = self._bucket_and_key(u)
+        try:
+            return self.client.get_object(Bucket=bucket, Key=key)['Body']
+        except (BotoCoreError, ClientError) as e:
+            raise RuntimeError('s3 fetch of {}: {}'.format(u.geturl(), e))
+
+    def open_write(self, u: ParseResult):
+        from botocore.exceptions import BotoCoreError, ClientError
+        bucket, key = self._bucket_and_key(u)
+        logger.info("Uploading: stream -> {}".format(u.geturl()))
+        try:
+            return S3MultipartWriter(self.client, bucket, key, self.partsize, self.max_concurrency)
+        except (BotoCoreError, ClientError) as e:
+            raise RuntimeError('s3 upload to {}: {}'.format(u.geturl(), e))
+
+    def fingerprint(self, u: ParseResult, is_dir: bool = False) -> str:
+        from botocore.exceptions import BotoCoreError, ClientError
+        bucket, key = self._bucket_and_key(u)
+        h = hashlib.sha256()
+        try:
+            if is_dir:
+                if key and not key.endswith('/'):
+                    key += '/'
+                objects = self._list_objects(bucket, key)
+                if not objects:
+                    raise FileNotFoundError(u.geturl())
+                for obj in sorted(objects, key=lambda o: o['Key']):
+                    h.update('{}:{}:{}\n'.format(obj['Key'], obj['Size'], obj['ETag']).encode('utf-8'))
+            else:
+                # the ETag alone does not change if identical content is uploaded again
+                head = self.client.head_object(Bucket=bucket, Key=key)
+                h.update('{}:{}:{}:{}'.format(head['ContentLength'], head['ETag'], head.get('LastModified'),
+                                              head.get('VersionId')).encode('utf-8'))
+        except (BotoCoreError, ClientError) as e:
+            raise RuntimeError('s3 lookup of {}: {}'.format(u.geturl(), e))
+        return h.hexdigest()
+
+
+# S3 access through the aws CLI, used when boto3 is not installed.
+class AwsCliStorageBackend(StorageBackend):
+    def exists(self, u: ParseResult, is_dir: bool = False) -> bool:
+        uri = u.geturl()
         if is_dir and not uri.endswith('/'):
             uri += '/'
         cmd = ['aws', 's3', 'ls', uri]
@@ -46,21 +380,9 @@ def uri_exists(uri: str, is_dir=False) -> bool:
         except subprocess.CalledProcessError as e:
             logger.warning('cmd: {}\nstderr: {}'.format(' '.join(cmd), e.stderr))
             return False
-    logger.error('unrecognized URI: {}'.format(uri))
-    return False
 
-
-def uri_fetch(uri: str, dest: str, is_dir=False):
-    u = urlparse(uri)
-    if u.scheme == 'file' or u.scheme == '':
-        if is_dir:
-            for f in os.listdir(u.path):
-                shutil.copyfile(os.path.join(u.path, f), os.path.join(dest, f))
-        else:
-            shutil.copyfile(u.path, dest)
-        return
-    if u.scheme == 's3':
-        cmd = ['aws', 's3', 'cp', uri, dest]
+    def fetch(self, u: ParseResult, dest: str, is_dir: bool = False):
+        cmd = ['aws', 's3', 'cp', u.geturl(), dest]
         if is_dir:
             cmd.append('--recursive')
         try:
@@ -70,17 +392,9 @@ def uri_fetch(uri: str, dest: str, is_dir=False):
             logger.debug("cmd: {}\noutput: {}\n".format(' '.join(cmd), proc.stdout))
         except subprocess.CalledProcessError as e:
             raise RuntimeError('cmd: {}\nstderr: {}'.format(' '.join(cmd), e.stderr))
-        return
-    raise RuntimeError('unrecognized URI: {}'.format(uri))
 
-
-def upload_file(filename: str, uri: str):
-    u = urlparse(uri)
-    if u.scheme == 'file' or u.scheme == '':
-        shutil.copyfile(filename, u.path)
-        return
-    if u.scheme == 's3':
-        cmd = ['aws', 's3', 'cp', filename, uri]
+    def upload(self, filename: str, u: ParseResult):
+        cmd = ['aws', 's3', 'cp', filename, u.geturl()]
         logger.info("Running: {}".format(cmd))
         try:
             subprocess.run(cmd,
@@ -88,8 +402,109 @@ def upload_file(filename: str, uri: str):
                            stdin=subprocess.DEVNULL, capture_output=True)
         except subprocess.CalledProcessError as e:
             raise RuntimeError('cmd:{}\nstderr: {}'.format(' '.join(cmd), e.stderr))
-        return
-    raise RuntimeError('unrecognized URI: {}'.format(uri))
+
+    def open_read(self, u: ParseResult):
+        return AwsCliStreamReader(u.geturl())
+
+    def open_write(self, u: ParseResult):
+        return AwsCliStreamWriter(u.geturl())
+
+    def fingerprint(self, u: ParseResult, is_dir: bool = False) -> str:
+        uri = u.geturl()
+        cmd = ['aws', 's3', 'ls', uri]
+        if is_dir:
+            if not uri.endswith('/'):
+                cmd[-1] += '/'
+            cmd.append('--recursive')
+        try:
+            proc = subprocess.run(cmd, check=True, encoding='utf-8',
+                                  stdin=subprocess.DEVNULL, capture_output=True)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError('cmd: {}\nstderr: {}'.format(' '.join(cmd), e.stderr))
+        return hashlib.sha256(proc.stdout.encode('utf-8')).hexdigest()
+
+
+_storage_config = {}
+_storage_backends = {}
+_storage_lock = threading.Lock()
+
+
+def configure_storage(config: dict):
+    with _storage_lock:
+        _storage_config.update({key: config.get(key) for key in ['S3_ENDPOINT_URL',
+                                                                 'S3_MAX_CONCURRENCY',
+                                                                 'S3_MULTIPART_CHUNKSIZE']
+                                if config.get(key) is not None})
+        _storage_backends.clear()
+
+
+def _new_s3_backend() -> StorageBackend:
+    try:
+        return S3StorageBackend(_storage_config.get('S3_ENDPOINT_URL'),
+                                int(_storage_config.get('S3_MAX_CONCURRENCY', 10)),
+                                int(_storage_config.get('S3_MULTIPART_CHUNKSIZE', 8388608)))
+    except ImportError:
+        logger.warning('boto3 not installed, falling back to aws CLI for S3 access')
+        return AwsCliStorageBackend()
+
+
+def storage_backend(uri: str) -> tuple[StorageBackend, ParseResult]:
+    u = urlparse(uri)
+    scheme = u.scheme or 'file'
+    if scheme not in ['file', 's3']:
+        raise RuntimeError('unrecognized URI: {}'.format(uri))
+    with _storage_lock:
+        backend = _storage_backends.get(scheme)
+        if not backend:
+            backend = FileStorageBackend() if scheme == 'file' else _new_s3_backend()
+            _storage_backends[scheme] = backend
+    return backend, u
+
+
+def uri_exists(uri: str, is_dir=False) -> bool:
+    try:
+        backend, u = storage_backend(uri)
+    except RuntimeError:
+        logger.error('unrecognized URI: {}'.format(uri))
+        return False
+    return backend.exists(u, is_dir=is_dir)
+
+
+def uri_fetch(uri: str, dest: str, is_dir=False):
+    backend, u = storage_backend(uri)
+    backend.fetch(u, dest, is_dir=is_dir)
+
+
+def upload_file(filename: str, uri: str):
+    backend, u = storage_backend(uri)
+    backend.upload(filename, u)
+
+
+def uri_open_read(uri: str):
+    backend, u = storage_backend(uri)
+    return backend.open_read(u)
+
+
+def uri_open_write(uri: str):
+    backend, u = storage_backend(uri)
+    return backend.open_write(u)
+
+
+def uri_fingerprint(uri: str, is_dir=False) -> str:
+    # Returns a string that changes whenever the object (or, for
+    # a directory, any object under it) is modified
+    backend, u = storage_backend(uri)
+    return backend.fingerprint(u, is_dir=is_dir)
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
 
 def to_boolean(boolstr: Optional[str]) -> bool:
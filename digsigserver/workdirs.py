@@ -0,0 +1,74 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sanic.log import logger
+
+from digsigserver.utils import process_exists
+
+
+# Creates the per-request working directories under a base directory,
+# and removes them in the background once they are released, on a
+# small dedicated thread pool, so that tearing down a large workdir
+# neither delays the response that used it nor ties up the threads
+# handling file I/O for other requests.
+#
+# Workdir names start with the PID of the process that created them,
+# so sweep() can find ones left behind by a process that exited
+# without cleaning up, or that this process lost track of.
+class WorkdirManager:
+    def __init__(self, basedir: str, concurrency: int):
+        self.basedir = basedir
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='reaper')
+        self.active = set()
+        self.removing = set()
+        self._lock = threading.Lock()
+        os.makedirs(basedir, mode=0o700, exist_ok=True)
+
+    def _create(self) -> str:
+        with self._lock:
+            path = tempfile.mkdtemp(prefix='{}-'.format(os.getpid()), dir=self.basedir)
+            self.active.add(path)
+        return path
+
+    async def create(self) -> str:
+        return await asyncio.get_running_loop().run_in_executor(None, self._create)
+
+    def _remove(self, path: str):
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            with self._lock:
+                self.removing.discard(path)
+
+    def release(self, path: str):
+        # Queues a workdir (or any other directory no longer needed)
+        # for removal, returning immediately
+        with self._lock:
+            self.active.discard(path)
+            self.removing.add(path)
+        self.executor.submit(self._remove, path)
+
+    def sweep(self) -> int:
+        count = 0
+        mypid = os.getpid()
+        for name in os.listdir(self.basedir):
+            path = os.path.join(self.basedir, name)
+            pid, _, _ = name.partition('-')
+            if not pid.isdigit():
+                continue
+            with self._lock:
+                if path in self.active or path in self.removing:
+                    continue
+            if int(pid) != mypid and process_exists(int(pid)):
+                continue
+            logger.info("Removing leftover workdir {}".format(path))
+            self.release(path)
+            count += 1
+        return count
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,87 @@
+import datetime
+import os
+import shutil
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from digsigserver.server import CodesignSanicDefaults
+
+MACHINE = 'testmachine'
+
+
+@pytest.fixture(scope='session')
+def signing_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'digsigserver test')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=30)).add_extension(
+        x509.BasicConstraints(ca=True, path_length=None), critical=True).sign(key, hashes.SHA256())
+    return key, cert
+
+
+@pytest.fixture
+def keydir(tmp_path, signing_key) -> str:
+    # Key files for MACHINE, laid out as under $DIGSIGSERVER_KEYFILE_URI,
+    # with the same key and certificate used for everything
+    key, cert = signing_key
+    key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                serialization.NoEncryption())
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    pubkey_pem = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+    files = {
+        'kmodsign/kernel-signkey.priv': key_pem,
+        'kmodsign/kernel-signkey.x509': cert_pem,
+        'swupdate/rsa-private.key': key_pem,
+        'swupdate/cms-private.key': key_pem,
+        'swupdate/cms.cert': cert_pem,
+        'mender/private.key': key_pem,
+        'uefisign/db.key': key_pem,
+        'uefisign/db.crt': cert_pem,
+    }
+    path = tmp_path / 'keys'
+    for name, data in files.items():
+        (path / MACHINE / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / MACHINE / name).write_bytes(data)
+    (path / 'cert.pem').write_bytes(cert_pem)
+    (path / 'pubkey.pem').write_bytes(pubkey_pem)
+    return str(path)
+
+
+@pytest.fixture
+def app(keydir):
+    config = dict(CodesignSanicDefaults, KEYFILE_URI='file://' + keydir)
+    return SimpleNamespace(config=config, ctx=SimpleNamespace())
+
+
+@pytest.fixture
+def workdir(tmp_path) -> str:
+    path = tmp_path / 'work'
+    path.mkdir()
+    return str(path)
+
+
+def require_tool(name: str) -> str:
+    path = shutil.which(name)
+    if not path:
+        pytest.skip('{} not installed'.format(name))
+    return path
+
+
+@pytest.fixture
+def openssl():
+    # Runs an openssl command, returning its exit status
+    path = require_tool('openssl')
+
+    def run(*args) -> int:
+        return subprocess.run([path] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    return run
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import struct
+import subprocess
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from conftest import require_tool
+from digsigserver.signers.authenticode import PEFormatError, sign_pe
+
+FILE_ALIGNMENT = 0x200
+# 1.2.840.113549.1.9.4
+MESSAGE_DIGEST = bytes.fromhex('2a864886f70d010904')
+
+
+def make_pe(sections: list, pe32plus: bool = True, trailer: bytes = b'') -> bytes:
+    # A minimal PE/COFF image with the given section contents, and any
+    # trailing data not covered by a section
+    opthdr_size = 240 if pe32plus else 224
+    coff = struct.pack('<HHIIIHH', 0x8664 if pe32plus else 0x14c, len(sections), 0, 0, 0, opthdr_size, 0x22)
+    opthdr = bytearray(opthdr_size)
+    struct.pack_into('<H', opthdr, 0, 0x20b if pe32plus else 0x10b)
+    struct.pack_into('<I', opthdr, 60, FILE_ALIGNMENT)
+    struct.pack_into('<I', opthdr, 108 if pe32plus else 92, 16)
+    section_table = b''
+    body = b''
+    for i, data in enumerate(sections):
+        size = len(data) + (-len(data) % FILE_ALIGNMENT)
+        section_table += struct.pack('<8sIIII16x', '.s{}'.format(i).encode(), len(data), 0x1000 * (i + 1),
+                                     size, FILE_ALIGNMENT + len(body))
+        body += data + bytes(size - len(data))
+    headers = b'MZ' + bytes(0x3a) + struct.pack('<I', 0x40) + b'PE\0\0' + coff + bytes(opthdr) + section_table
+    return headers + bytes(FILE_ALIGNMENT - len(headers)) + body + trailer
+
+
+def der(buf: bytes, pos: int = 0) -> tuple[int, bytes, int]:
+    # Returns the tag and contents of the DER element at pos, and the
+    # position of the next one
+    tag, length = buf[pos], buf[pos + 1]
+    pos += 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = int.from_bytes(buf[pos:pos + count], 'big')
+        pos += count
+    return tag, buf[pos:pos + length], pos + length
+
+
+def children(buf: bytes) -> list:
+    items = []
+    pos = 0
+    while pos < len(buf):
+        start = pos
+        tag, contents, pos = der(buf, pos)
+        items.append((tag, contents, buf[start:pos]))
+    return items
+
+
+def checksum(image: bytes, checksum_offset: int) -> int:
+    image = image[:checksum_offset] + bytes(4) + image[checksum_offset + 4:]
+    total = 0
+    for (word,) in struct.iter_unpack('<H', image + bytes(len(image) % 2)):
+        total += word
+        total = (total & 0xffff) + (total >> 16)
+    return total + len(image)
+
+
+def verify(image: bytes, cert: x509.Certificate):
+    # Checks an Authenticode signature the way a UEFI implementation
+    # does, with a certificate trusted directly
+    pe_offset = struct.unpack_from('<I', image, 0x3c)[0]
+    opthdr = pe_offset + 24
+    pe32plus = struct.unpack_from('<H', image, opthdr)[0] == 0x20b
+    checksum_offset = opthdr + 64
+    certdir_offset = opthdr + (144 if pe32plus else 128)
+    size_of_headers = struct.unpack_from('<I', image, opthdr + 60)[0]
+    cert_offset, cert_size = struct.unpack_from('<II', image, certdir_offset)
+    assert cert_offset % 8 == 0 and cert_offset + cert_size == len(image)
+    assert struct.unpack_from('<I', image, checksum_offset)[0] == checksum(image, checksum_offset)
+    length, revision, cert_type = struct.unpack_from('<IHH', image, cert_offset)
+    assert (length, revision, cert_type) == (cert_size, 0x200, 2)
+
+    # the image hash, over everything but the checksum, the certificate
+    # table entry and the certificate table, with the sections in order
+    h = hashlib.sha256(image[:checksum_offset] + image[checksum_offset + 4:certdir_offset] +
+                       image[certdir_offset + 8:size_of_headers])
+    nsections = struct.unpack_from('<H', image, pe_offset + 6)[0]
+    section_table = opthdr + struct.unpack_from('<H', image, pe_offset + 20)[0]
+    end = size_of_headers
+    for raw_ptr, raw_size in sorted(struct.unpack_from('<II', image, section_table + 40 * i + 16)[::-1]
+                                    for i in range(nsections)):
+        h.update(image[raw_ptr:raw_ptr + raw_size])
+        end = max(end, raw_ptr + raw_size)
+    h.update(image[end:cert_offset])
+
+    # the PKCS#7 SignedData, with the image hash in its SpcIndirectDataContent
+    _, content_info, _ = der(image[cert_offset + 8:cert_offset + length])
+    _, signed_data = [contents for _, contents, _ in children(content_info)]
+    _, _, encap_content_info, certificates, signer_infos = children(der(signed_data)[1])
+    _, spc_content = [contents for _, contents, _ in children(encap_content_info[1])]
+    _, spc_body, _ = der(spc_content)
+    _, digest_info = [contents for _, contents, _ in children(spc_body)]
+    assert children(digest_info)[1][1] == h.digest()
+    assert x509.load_der_x509_certificate(children(certificates[1])[0][2]) == cert
+
+    # the signed attributes, with the digest of the SpcIndirectDataContent
+    _, _, _, signed_attrs, _, signature = children(children(signer_infos[1])[0][1])
+    assert signed_attrs[0] == 0xa0
+    attributes = dict((children(attr)[0][1], children(children(attr)[1][1])[0][1])
+                      for _, attr, _ in children(signed_attrs[1]))
+    assert attributes[MESSAGE_DIGEST] == hashlib.sha256(spc_body).digest()
+    # signed as a SET, rather than with the implicit [0] tag
+    cert.public_key().verify(signature[1], b'\x31' + signed_attrs[2][1:], padding.PKCS1v15(), hashes.SHA256())
+
+
+@pytest.mark.parametrize('pe32plus', [True, False])
+@pytest.mark.parametrize('trailer', [b'', b'debug data not in a section'])
+def test_signed_image_verifies(tmp_path, signing_key, pe32plus, trailer):
+    key, cert = signing_key
+    image = make_pe([os.urandom(3000), b'', os.urandom(FILE_ALIGNMENT)], pe32plus, trailer)
+    (tmp_path / 'unsigned.efi').write_bytes(image)
+    sign_pe(str(tmp_path / 'unsigned.efi'), str(tmp_path / 'signed.efi'), key, cert)
+    signed = (tmp_path / 'signed.efi').read_bytes()
+    verify(signed, cert)
+    # apart from the checksum and certificate table entry, the image is unchanged
+    assert signed[:0x40 + 24 + 64] == image[:0x40 + 24 + 64]
+    assert signed[0x100:len(image)] == image[0x100:]
+
+
+def test_resigning_replaces_signature(tmp_path, signing_key):
+    key, cert = signing_key
+    (tmp_path / 'unsigned.efi').write_bytes(make_pe([os.urandom(1000)], trailer=b'odd'))
+    sign_pe(str(tmp_path / 'unsigned.efi'), str(tmp_path / 'signed.efi'), key, cert)
+    sign_pe(str(tmp_path / 'signed.efi'), str(tmp_path / 'resigned.efi'), key, cert)
+    resigned = (tmp_path / 'resigned.efi').read_bytes()
+    verify(resigned, cert)
+    assert len(resigned) == len((tmp_path / 'signed.efi').read_bytes())
+
+
+def test_sbverify(tmp_path, keydir, signing_key):
+    sbverify = require_tool('sbverify')
+    key, cert = signing_key
+    (tmp_path / 'unsigned.efi').write_bytes(make_pe([os.urandom(3000)]))
+    sign_pe(str(tmp_path / 'unsigned.efi'), str(tmp_path / 'signed.efi'), key, cert)
+    assert subprocess.run([sbverify, '--cert', os.path.join(keydir, 'cert.pem'),
+                           str(tmp_path / 'signed.efi')]).returncode == 0
+
+
+@pytest.mark.parametrize('image', [
+    b'not a PE image' * 10,
+    make_pe([os.urandom(100)])[:0x100],
+    make_pe([os.urandom(1000)])[:0x300],
+])
+def test_invalid_images(tmp_path, signing_key, image):
+    key, cert = signing_key
+    (tmp_path / 'bad.efi').write_bytes(image)
+    with pytest.raises(PEFormatError):
+        sign_pe(str(tmp_path / 'bad.efi'), str(tmp_path / 'signed.efi'), key, cert)
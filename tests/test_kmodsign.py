@@ -0,0 +1,58 @@
+import os
+import struct
+
+import pytest
+
+from conftest import MACHINE
+from digsigserver.signers.kmodsign import MODULE_SIG_MAGIC, PKEY_ID_PKCS7, KernelModuleSigner
+
+
+def split_signature(data: bytes) -> tuple[bytes, tuple, bytes]:
+    # Undoes what sign-file does: returns the module, the fields of
+    # the module_signature structure, and the signature
+    assert data.endswith(MODULE_SIG_MAGIC)
+    end = len(data) - len(MODULE_SIG_MAGIC)
+    fields = struct.unpack('>BBBBB3xI', data[end - 12:end])
+    siglen = fields[-1]
+    return data[:end - 12 - siglen], fields, data[end - 12 - siglen:end - 12]
+
+
+@pytest.mark.parametrize('hashalg', ['sha256', 'sha512'])
+def test_modules_verify(app, keydir, workdir, openssl, hashalg):
+    modules = {os.path.join(workdir, 'kernel', 'drivers', 'mod{}.ko'.format(i)): os.urandom(1000 * i + 1)
+               for i in range(4)}
+    for path, data in modules.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    with open(os.path.join(workdir, 'not-a-module.txt'), 'wb') as f:
+        f.write(b'left alone')
+
+    assert KernelModuleSigner(app, workdir, MACHINE, hashalg).sign()
+
+    cert = os.path.join(keydir, 'cert.pem')
+
+    def verify(content: bytes, sig: bytes) -> bool:
+        with open(os.path.join(workdir, 'content'), 'wb') as f:
+            f.write(content)
+        with open(os.path.join(workdir, 'content.p7s'), 'wb') as f:
+            f.write(sig)
+        # the certificate is not included in the signature, as with sign-file
+        return openssl('cms', '-verify', '-binary', '-inform', 'DER', '-in', os.path.join(workdir, 'content.p7s'),
+                       '-content', os.path.join(workdir, 'content'), '-certfile', cert, '-CAfile', cert,
+                       '-purpose', 'any', '-out', os.devnull) == 0
+
+    for path, data in modules.items():
+        with open(path, 'rb') as f:
+            module, fields, sig = split_signature(f.read())
+        assert module == data
+        assert fields[:5] == (0, 0, PKEY_ID_PKCS7, 0, 0)
+        assert verify(module, sig)
+        assert not verify(module + b'x', sig)
+    with open(os.path.join(workdir, 'not-a-module.txt'), 'rb') as f:
+        assert f.read() == b'left alone'
+
+
+def test_unrecognized_hash(app, workdir):
+    with pytest.raises(ValueError):
+        KernelModuleSigner(app, workdir, MACHINE, 'md5')
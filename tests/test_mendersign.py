@@ -0,0 +1,113 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import subprocess
+import tarfile
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+
+from conftest import MACHINE, require_tool
+from digsigserver.signers.mendersign import ArtifactFormatError, MenderSigner, sign_artifact
+
+MEMBERS = ['version', 'manifest', 'header.tar.gz', 'data/0000.tar.gz']
+
+
+def tarball(members: list, tar_format: int = tarfile.USTAR_FORMAT, gz: bool = False) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz' if gz else 'w', format=tar_format) as tf:
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            # fractional times are stored in pax headers, in pax format
+            info.mtime = 1700000000.5
+            tf.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def artifact(payload: bytes = b'', tar_format: int = tarfile.USTAR_FORMAT, manifest_checksums: bool = True) -> bytes:
+    # A version 3 Mender artifact with a single payload file
+    version = json.dumps({'format': 'mender', 'version': 3}).encode('utf-8')
+    header = gzip.compress(b'{}')
+    data = tarball([('rootfs.img', payload)], gz=True)
+    entries = [('version', version), ('header.tar.gz', header), ('data/0000/rootfs.img', payload)]
+    manifest = ''.join('{}  {}\n'.format(hashlib.sha256(content).hexdigest() if manifest_checksums else '0' * 64,
+                                         name) for name, content in sorted(entries)).encode('utf-8')
+    return tarball(list(zip(MEMBERS, [version, manifest, header, data])), tar_format)
+
+
+def members(data: bytes) -> dict:
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tf:
+        return {info.name: tf.extractfile(info).read() for info in tf.getmembers()}
+
+
+def sign(app, workdir: str, data: bytes) -> tuple[bool, bytes]:
+    path = os.path.join(workdir, 'artifact.mender')
+    with open(path, 'wb') as f:
+        f.write(data)
+    result = MenderSigner(app, workdir, MACHINE, 'file://' + path).sign()
+    with open(path, 'rb') as f:
+        return result, f.read()
+
+
+@pytest.mark.parametrize('tar_format', [tarfile.USTAR_FORMAT, tarfile.GNU_FORMAT, tarfile.PAX_FORMAT])
+def test_signed_artifact_verifies(app, keydir, workdir, openssl, tar_format):
+    unsigned = artifact(os.urandom(100000), tar_format)
+    ok, signed = sign(app, workdir, unsigned)
+    assert ok
+    with tarfile.open(fileobj=io.BytesIO(signed), mode='r:') as tf:
+        assert tf.getnames() == ['version', 'manifest', 'manifest.sig', 'header.tar.gz', 'data/0000.tar.gz']
+    before, after = members(unsigned), members(signed)
+    assert {name: data for name, data in after.items() if name != 'manifest.sig'} == before
+    # mender-artifact signs the manifest with RSA PKCS#1 v1.5 and SHA-256,
+    # and base64-encodes the signature
+    with open(os.path.join(workdir, 'manifest'), 'wb') as f:
+        f.write(after['manifest'])
+    with open(os.path.join(workdir, 'manifest.sig'), 'wb') as f:
+        f.write(base64.b64decode(after['manifest.sig']))
+    assert openssl('dgst', '-sha256', '-verify', os.path.join(keydir, 'pubkey.pem'),
+                   '-signature', os.path.join(workdir, 'manifest.sig'), os.path.join(workdir, 'manifest')) == 0
+
+
+def test_mender_artifact_validates(app, keydir, workdir):
+    mender_artifact = require_tool('mender-artifact')
+    ok, signed = sign(app, workdir, artifact(payload=os.urandom(10000)))
+    assert ok
+    assert subprocess.run([mender_artifact, 'validate', '-k', os.path.join(keydir, 'pubkey.pem'),
+                           os.path.join(workdir, 'artifact.mender')]).returncode == 0
+
+
+def test_already_signed(app, workdir):
+    ok, signed = sign(app, workdir, artifact())
+    assert ok
+    assert sign(app, workdir, signed) == (False, signed)
+
+
+def test_checksum_mismatch(app, workdir):
+    unsigned = artifact(manifest_checksums=False)
+    assert sign(app, workdir, unsigned) == (False, unsigned)
+
+
+@pytest.mark.parametrize('length', [700, 2000, 5000])
+def test_truncated(length):
+    unsigned = artifact(os.urandom(10000))
+    with pytest.raises(ArtifactFormatError):
+        sign_artifact(io.BytesIO(unsigned[:length]), io.BytesIO(), ec.generate_private_key(ec.SECP256R1()))
+
+
+def test_ecdsa_signature():
+    key = ec.generate_private_key(ec.SECP256R1())
+    dst = io.BytesIO()
+    sign_artifact(io.BytesIO(artifact()), dst, key)
+    after = members(dst.getvalue())
+    # raw r and s, each padded to the size of the curve
+    sig = base64.b64decode(after['manifest.sig'])
+    assert len(sig) == 64
+    key.public_key().verify(encode_dss_signature(int.from_bytes(sig[:32], 'big'), int.from_bytes(sig[32:], 'big')),
+                            after['manifest'], ec.ECDSA(hashes.SHA256()))
@@ -0,0 +1,38 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+from sanic.compat import Header
+from sanic.exceptions import RangeNotSatisfiable
+
+from digsigserver.server import byte_range
+
+
+def requested(range_header: str, size: int) -> tuple[int, int]:
+    req = SimpleNamespace(headers=Header({'range': range_header}))
+    return byte_range(req, os.stat_result((0, 0, 0, 0, 0, 0, size, 0, 0, 0)))
+
+
+@pytest.mark.parametrize('range_header,expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 3353)),
+    ('bytes=3000-9999', (3000, 3353)),
+    ('bytes=-100', (3254, 3353)),
+    ('bytes=-3354', (0, 3353)),
+    ('bytes=-5000', (0, 3353)),
+])
+def test_byte_range(range_header, expected):
+    assert requested(range_header, 3354) == expected
+
+
+@pytest.mark.parametrize('range_header,size', [
+    ('bytes=3354-', 3354),
+    ('bytes=5000-6000', 3354),
+    ('bytes=200-100', 3354),
+    ('bytes=-0', 3354),
+    ('bytes=-10', 0),
+    ('bytes=0-', 0),
+])
+def test_byte_range_not_satisfiable(range_header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        requested(range_header, size)
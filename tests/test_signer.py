@@ -0,0 +1,56 @@
+import os
+import signal
+
+import pytest
+
+from digsigserver.signers.signer import OutputTail, Signer
+
+
+def test_output_tail_keeps_last_bytes():
+    tail = OutputTail(10)
+    for data in [b'abcdef', b'ghijkl', b'mnop']:
+        tail.feed(data)
+    assert tail.text() == '[6 bytes omitted]\nghijklmnop'
+
+
+@pytest.mark.parametrize('limit', [0, 8, 4096])
+def test_output_tail_logs_whole_lines(limit):
+    lines = []
+    tail = OutputTail(limit, lines.append)
+    for data in [b'one\ntw', b'o\nthr', b'e', b'e\nfour']:
+        tail.feed(data)
+    tail.close()
+    assert lines == [b'one', b'two', b'three', b'four']
+
+
+def test_output_tail_splits_long_lines():
+    lines = []
+    tail = OutputTail(0, lines.append)
+    tail.feed(b'x' * (OutputTail.max_line + 1))
+    tail.feed(b'y\n')
+    assert lines == [b'x' * (OutputTail.max_line + 1), b'y']
+
+
+def test_run_returns_output(app, workdir):
+    returncode, stdout, stderr = Signer(app, workdir, load_keys=False)._run(
+        ['sh', '-c', 'echo out; echo err >&2; exit 3'], None, workdir)
+    assert (returncode, stdout.text(), stderr.text()) == (3, 'out\n', 'err\n')
+
+
+def test_run_kills_tool_if_collecting_output_fails(app, workdir, monkeypatch):
+    signer = Signer(app, workdir, load_keys=False)
+    pids = []
+
+    def collect_output(proc, tool):
+        pids.append(proc.pid)
+        raise OSError('read failed')
+
+    monkeypatch.setattr(signer, '_collect_output', collect_output)
+    with pytest.raises(OSError):
+        signer._run(['sleep', '30'], None, workdir)
+    assert not signer._procs
+    # the child has been reaped, so its PID is gone
+    with pytest.raises(ChildProcessError):
+        os.waitpid(pids[0], os.WNOHANG)
+    with pytest.raises(ProcessLookupError):
+        os.killpg(pids[0], signal.SIGKILL)
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from conftest import MACHINE
+from digsigserver.signers.swupdsign import SwupdateSigner
+
+SW_DESCRIPTION = b'software =\n{\n\tversion = "1.0";\n\thardware-compatibility = [ "1.0" ];\n};\n'
+
+
+def sign(app, workdir: str, method: str) -> str:
+    with open(os.path.join(workdir, 'sw-description'), 'wb') as f:
+        f.write(SW_DESCRIPTION)
+    outfile = os.path.join(workdir, 'sw-description.sig')
+    assert SwupdateSigner(app, workdir, MACHINE, None).sign(method, 'sw-description', outfile)
+    with open(outfile, 'rb') as f:
+        return f.read()
+
+
+def write_tampered(workdir: str) -> str:
+    path = os.path.join(workdir, 'sw-description.tampered')
+    with open(path, 'wb') as f:
+        f.write(SW_DESCRIPTION.replace(b'1.0', b'2.0'))
+    return path
+
+
+@pytest.mark.parametrize('ssl_backend', ['native', 'openssl'])
+def test_rsa_verifies(app, keydir, workdir, openssl, ssl_backend):
+    app.config['SWUPDATE_SSL_BACKEND'] = ssl_backend
+    sign(app, workdir, 'RSA')
+    # swupdate checks RSA signatures as 'openssl dgst -sha256 -verify' does
+    pubkey = os.path.join(keydir, 'pubkey.pem')
+    sig = os.path.join(workdir, 'sw-description.sig')
+    assert openssl('dgst', '-sha256', '-verify', pubkey, '-signature', sig,
+                   os.path.join(workdir, 'sw-description')) == 0
+    assert openssl('dgst', '-sha256', '-verify', pubkey, '-signature', sig, write_tampered(workdir)) != 0
+
+
+def test_rsa_native_matches_openssl(app, workdir, openssl):
+    native = sign(app, workdir, 'RSA')
+    app.config['SWUPDATE_SSL_BACKEND'] = 'openssl'
+    assert sign(app, workdir, 'RSA') == native
+
+
+@pytest.mark.parametrize('ssl_backend', ['native', 'openssl'])
+def test_cms_verifies(app, keydir, workdir, openssl, ssl_backend):
+    app.config['SWUPDATE_SSL_BACKEND'] = ssl_backend
+    sign(app, workdir, 'CMS')
+    # swupdate checks CMS signatures against its CA file, as 'openssl cms -verify' does
+    cert = os.path.join(keydir, 'cert.pem')
+    sig = os.path.join(workdir, 'sw-description.sig')
+    for content, expected in [(os.path.join(workdir, 'sw-description'), True), (write_tampered(workdir), False)]:
+        status = openssl('cms', '-verify', '-binary', '-inform', 'DER', '-in', sig, '-content', content,
+                         '-CAfile', cert, '-purpose', 'any', '-out', os.devnull)
+        assert (status == 0) == expected
+
+
+def test_unrecognized_method(app, workdir):
+    with pytest.raises(RuntimeError):
+        sign(app, workdir, 'DSA')
@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import io
+import os
+import tarfile
+from types import SimpleNamespace
+
+import pytest
+from sanic.compat import Header
+from sanic.exceptions import BadRequest
+
+from digsigserver.uploads import receive_upload
+
+BOUNDARY = 'xYzZY'
+
+# Data that looks like the start of a part delimiter, to check that
+# a near-match is not taken for the end of the part
+TRICKY = b'line\r\n--xYzZ\r\n-\r\n--xYzZy\r\r\n\r\n--xYzZ'
+
+
+def multipart(parts: list, boundary: str = BOUNDARY) -> bytes:
+    # parts are (name, value) for form fields, and (name, filename,
+    # content type, data) for files
+    body = b'preamble to be ignored\r\n'
+    for part in parts:
+        if len(part) == 2:
+            name, value = part
+            body += '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n'.format(boundary, name).encode()
+            body += value.encode() + b'\r\n'
+        else:
+            name, filename, content_type, data = part
+            body += ('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: {}\r\n\r\n').format(boundary, name, filename, content_type).encode()
+            body += data + b'\r\n'
+    return body + '--{}--\r\nepilogue to be ignored\r\n'.format(boundary).encode()
+
+
+def chunked(body: bytes, splits: list) -> list:
+    positions = [0] + sorted(splits) + [len(body)]
+    return [body[start:end] for start, end in zip(positions, positions[1:])]
+
+
+def receive(chunks: list, workdir: str, content_type: str = 'multipart/form-data; boundary=' + BOUNDARY,
+            **kwargs):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    req = SimpleNamespace(headers=Header({'content-type': content_type}), stream=stream())
+    return asyncio.run(receive_upload(req, workdir, **kwargs))
+
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_fields_and_files(tmp_path):
+    body = multipart([('machine', 'imx'), ('empty', ''),
+                      ('artifact', 'a.bin', 'application/octet-stream', TRICKY),
+                      ('other', 'b.bin', 'application/octet-stream', b'discarded')])
+    upload = receive([body], str(tmp_path), spool=['artifact'], digest=True)
+    assert upload.form == {'machine': 'imx', 'empty': ''}
+    artifact = upload.files['artifact']
+    assert (artifact.name, artifact.field, artifact.type) == ('a.bin', 'artifact', 'application/octet-stream')
+    assert read(artifact.path) == TRICKY
+    assert artifact.digest == hashlib.sha256(TRICKY).hexdigest()
+    assert upload.files['other'].path is None
+    assert upload.files['other'].digest == hashlib.sha256(b'discarded').hexdigest()
+
+
+def test_every_split_position(tmp_path):
+    body = multipart([('distro', 'test'), ('artifact', 'a.bin', 'application/octet-stream', TRICKY)])
+    for split in range(1, len(body)):
+        workdir = tmp_path / str(split)
+        workdir.mkdir()
+        upload = receive(chunked(body, [split]), str(workdir), spool=['artifact'])
+        assert upload.form == {'distro': 'test'}, split
+        assert read(upload.files['artifact'].path) == TRICKY, split
+
+
+def test_one_byte_chunks(tmp_path):
+    data = os.urandom(4096) + b'\r\n--' + BOUNDARY.encode()[:-1]
+    body = multipart([('distro', 'test'), ('artifact', 'a.bin', 'application/octet-stream', data)])
+    upload = receive(chunked(body, list(range(1, len(body)))), str(tmp_path), spool=['artifact'], digest=True)
+    assert read(upload.files['artifact'].path) == data
+    assert upload.files['artifact'].digest == hashlib.sha256(data).hexdigest()
+
+
+def test_quoted_boundary_and_empty_file(tmp_path):
+    body = multipart([('artifact', 'a.bin', 'application/octet-stream', b'')], boundary='a b:c')
+    upload = receive([body], str(tmp_path), content_type='multipart/form-data; boundary="a b:c"',
+                     spool=['artifact'])
+    assert read(upload.files['artifact'].path) == b''
+
+
+def test_first_duplicate_wins(tmp_path):
+    body = multipart([('artifact', 'a.bin', 'application/octet-stream', b'first'), ('machine', 'x'),
+                      ('artifact', 'b.bin', 'text/plain', b'second'), ('machine', 'y')])
+    upload = receive([body], str(tmp_path), spool=['artifact'])
+    assert upload.form == {'machine': 'x'}
+    assert upload.files['artifact'].name == 'a.bin'
+    assert read(upload.files['artifact'].path) == b'first'
+
+
+def test_extract(tmp_path):
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode='w:gz') as tar:
+        info = tarfile.TarInfo('dir/file.txt')
+        info.size = len(TRICKY)
+        tar.addfile(info, io.BytesIO(TRICKY))
+    body = multipart([('artifact', 'a.tar.gz', 'application/octet-stream', tarball.getvalue())])
+    upload = receive(chunked(body, [100, 101, 1000]), str(tmp_path), extract=['artifact'])
+    assert upload.files['artifact'].extracted
+    assert read(str(tmp_path / 'dir' / 'file.txt')) == TRICKY
+
+
+def test_extract_wrong_type_is_not_extracted(tmp_path):
+    body = multipart([('artifact', 'a.tar.gz', 'text/plain', b'not a tarball')])
+    upload = receive([body], str(tmp_path), extract=['artifact'])
+    assert not upload.files['artifact'].extracted
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('length', [0, 60, 160, 185])
+def test_truncated_body(tmp_path, length):
+    body = multipart([('machine', 'imx'), ('artifact', 'a.bin', 'application/octet-stream', b'data')])
+    with pytest.raises(BadRequest):
+        receive([body[:length]], str(tmp_path), spool=['artifact'])
+
+
+def test_headers_too_long(tmp_path):
+    body = '--{}\r\nX-Padding: {}'.format(BOUNDARY, 'x' * 20000).encode()
+    with pytest.raises(BadRequest):
+        receive([body], str(tmp_path))
+
+
+def test_part_without_name(tmp_path):
+    body = '--{}\r\nContent-Disposition: form-data\r\n\r\nvalue\r\n--{}--\r\n'.format(BOUNDARY, BOUNDARY).encode()
+    with pytest.raises(BadRequest):
+        receive([body], str(tmp_path))
+
+
+def test_missing_boundary(tmp_path):
+    with pytest.raises(BadRequest):
+        receive([b''], str(tmp_path), content_type='multipart/form-data')
+
+
+def test_urlencoded(tmp_path):
+    upload = receive([b'machine=im', b'x&distro=a%20b&empty='], str(tmp_path),
+                     content_type='application/x-www-form-urlencoded')
+    assert upload.form == {'machine': 'imx', 'distro': 'a b', 'empty': ''}
+    assert upload.files == {}
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+import pytest
+
+from digsigserver.utils import FileStreamWriter, S3MultipartWriter
+
+
+# Stands in for a boto3 S3 client, keeping the parts of each
+# multipart upload, and the objects that uploads were completed into
+class FakeS3Client:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.uploads = {}
+        self.objects = {}
+        self.aborted = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket: str, Key: str) -> dict:
+        upload_id = 'upload-{}'.format(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes) -> dict:
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # later parts finish first, to check they are put back in order
+        time.sleep(self.delay / PartNumber)
+        with self._lock:
+            self.in_flight -= 1
+            self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"etag-{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict):
+        parts = self.uploads.pop(UploadId)
+        assert [part['PartNumber'] for part in MultipartUpload['Parts']] == list(range(1, len(parts) + 1))
+        assert [part['ETag'] for part in MultipartUpload['Parts']] == ['"etag-{}"'.format(number)
+                                                                      for number in range(1, len(parts) + 1)]
+        self.objects[(Bucket, Key)] = b''.join(parts[number] for number in sorted(parts))
+        return {}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        self.uploads.pop(UploadId)
+        self.aborted.append((Bucket, Key))
+
+
+@pytest.mark.parametrize('size', [0, 1, 1000, 1024, 1025, 10000])
+def test_s3_multipart_writer(size):
+    client = FakeS3Client(delay=0.02)
+    data = os.urandom(size)
+    writer = S3MultipartWriter(client, 'bucket', 'key', partsize=1024, max_concurrency=3)
+    for pos in range(0, size, 300):
+        writer.write(data[pos:pos + 300])
+    writer.commit()
+    assert client.objects == {('bucket', 'key'): data}
+    assert client.max_in_flight <= 3
+
+
+def test_s3_multipart_writer_abort():
+    client = FakeS3Client()
+    writer = S3MultipartWriter(client, 'bucket', 'key', partsize=1024, max_concurrency=2)
+    writer.write(os.urandom(5000))
+    writer.abort()
+    assert client.aborted == [('bucket', 'key')]
+    assert client.objects == {}
+    assert client.uploads == {}
+
+
+def test_file_stream_writer(tmp_path):
+    path = tmp_path / 'artifact'
+    path.write_bytes(b'old contents')
+    path.chmod(0o640)
+    writer = FileStreamWriter(str(path))
+    writer.write(b'new ')
+    writer.write(b'contents')
+    assert path.read_bytes() == b'old contents'
+    writer.commit()
+    assert path.read_bytes() == b'new contents'
+    assert path.stat().st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmp_path)) == ['artifact']
+
+
+def test_file_stream_writer_abort(tmp_path):
+    path = tmp_path / 'artifact'
+    path.write_bytes(b'old contents')
+    writer = FileStreamWriter(str(path))
+    writer.write(b'new contents')
+    writer.abort()
+    assert path.read_bytes() == b'old contents'
+    assert os.listdir(str(tmp_path)) == ['artifact']